@@ -1,11 +1,13 @@
-import os, uuid, base64, json
+import os, io, uuid, base64, json, threading
 from datetime import datetime, timedelta, date
-from flask import Flask, render_template, request, redirect, url_for, session, abort, flash, jsonify
+from decimal import Decimal, ROUND_HALF_UP, InvalidOperation
+from flask import Flask, render_template, request, redirect, url_for, session, abort, flash, jsonify, g, has_app_context, has_request_context
+from flask import Response, stream_with_context
+import click
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
 import psycopg2
 from psycopg2.extras import RealDictCursor
-from supabase import create_client, Client
 
 app = Flask(__name__)
 app.secret_key = os.environ.get("SECRET_KEY", "super_secreto_demo_cambiar")
@@ -18,7 +20,40 @@ SUPABASE_URL = os.environ.get("SUPABASE_URL", "")
 SUPABASE_KEY = os.environ.get("SUPABASE_KEY", "")
 DATABASE_URL = os.environ.get("DATABASE_URL", "")
 
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+# Clientes externos: se construyen en el primer uso (ver get_supabase / _http)
+# para que importar app.py sea barato y una mala config no tumbe el arranque.
+_supabase = None
+_http_mod = None
+_upload_pool = None
+_pdf_pool = None
+_storage = None
+
+def get_supabase():
+    """Cliente Supabase perezoso; el SDK se importa aquí, no al cargar la app."""
+    global _supabase
+    if _supabase is None:
+        from supabase import create_client
+        _supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+    return _supabase
+
+def _http():
+    """Módulo `requests` importado a demanda (SAP Service Layer y utilidades)."""
+    global _http_mod
+    if _http_mod is None:
+        import requests, urllib3
+        urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+        _http_mod = requests
+    return _http_mod
+
+def reset_clients():
+    """Descarta los clientes creados antes de un fork (gunicorn --preload).
+    El master normalmente ya cerró su pool (cerrar_pool); si alguno llega hasta
+    aquí se guarda en _pool_heredado en vez de soltarlo, porque al liberarse sus
+    conexiones enviarían Terminate por sockets que siguen siendo del padre."""
+    global _supabase, _storage, _db_pool, _db_slots, _upload_pool, _pdf_pool, _pool_heredado
+    if _db_pool is not None: _pool_heredado = _db_pool
+    _supabase = _storage = None
+    _db_pool = _db_slots = _upload_pool = _pdf_pool = None
 
 # ── SAP Service Layer config ──────────────────────────────
 SAP_BASE_URL   = os.environ.get("SAP_BASE_URL","").rstrip("/")
@@ -31,6 +66,29 @@ BUCKET_FOTOS  = "fotos"
 BUCKET_FIRMAS = "firmas"
 BUCKET_AVA    = "avatares"
 ALLOWED_EXT   = {"png", "jpg", "jpeg", "webp"}
+UPLOAD_WORKERS = int(os.environ.get("UPLOAD_WORKERS", "4"))
+# supabase | local (disco, útil en pruebas y desarrollo sin proyecto Supabase)
+STORAGE_BACKEND   = os.environ.get("STORAGE_BACKEND", "supabase")
+LOCAL_STORAGE_DIR = os.environ.get("LOCAL_STORAGE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "storage_local"))
+# Envío de archivos locales por el proxy: prefijo interno de nginx o X-Sendfile
+LOCAL_STORAGE_ACCEL    = os.environ.get("LOCAL_STORAGE_ACCEL", "")
+LOCAL_STORAGE_SENDFILE = os.environ.get("LOCAL_STORAGE_SENDFILE", "0") == "1"
+SUBIDA_TTL        = int(os.environ.get("SUBIDA_TTL", "600"))   # vigencia de URLs firmadas (s)
+# Procesamiento de fotos de visitas (requiere Pillow)
+IMG_MAX_LADO   = int(os.environ.get("IMG_MAX_LADO", "2048"))
+IMG_CALIDAD    = int(os.environ.get("IMG_CALIDAD", "80"))
+IMG_FORMATO    = os.environ.get("IMG_FORMATO", "webp")            # webp | jpeg
+IMG_MINIATURAS = [int(w) for w in os.environ.get("IMG_MINIATURAS", "320,640,1280").split(",")]
+# Proxy /media con caché LRU en disco para imágenes del storage
+MEDIA_PROXY      = os.environ.get("MEDIA_PROXY", "1") == "1"
+MEDIA_CACHE_DIR  = os.environ.get("MEDIA_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "media_cache"))
+MEDIA_CACHE_MAX  = int(os.environ.get("MEDIA_CACHE_MAX_MB", "512")) * 1024 * 1024
+MEDIA_MAX_AGE    = 365 * 24 * 3600   # los nombres de objeto son únicos: contenido inmutable
+# PDF de cotizaciones y remisiones (WeasyPrint opcional: requirements-pdf.txt)
+PDF_CACHE_DIR    = os.environ.get("PDF_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "pdf_cache"))
+PDF_CACHE_MAX    = int(os.environ.get("PDF_CACHE_MAX_MB", "256")) * 1024 * 1024
+PDF_WORKERS      = int(os.environ.get("PDF_WORKERS", "4"))
+PDF_LOTE_MAX     = int(os.environ.get("PDF_LOTE_MAX", "1000"))   # documentos por ZIP
 
 # ── PERMISOS BASE POR ROL (fallback si no hay permisos en BD) ─
 PERMISOS_ROL = {
@@ -67,140 +125,195 @@ def tiene_permiso(accion, modulo="visitas"):
     return p.get(accion, False)
 
 # ── DB ────────────────────────────────────────────────────
+# Pool por proceso. DB_POOL_MAX acota las conexiones abiertas; si se agota,
+# get_db() espera (hasta DB_POOL_TIMEOUT s) en vez de fallar, lo que permite
+# que cientos de greenlets (worker gevent) compartan pocas conexiones.
+DB_POOL_MAX     = int(os.environ.get("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "30"))
+_db_pool  = None
+_db_slots = None
+_db_lock  = threading.Lock()
+_pool_heredado = None   # ver reset_clients
+
+class _ConexionPool(psycopg2.extensions.connection):
+    """Conexión cuyo close() la devuelve al pool en lugar de cerrarla."""
+    pool = None
+    prestamo = None
+
+    def close(self):
+        pool, self.pool = self.pool, None
+        if pool is None:
+            return super().close()
+        try:
+            if not self.closed: self.rollback()
+            pool.putconn(self)
+        except Exception:
+            pool.putconn(self, close=True)
+        finally:
+            _db_slots.release()
+
+def _get_pool():
+    global _db_pool, _db_slots
+    if _db_pool is None:
+        with _db_lock:
+            if _db_pool is None:
+                from psycopg2.pool import ThreadedConnectionPool
+                _db_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+                _db_pool  = ThreadedConnectionPool(0, DB_POOL_MAX, DATABASE_URL,
+                                                   connection_factory=_ConexionPool,
+                                                   cursor_factory=RealDictCursor,
+                                                   options="-c statement_timeout=30000")
+                # Se crea con minconn=0 (no abre nada al arrancar) pero conserva
+                # hasta DB_POOL_MAX conexiones ociosas para reutilizarlas.
+                _db_pool.minconn = DB_POOL_MAX
+    return _db_pool
+
+def cerrar_pool():
+    """Cierra las conexiones del pool de este proceso; el siguiente get_db() abre
+    uno nuevo. Se usa antes de hacer fork para que los workers no hereden sockets."""
+    global _db_pool, _db_slots
+    with _db_lock:
+        pool, _db_pool, _db_slots = _db_pool, None, None
+    if pool is not None and not pool.closed: pool.closeall()
+
 def get_db():
-    conn = psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor,
-                            options="-c statement_timeout=30000")
+    pool = _get_pool()
+    if not _db_slots.acquire(timeout=DB_POOL_TIMEOUT):
+        raise psycopg2.OperationalError("Pool de conexiones agotado")
+    try:
+        conn = pool.getconn()
+        if conn.closed:
+            pool.putconn(conn, close=True); conn = pool.getconn()
+    except Exception:
+        _db_slots.release(); raise
+    conn.pool = pool
+    conn.prestamo = prestamo = object()
+    if has_app_context():
+        g.setdefault("_conexiones", []).append((conn, prestamo))
     return conn
 
+@app.teardown_appcontext
+def _liberar_conexiones(exc):
+    """Devuelve al pool las conexiones que una ruta no cerró (p.ej. tras una excepción)."""
+    for conn, prestamo in g.pop("_conexiones", []):
+        if conn.pool is not None and conn.prestamo is prestamo: conn.close()
+
 def query(sql, params=(), fetchone=False, fetchall=False, commit=False):
-    conn = get_db(); cur = conn.cursor()
-    cur.execute(sql, params)
-    result = None
-    if fetchone:  result = cur.fetchone()
-    if fetchall:  result = cur.fetchall()
-    if commit:    conn.commit()
-    cur.close(); conn.close()
+    conn = get_db()
+    try:
+        cur = conn.cursor()
+        cur.execute(sql, params)
+        result = None
+        if fetchone:  result = cur.fetchone()
+        if fetchall:  result = cur.fetchall()
+        if commit:    conn.commit()
+        cur.close()
+    finally:
+        conn.close()
     return result
 
-def init_db():
+def insertar_filas(cur, tabla, columnas, filas):
+    """INSERT multi-fila (execute_values) de `filas` en `tabla`; un viaje por cada 1000 filas."""
+    from psycopg2.extras import execute_values
+    if filas:
+        execute_values(cur, f"INSERT INTO {tabla} ({','.join(columnas)}) VALUES %s", filas, page_size=1000)
+
+def ids_articulos(cur, codigos):
+    """{codigo: articulo_id} resolviendo todos los códigos en una sola consulta."""
+    codigos = list({c for c in codigos if c})
+    if not codigos: return {}
+    cur.execute("SELECT codigo,id FROM articulos WHERE codigo = ANY(%s)", (codigos,))
+    return {r["codigo"]: r["id"] for r in cur.fetchall()}
+
+# ── MIGRACIONES ───────────────────────────────────────────
+# El esquema vive en migrations/NNNN_nombre.{sql,py}; se aplica con
+# `flask --app app upgrade`. Al arrancar sólo se compara la versión.
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+MIGRATIONS_LOCK = 72610026   # pg_advisory_lock: un solo upgrade a la vez
+
+def listar_migraciones():
+    """Retorna [(version, archivo)] de migrations/ ordenado por versión."""
+    migs = []
+    for f in os.listdir(MIGRATIONS_DIR):
+        num = f.split("_", 1)[0]
+        if num.isdigit() and f.endswith((".sql", ".py")):
+            migs.append((int(num), f))
+    return sorted(migs)
+
+def version_esquema(cur):
+    """Versión aplicada en la BD (0 si schema_version aún no existe)."""
+    cur.execute("SELECT to_regclass('schema_version') IS NOT NULL AS existe")
+    if not cur.fetchone()["existe"]: return 0
+    cur.execute("SELECT COALESCE(MAX(version),0) AS v FROM schema_version")
+    return cur.fetchone()["v"]
+
+def aplicar_migracion(cur, archivo):
+    path = os.path.join(MIGRATIONS_DIR, archivo)
+    if archivo.endswith(".sql"):
+        with open(path, encoding="utf-8") as fh:
+            cur.execute(fh.read())
+    else:
+        import importlib.util
+        spec = importlib.util.spec_from_file_location(f"migracion_{archivo[:-3]}", path)
+        mod  = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(mod)
+        mod.upgrade(cur)
+
+def upgrade_db(echo=print):
+    """Aplica las migraciones pendientes, una transacción por archivo."""
     conn = get_db(); cur = conn.cursor()
-    cur.execute("""CREATE TABLE IF NOT EXISTS usuarios (
-        id SERIAL PRIMARY KEY, usuario TEXT UNIQUE NOT NULL,
-        nombre TEXT DEFAULT '', apellido TEXT DEFAULT '',
-        email TEXT UNIQUE NOT NULL, password TEXT NOT NULL,
-        rol TEXT DEFAULT 'vendedor', activo INTEGER DEFAULT 1,
-        fecha_creacion TEXT DEFAULT '',
-        telefono TEXT DEFAULT '', zona TEXT DEFAULT '', foto_url TEXT DEFAULT '',
-        supervisor_id INTEGER DEFAULT NULL
-    )""")
-    cur.execute("""CREATE TABLE IF NOT EXISTS actividades (
-        id SERIAL PRIMARY KEY, usuario_id INTEGER REFERENCES usuarios(id),
-        fecha TEXT NOT NULL, cliente TEXT NOT NULL,
-        comentarios TEXT DEFAULT '', proxima_visita TEXT DEFAULT NULL,
-        firma_archivo TEXT DEFAULT NULL
-    )""")
-    cur.execute("""CREATE TABLE IF NOT EXISTS fotos (
-        id SERIAL PRIMARY KEY, actividad_id INTEGER REFERENCES actividades(id),
-        archivo TEXT NOT NULL
-    )""")
-    cur.execute("""CREATE TABLE IF NOT EXISTS eventos (
-        id SERIAL PRIMARY KEY, usuario_id INTEGER REFERENCES usuarios(id),
-        titulo TEXT NOT NULL, descripcion TEXT DEFAULT '',
-        fecha_inicio TEXT NOT NULL, fecha_fin TEXT DEFAULT NULL,
-        hora_inicio TEXT DEFAULT '', hora_fin TEXT DEFAULT '',
-        tipo TEXT DEFAULT 'visita', color TEXT DEFAULT '#714B67',
-        cliente TEXT DEFAULT '', ubicacion TEXT DEFAULT '',
-        todo_el_dia INTEGER DEFAULT 0, creado_en TEXT DEFAULT ''
-    )""")
-    cur.execute("""CREATE TABLE IF NOT EXISTS config (
-        id INTEGER PRIMARY KEY, empresa TEXT DEFAULT 'Altasolucion',
-        logo_url TEXT DEFAULT '', color_primario TEXT DEFAULT '#714B67',
-        descripcion TEXT DEFAULT ''
-    )""")
-    cur.execute("""CREATE TABLE IF NOT EXISTS solicitudes_reset (
-        id SERIAL PRIMARY KEY, usuario_id INTEGER REFERENCES usuarios(id),
-        email TEXT, fecha TEXT, atendido INTEGER DEFAULT 0
-    )""")
-    cur.execute("""CREATE TABLE IF NOT EXISTS clientes (
-        id SERIAL PRIMARY KEY,
-        nombre TEXT NOT NULL, empresa TEXT DEFAULT '', cargo TEXT DEFAULT '',
-        email TEXT DEFAULT '', telefono TEXT DEFAULT '', telefono2 TEXT DEFAULT '',
-        direccion TEXT DEFAULT '', ciudad TEXT DEFAULT '', estado_dir TEXT DEFAULT '',
-        pais TEXT DEFAULT 'Mexico', codigo_postal TEXT DEFAULT '',
-        rfc TEXT DEFAULT '', razon_social TEXT DEFAULT '', uso_cfdi TEXT DEFAULT '',
-        clasificacion TEXT DEFAULT 'prospecto', estado_semaforo TEXT DEFAULT 'verde',
-        vendedor_id INTEGER REFERENCES usuarios(id),
-        notas TEXT DEFAULT '', sitio_web TEXT DEFAULT '', industria TEXT DEFAULT '',
-        empleados TEXT DEFAULT '', fuente TEXT DEFAULT '',
-        activo INTEGER DEFAULT 1, creado_por INTEGER REFERENCES usuarios(id),
-        fecha_creacion TEXT DEFAULT '', fecha_actualizacion TEXT DEFAULT ''
-    )""")
-    now = datetime.now().strftime("%Y-%m-%d %H:%M")
-    cur.execute("""INSERT INTO usuarios (usuario,nombre,apellido,email,password,rol,activo,fecha_creacion)
-        VALUES (%s,%s,%s,%s,%s,%s,%s,%s) ON CONFLICT (usuario) DO NOTHING""",
-        ("admin","Admin","Sistema","admin@demo.com",generate_password_hash("admin123"),"admin",1,now))
-    cur.execute("""INSERT INTO usuarios (usuario,nombre,apellido,email,password,rol,activo,fecha_creacion)
-        VALUES (%s,%s,%s,%s,%s,%s,%s,%s) ON CONFLICT (usuario) DO NOTHING""",
-        ("demo","Demo","Vendedor","demo@demo.com",generate_password_hash("1234"),"vendedor",1,now))
-    cur.execute("""CREATE TABLE IF NOT EXISTS cotizaciones (
-        id SERIAL PRIMARY KEY, folio TEXT UNIQUE,
-        cliente_id INTEGER REFERENCES clientes(id),
-        cliente_nombre TEXT DEFAULT '', estatus TEXT DEFAULT 'borrador',
-        validez_dias INTEGER DEFAULT 15, moneda TEXT DEFAULT 'MXN',
-        descuento_global NUMERIC(5,2) DEFAULT 0,
-        subtotal NUMERIC(18,2) DEFAULT 0,
-        descuento_monto NUMERIC(18,2) DEFAULT 0,
-        impuesto NUMERIC(18,2) DEFAULT 0,
-        total NUMERIC(18,2) DEFAULT 0,
-        notas TEXT DEFAULT '', condiciones TEXT DEFAULT '',
-        creado_por INTEGER REFERENCES usuarios(id),
-        fecha_creacion TEXT DEFAULT '', fecha_actualizacion TEXT DEFAULT '',
-        fecha_vencimiento TEXT DEFAULT ''
-    )""")
-    cur.execute("""CREATE TABLE IF NOT EXISTS cotizaciones_items (
-        id SERIAL PRIMARY KEY,
-        cotizacion_id INTEGER REFERENCES cotizaciones(id) ON DELETE CASCADE,
-        item_code TEXT, item_nombre TEXT, uom TEXT DEFAULT '',
-        cantidad NUMERIC(18,3) DEFAULT 1,
-        precio_unitario NUMERIC(18,2) DEFAULT 0,
-        descuento NUMERIC(5,2) DEFAULT 0,
-        subtotal NUMERIC(18,2) DEFAULT 0
-    )""")
-    cur.execute("""CREATE TABLE IF NOT EXISTS llamadas_servicio (
-        id SERIAL PRIMARY KEY, folio TEXT UNIQUE,
-        cliente_id INTEGER REFERENCES clientes(id),
-        cliente_nombre TEXT DEFAULT '',
-        item_code TEXT, item_nombre TEXT DEFAULT '',
-        serial_number TEXT DEFAULT '', problema TEXT NOT NULL,
-        prioridad TEXT DEFAULT 'media', estatus TEXT DEFAULT 'abierta',
-        tecnico_id INTEGER REFERENCES usuarios(id),
-        fecha_atencion TEXT DEFAULT '', fecha_cierre TEXT DEFAULT '',
-        creado_por INTEGER REFERENCES usuarios(id),
-        fecha_creacion TEXT DEFAULT '', fecha_actualizacion TEXT DEFAULT ''
-    )""")
-    cur.execute("""CREATE TABLE IF NOT EXISTS llamadas_seguimiento (
-        id SERIAL PRIMARY KEY,
-        llamada_id INTEGER REFERENCES llamadas_servicio(id) ON DELETE CASCADE,
-        usuario_id INTEGER REFERENCES usuarios(id),
-        accion TEXT NOT NULL, nota TEXT DEFAULT '',
-        estatus_anterior TEXT DEFAULT '', estatus_nuevo TEXT DEFAULT '',
-        fecha TEXT DEFAULT ''
-    )""")
-    conn.commit(); cur.close(); conn.close()
-
-init_db()
+    try:
+        cur.execute("SELECT pg_advisory_lock(%s)", (MIGRATIONS_LOCK,))
+        cur.execute("""CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY, archivo TEXT NOT NULL,
+            aplicada TEXT DEFAULT '')""")
+        conn.commit()
+        actual = version_esquema(cur)
+        pendientes = [(v, f) for v, f in listar_migraciones() if v > actual]
+        for v, f in pendientes:
+            echo(f"Aplicando {f} ...")
+            try:
+                aplicar_migracion(cur, f)
+                cur.execute("INSERT INTO schema_version (version,archivo,aplicada) VALUES (%s,%s,%s)",
+                            (v, f, datetime.now().strftime("%Y-%m-%d %H:%M")))
+                conn.commit()
+            except Exception:
+                conn.rollback(); raise
+        echo(f"Esquema en versión {pendientes[-1][0] if pendientes else actual}")
+    finally:
+        cur.execute("SELECT pg_advisory_unlock(%s)", (MIGRATIONS_LOCK,))
+        conn.commit(); cur.close(); conn.close()
 
-# ── SAP SERVICE LAYER HELPERS ─────────────────────────────
-import requests as _req
-import urllib3
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+def verificar_esquema():
+    """Chequeo de arranque: una sola consulta, sin DDL ni locks de catálogo.
+    SCHEMA_CHECK=0 lo omite por completo."""
+    if os.environ.get("SCHEMA_CHECK", "1") == "0":
+        return
+    esperada = listar_migraciones()[-1][0]
+    try:
+        row = query("SELECT COALESCE(MAX(version),0) AS v FROM schema_version", fetchone=True)
+        actual = row["v"]
+    except Exception:
+        actual = 0
+    if actual < esperada:
+        app.logger.warning("Esquema en versión %s, se esperaba %s: ejecuta `flask --app app upgrade`",
+                           actual, esperada)
+
+@app.cli.command("upgrade")
+def cli_upgrade():
+    """Aplica las migraciones pendientes de migrations/."""
+    upgrade_db(echo=click.echo)
+
+verificar_esquema()
+cerrar_pool()   # importar la app no deja conexiones abiertas (master de gunicorn --preload)
 
+# ── SAP SERVICE LAYER HELPERS ─────────────────────────────
 def sap_login():
     """Abre sesión en SAP Service Layer. Retorna session o None."""
     if not SAP_BASE_URL or not SAP_USER:
         return None
     try:
-        s = _req.Session()
+        s = _http().Session()
         s.verify = SAP_VERIFY_SSL
         r = s.post(f"{SAP_BASE_URL}/Login", json={
             "CompanyDB": SAP_COMPANY_DB,
@@ -218,14 +331,51 @@ def sap_logout(s):
         try: s.post(f"{SAP_BASE_URL}/Logout", timeout=5)
         except: pass
 
+# ── CardCode de socios de negocio ──
+# clientes.sap_card_code (migración 0011) manda; si está vacío se busca el socio
+# con el mismo nombre en sap_business_partners. Los resultados (también los
+# vacíos) se guardan en memoria CARDCODE_TTL s; editar/importar clientes vacía
+# el cache del proceso y el TTL cubre la sincronización externa de socios.
+CARDCODE_RE  = r"SAP CardCode:\s*(\S+)"
+CARDCODE_TTL = int(os.environ.get("CARDCODE_TTL", "300"))
+_cardcodes      = {}
+_cardcodes_lock = threading.Lock()
+
+def card_code_de_notas(notas):
+    """CardCode escrito en notas como "SAP CardCode: C00123" (formato anterior)."""
+    import re
+    m = re.search(CARDCODE_RE, notas or "")
+    return m.group(1) if m else ""
+
+def invalidar_card_codes():
+    with _cardcodes_lock: _cardcodes.clear()
+
+def resolver_card_code(cliente_id=None, nombre=""):
+    """CardCode SAP de un cliente/proveedor por id o, en su defecto, por nombre."""
+    import time
+    clave = ("id", int(cliente_id)) if cliente_id else ("nombre", (nombre or "").strip().lower())
+    if not clave[1]: return ""
+    ahora = time.monotonic()
+    with _cardcodes_lock:
+        hit = _cardcodes.get(clave)
+    if hit and hit[1] > ahora: return hit[0]
+    code = ""
+    if cliente_id:
+        row = query("SELECT sap_card_code,nombre FROM clientes WHERE id=%s", (cliente_id,), fetchone=True)
+        if row: code, nombre = row["sap_card_code"] or "", nombre or row["nombre"]
+    if not code and nombre:
+        row = query("""SELECT card_code FROM sap_business_partners
+                       WHERE lower(card_name)=lower(%s) ORDER BY card_code LIMIT 1""",
+                    (nombre.strip(),), fetchone=True)
+        code = row["card_code"] if row else ""
+    with _cardcodes_lock:
+        if len(_cardcodes) > 10000: _cardcodes.clear()
+        _cardcodes[clave] = (code, ahora + CARDCODE_TTL)
+    return code
+
 def sap_get_bp_code(cliente_nombre):
     """Busca el CardCode del cliente en sap_business_partners por nombre."""
-    if not cliente_nombre:
-        return None
-    row = query("""SELECT card_code FROM sap_business_partners
-                   WHERE card_name ILIKE %s LIMIT 1""",
-                (cliente_nombre,), fetchone=True)
-    return row["card_code"] if row else None
+    return resolver_card_code(nombre=cliente_nombre) or None
 
 def sap_get_item_info(item_code):
     """Obtiene info del artículo para el payload SAP."""
@@ -245,7 +395,7 @@ def crear_service_call_sap(llamada: dict) -> tuple[bool, str, int | None]:
 
     try:
         # Buscar CardCode del cliente
-        card_code = sap_get_bp_code(llamada.get("cliente_nombre",""))
+        card_code = resolver_card_code(llamada.get("cliente_id"), llamada.get("cliente_nombre","")) or None
 
         # SAP B1 HANA: Priority usa letras L/M/H, Status usa enteros
         prio_map   = {"baja":"L","media":"M","alta":"H","urgente":"H"}
@@ -314,27 +464,579 @@ def actualizar_service_call_sap(doc_entry: int, nuevo_estatus: str, nota: str =
 # ── STORAGE ───────────────────────────────────────────────
 def allowed_file(f): return "." in f and f.rsplit(".",1)[1].lower() in ALLOWED_EXT
 
+def _firmador(salt):
+    from itsdangerous import URLSafeTimedSerializer
+    return URLSafeTimedSerializer(app.secret_key, salt=salt)
+
+class SupabaseStorage:
+    """Backend de storage sobre Supabase (buckets públicos)."""
+
+    def _b(self, bucket): return get_supabase().storage.from_(bucket)
+
+    def subir(self, bucket, ruta, fuente, content_type):
+        data = fuente if isinstance(fuente, bytes) else fuente.read()
+        self._b(bucket).upload(ruta, data, {"content-type": content_type})
+        return self.url_publica(bucket, ruta)
+
+    def url_publica(self, bucket, ruta): return self._b(bucket).get_public_url(ruta)
+
+    def url_subida(self, bucket, ruta):
+        """URL firmada de corta vida para que el navegador suba `ruta` con PUT."""
+        return self._b(bucket).create_signed_upload_url(ruta)["signed_url"]
+
+    def existe(self, bucket, ruta):
+        carpeta, _, nombre = ruta.rpartition("/")
+        objs = self._b(bucket).list(carpeta, {"search": nombre, "limit": 10})
+        return any(o.get("name") == nombre for o in objs or [])
+
+    def descargar(self, bucket, ruta): return self._b(bucket).download(ruta)
+
+    def borrar(self, bucket, rutas): self._b(bucket).remove(rutas)
+
+    def listar(self, bucket, carpeta="", pagina=1000):
+        """Genera (ruta, fecha UTC) de todos los objetos, paginando y bajando a subcarpetas."""
+        offset = 0
+        while True:
+            objs = self._b(bucket).list(carpeta, {"limit": pagina, "offset": offset,
+                                                  "sortBy": {"column": "name", "order": "asc"}}) or []
+            for o in objs:
+                ruta = f"{carpeta}/{o['name']}" if carpeta else o["name"]
+                if o.get("id") is None:   # carpeta
+                    yield from self.listar(bucket, ruta, pagina)
+                else:
+                    fecha = o.get("created_at") or o.get("updated_at") or ""
+                    yield ruta, datetime.fromisoformat(fecha.replace("Z", "+00:00")).replace(tzinfo=None) \
+                                if fecha else datetime.utcnow()
+            if len(objs) < pagina: break
+            offset += pagina
+
+class LocalStorage:
+    """Backend en disco (on-prem, desarrollo y pruebas de carga).
+
+    El contenido se guarda una sola vez por hash en `<raíz>/.objetos/` y la
+    ruta lógica del bucket es un hard link a ese objeto; así las rutas que usa
+    la app no cambian y el mismo archivo subido dos veces no ocupa el doble.
+    Las escrituras son en streaming (nunca se lee el archivo completo)."""
+    BLOQUE = 64 * 1024
+
+    def __init__(self, raiz):
+        self.raiz = os.path.realpath(raiz)
+        self.objetos = os.path.join(self.raiz, ".objetos")
+
+    def ruta(self, bucket, ruta):
+        base = os.path.join(self.raiz, bucket)
+        path = os.path.realpath(os.path.join(base, ruta))
+        if not bucket or bucket.startswith(".") or not path.startswith(base + os.sep):
+            raise ValueError("Ruta inválida")
+        return path
+
+    def subir(self, bucket, ruta, fuente, content_type=None):
+        import hashlib
+        destino = self.ruta(bucket, ruta)
+        if isinstance(fuente, bytes): fuente = io.BytesIO(fuente)
+        os.makedirs(self.objetos, exist_ok=True)
+        tmp = os.path.join(self.objetos, f"{uuid.uuid4().hex}.tmp")
+        h = hashlib.sha256()
+        try:
+            with open(tmp, "wb") as fh:
+                for bloque in iter(lambda: fuente.read(self.BLOQUE), b""):
+                    h.update(bloque); fh.write(bloque)
+            digest = h.hexdigest()
+            objeto = os.path.join(self.objetos, digest[:2], digest)
+            os.makedirs(os.path.dirname(objeto), exist_ok=True)
+            if os.path.exists(objeto): os.remove(tmp)
+            else: os.replace(tmp, objeto)
+        except BaseException:
+            if os.path.exists(tmp): os.remove(tmp)
+            raise
+        os.makedirs(os.path.dirname(destino), exist_ok=True)
+        nuevo = f"{destino}.{uuid.uuid4().hex}.lnk"
+        os.link(objeto, nuevo); os.replace(nuevo, destino)
+        return self.url_publica(bucket, ruta)
+
+    def url_publica(self, bucket, ruta): return f"/storage/local/{bucket}/{ruta}"
+
+    def url_subida(self, bucket, ruta):
+        token = _firmador("subida-local").dumps([bucket, ruta])
+        return f"/storage/local/{bucket}/{ruta}?token={token}"
+
+    def existe(self, bucket, ruta): return os.path.isfile(self.ruta(bucket, ruta))
+
+    def descargar(self, bucket, ruta):
+        with open(self.ruta(bucket, ruta), "rb") as fh: return fh.read()
+
+    def borrar(self, bucket, rutas):
+        """Quita las rutas y el objeto de contenido si ya nadie más lo enlaza."""
+        import hashlib
+        for r in rutas:
+            path = self.ruta(bucket, r)
+            try: st = os.stat(path)
+            except FileNotFoundError: continue
+            objeto = None
+            if st.st_nlink <= 2:   # sólo quedaría el objeto en .objetos/
+                h = hashlib.sha256()
+                with open(path, "rb") as fh:
+                    for bloque in iter(lambda: fh.read(self.BLOQUE), b""): h.update(bloque)
+                objeto = os.path.join(self.objetos, h.hexdigest()[:2], h.hexdigest())
+            os.remove(path)
+            if objeto and os.path.exists(objeto) and os.stat(objeto).st_nlink == 1:
+                os.remove(objeto)
+
+    def listar(self, bucket, carpeta="", pagina=None):
+        base = os.path.join(self.raiz, bucket)
+        for raiz, _, nombres in os.walk(os.path.join(base, carpeta)):
+            for n in nombres:
+                path = os.path.join(raiz, n)
+                try: mtime = os.stat(path).st_mtime
+                except FileNotFoundError: continue
+                yield os.path.relpath(path, base).replace(os.sep, "/"), datetime.utcfromtimestamp(mtime)
+
+    def servir(self, bucket, ruta):
+        """Respuesta para GET: delega el envío al proxy si está configurado
+        (X-Accel-Redirect de nginx / X-Sendfile de Apache), si no send_file."""
+        from flask import send_file, Response
+        import mimetypes
+        path = self.ruta(bucket, ruta)
+        if not os.path.isfile(path): abort(404)
+        mime = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        if LOCAL_STORAGE_ACCEL:
+            return Response(headers={"X-Accel-Redirect": f"{LOCAL_STORAGE_ACCEL.rstrip('/')}/{bucket}/{ruta}",
+                                     "Content-Type": mime})
+        if LOCAL_STORAGE_SENDFILE:
+            return Response(headers={"X-Sendfile": path, "Content-Type": mime})
+        return send_file(path, mimetype=mime, conditional=True)
+
+STORAGE_BACKENDS = {"supabase": lambda: SupabaseStorage(),
+                    "local":    lambda: LocalStorage(LOCAL_STORAGE_DIR)}
+
+def get_storage():
+    global _storage
+    if _storage is None:
+        if STORAGE_BACKEND not in STORAGE_BACKENDS:
+            raise RuntimeError(f"STORAGE_BACKEND desconocido: {STORAGE_BACKEND}")
+        _storage = STORAGE_BACKENDS[STORAGE_BACKEND]()
+    return _storage
+
 def upload_foto(file_storage, actividad_id):
     filename = secure_filename(file_storage.filename)
     if not allowed_file(filename): raise ValueError("Formato no permitido")
     ext  = filename.rsplit(".",1)[1].lower()
     name = f"actividad_{actividad_id}/{uuid.uuid4().hex}.{ext}"
-    data = file_storage.read()
-    supabase.storage.from_(BUCKET_FOTOS).upload(name, data, {"content-type": f"image/{ext}"})
-    return supabase.storage.from_(BUCKET_FOTOS).get_public_url(name)
+    return get_storage().subir(BUCKET_FOTOS, name, file_storage.stream, f"image/{ext}")
 
 def upload_firma(dataurl, actividad_id):
     if not dataurl or not dataurl.startswith("data:image"): raise ValueError("Firma invalida")
     _, b64 = dataurl.split(",", 1)
     name = f"actividad_{actividad_id}/{uuid.uuid4().hex}.png"
-    supabase.storage.from_(BUCKET_FIRMAS).upload(name, base64.b64decode(b64), {"content-type":"image/png"})
-    return supabase.storage.from_(BUCKET_FIRMAS).get_public_url(name)
+    return get_storage().subir(BUCKET_FIRMAS, name, base64.b64decode(b64), "image/png")
 
 def upload_avatar(file_storage, uid):
     ext  = secure_filename(file_storage.filename).rsplit(".",1)[1].lower()
     name = f"perfil_{uid}_{uuid.uuid4().hex}.{ext}"
-    supabase.storage.from_(BUCKET_AVA).upload(name, file_storage.read(), {"content-type":f"image/{ext}"})
-    return supabase.storage.from_(BUCKET_AVA).get_public_url(name)
+    return get_storage().subir(BUCKET_AVA, name, file_storage.stream, f"image/{ext}")
+
+def ruta_storage(bucket, url):
+    """Ruta del objeto dentro del bucket a partir de su URL pública."""
+    for marca in (f"/object/public/{bucket}/", f"/storage/local/{bucket}/"):
+        if url and marca in url:
+            return url.split(marca, 1)[1].split("?", 1)[0]
+    return None
+
+def borrar_subidas(subidas):
+    """Compensa subidas huérfanas: subidas = [(bucket, url)]. No lanza excepciones."""
+    por_bucket = {}
+    for bucket, url in subidas:
+        ruta = ruta_storage(bucket, url)
+        if ruta: por_bucket.setdefault(bucket, []).append(ruta)
+    for bucket, rutas in por_bucket.items():
+        try: get_storage().borrar(bucket, rutas)
+        except Exception as e: app.logger.warning("No se pudieron borrar %s de %s: %s", rutas, bucket, e)
+
+def _get_upload_pool():
+    """Pool acotado de hilos para subir archivos en paralelo (UPLOAD_WORKERS)."""
+    global _upload_pool
+    if _upload_pool is None:
+        from concurrent.futures import ThreadPoolExecutor
+        _upload_pool = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS, thread_name_prefix="upload")
+    return _upload_pool
+
+# ── PROCESAMIENTO DE FOTOS ────────────────────────────────
+def procesar_imagen(data):
+    """Normaliza una foto: aplica la orientación EXIF, descarta metadatos,
+    limita el lado mayor a IMG_MAX_LADO y recomprime en IMG_FORMATO.
+    Retorna (bytes, ext, {ancho: bytes_miniatura}, (ancho, alto))."""
+    from PIL import Image, ImageOps
+    img = ImageOps.exif_transpose(Image.open(io.BytesIO(data)))
+    formato = "JPEG" if IMG_FORMATO == "jpeg" else "WEBP"
+    img = img.convert("RGBA" if formato == "WEBP" and "A" in img.getbands() else "RGB")
+    img.thumbnail((IMG_MAX_LADO, IMG_MAX_LADO))
+
+    def codificar(im):
+        buf = io.BytesIO()
+        if formato == "JPEG": im.save(buf, "JPEG", quality=IMG_CALIDAD, optimize=True, progressive=True)
+        else:                 im.save(buf, "WEBP", quality=IMG_CALIDAD, method=4)
+        return buf.getvalue()
+
+    miniaturas = {}
+    for ancho in sorted(IMG_MINIATURAS):
+        if ancho >= max(img.size): break
+        mini = img.copy(); mini.thumbnail((ancho, ancho))
+        miniaturas[ancho] = codificar(mini)
+    return codificar(img), ("jpg" if formato == "JPEG" else "webp"), miniaturas, img.size
+
+def procesar_foto(foto_id):
+    """Tarea en segundo plano: sustituye la foto original por su versión
+    normalizada (<nombre>_max.<ext>) y sube las miniaturas (<nombre>_w<ancho>.<ext>)."""
+    try:
+        f = query("SELECT id,archivo FROM fotos WHERE id=%s",(foto_id,),fetchone=True)
+        ruta = ruta_storage(BUCKET_FOTOS, f["archivo"]) if f else None
+        if not ruta or "_max." in ruta: return
+        principal, ext, miniaturas, (ancho, alto) = procesar_imagen(get_storage().descargar(BUCKET_FOTOS, ruta))
+        base = ruta.rsplit(".", 1)[0]
+        ct   = "image/jpeg" if ext == "jpg" else f"image/{ext}"
+        for lado, data in miniaturas.items():
+            get_storage().subir(BUCKET_FOTOS, f"{base}_w{lado}.{ext}", data, ct)
+        url = get_storage().subir(BUCKET_FOTOS, f"{base}_max.{ext}", principal, ct)
+        query("UPDATE fotos SET archivo=%s,miniaturas=%s,ancho=%s,alto=%s WHERE id=%s",
+              (url, ",".join(str(a) for a in miniaturas), ancho, alto, foto_id), commit=True)
+        get_storage().borrar(BUCKET_FOTOS, [ruta])
+    except ImportError:
+        app.logger.warning("Pillow no está instalado: las fotos se guardan sin procesar")
+    except Exception as e:
+        app.logger.warning("No se pudo procesar la foto %s: %s", foto_id, e)
+
+def encolar_fotos(foto_ids):
+    pool = _get_upload_pool()
+    for fid in foto_ids: pool.submit(procesar_foto, fid)
+
+@app.template_filter("miniatura")
+def miniatura_foto(foto, ancho=640):
+    """URL de la miniatura más cercana (>=) a `ancho`; la original si no hay."""
+    anchos = sorted(int(a) for a in (foto.get("miniaturas") or "").split(",") if a.isdigit())
+    elegido = next((a for a in anchos if a >= ancho), None)
+    if not elegido: return media_url(foto["archivo"])
+    base, ext = foto["archivo"].rsplit("_max.", 1)
+    return media_url(f"{base}_w{elegido}.{ext}")
+
+@app.template_filter("srcset")
+def srcset_foto(foto):
+    """srcset con el ancho real de cada versión. Las miniaturas limitan el lado
+    mayor, así que en fotos verticales su ancho es proporcionalmente menor."""
+    anchos = sorted(int(a) for a in (foto.get("miniaturas") or "").split(",") if a.isdigit())
+    if not anchos: return ""
+    base, ext = foto["archivo"].rsplit("_max.", 1)
+    ancho, alto = foto.get("ancho"), foto.get("alto")
+    def real(lado):
+        return lado if not (ancho and alto) or ancho >= alto else max(1, round(ancho * lado / alto))
+    partes = [f"{media_url(f'{base}_w{a}.{ext}')} {real(a)}w" for a in anchos]
+    # Sin medidas (fotos anteriores a la migración 0017) la principal se omite
+    # para no anunciar un ancho que quizá no tiene: `flask procesar-fotos --medidas`
+    if ancho: partes.append(f"{media_url(foto['archivo'])} {ancho}w")
+    return ", ".join(partes)
+
+def medir_foto(foto_id):
+    """Guarda ancho y alto de una foto ya procesada (sólo lee el encabezado)."""
+    from PIL import Image
+    f = query("SELECT archivo FROM fotos WHERE id=%s",(foto_id,),fetchone=True)
+    ruta = ruta_storage(BUCKET_FOTOS, f["archivo"]) if f else None
+    if not ruta: return
+    ancho, alto = Image.open(io.BytesIO(get_storage().descargar(BUCKET_FOTOS, ruta))).size
+    query("UPDATE fotos SET ancho=%s,alto=%s WHERE id=%s",(ancho,alto,foto_id),commit=True)
+
+@app.cli.command("procesar-fotos")
+@click.option("--medidas", is_flag=True, help="Además, medir las fotos ya procesadas que no tienen ancho/alto")
+def cli_procesar_fotos(medidas):
+    """Procesa (redimensiona y genera miniaturas) las fotos aún sin procesar."""
+    pendientes = query("SELECT id FROM fotos WHERE archivo NOT LIKE %s ORDER BY id",
+                       ("%\\_max.%",), fetchall=True) or []
+    for f in pendientes: procesar_foto(f["id"])
+    click.echo(f"{len(pendientes)} fotos procesadas")
+    if medidas:
+        sin_medidas = query("SELECT id FROM fotos WHERE archivo LIKE %s AND ancho IS NULL ORDER BY id",
+                            ("%\\_max.%",), fetchall=True) or []
+        for f in sin_medidas:
+            try: medir_foto(f["id"])
+            except Exception as e: click.echo(f"Foto {f['id']}: {e}")
+        click.echo(f"{len(sin_medidas)} fotos medidas")
+
+# ── PROXY DE IMÁGENES (/media) ────────────────────────────
+_cache_lock    = threading.Lock()
+_cache_totales = {}   # bytes por directorio de caché según este proceso (se recalcula al podar)
+
+def media_url(url):
+    """URL del proxy /media para una URL pública del storage (o la misma URL)."""
+    if not MEDIA_PROXY or not url or STORAGE_BACKEND == "local": return url
+    for bucket in (BUCKET_FOTOS, BUCKET_FIRMAS, BUCKET_AVA):
+        ruta = ruta_storage(bucket, url)
+        if ruta: return f"/media/{bucket}/{ruta}"
+    return url
+
+app.add_template_filter(media_url, "media")
+
+def podar_cache(directorio, maximo, nuevo):
+    """LRU: al exceder `maximo` bytes borra los archivos usados hace más tiempo
+    (mtime, que se actualiza en cada acierto) hasta quedar en el 90 %."""
+    with _cache_lock:
+        total = _cache_totales.get(directorio)
+        if total is not None and total + nuevo <= maximo:
+            _cache_totales[directorio] = total + nuevo; return
+        archivos = []
+        for raiz, _, nombres in os.walk(directorio):
+            for n in nombres:
+                p = os.path.join(raiz, n)
+                try: st = os.stat(p)
+                except FileNotFoundError: continue
+                archivos.append((st.st_mtime, st.st_size, p))
+        total = sum(a[1] for a in archivos)
+        if total > maximo:
+            for _, size, p in sorted(archivos):
+                if total <= maximo * 0.9: break
+                try: os.remove(p); total -= size
+                except FileNotFoundError: pass
+        _cache_totales[directorio] = total
+
+@app.route("/media/<bucket>/<path:ruta>")
+def media(bucket, ruta):
+    """Imagen del storage servida desde la caché local (sendfile + ETag);
+    sólo va al storage en un fallo de caché."""
+    if not logged_in(): abort(403)
+    if bucket not in (BUCKET_FOTOS, BUCKET_FIRMAS, BUCKET_AVA) or ".." in ruta: abort(404)
+    from flask import send_file
+    import hashlib, mimetypes
+    clave = hashlib.sha256(f"{bucket}/{ruta}".encode()).hexdigest()
+    path  = os.path.join(MEDIA_CACHE_DIR, clave[:2], clave)
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        try: data = get_storage().descargar(bucket, ruta)
+        except Exception as e:
+            app.logger.warning("media: no se pudo obtener %s/%s: %s", bucket, ruta, e)
+            abort(404 if "not found" in str(e).lower() else 502)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp, "wb") as fh: fh.write(data)
+        os.replace(tmp, path)
+        podar_cache(MEDIA_CACHE_DIR, MEDIA_CACHE_MAX, len(data))
+    resp = send_file(path, mimetype=mimetypes.guess_type(ruta)[0] or "application/octet-stream",
+                     conditional=True, etag=f"{clave[:32]}-{os.path.getsize(path)}", max_age=MEDIA_MAX_AGE)
+    resp.cache_control.public  = False
+    resp.cache_control.private = True
+    resp.cache_control.immutable = True
+    return resp
+
+# ── PDF DE DOCUMENTOS (cotizaciones / remisiones) ─────────
+# Cada PDF se guarda en PDF_CACHE_DIR con clave = documento + su versión
+# (fecha_actualizacion y el xmin del renglón, que cambia con cada UPDATE) +
+# config.version + la fecha de la plantilla. La clave es también el ETag, así
+# que sólo se vuelve a generar cuando cambia el documento o la marca. Sin
+# WeasyPrint se sirve (y cachea) el HTML imprimible de siempre.
+_PDF_DOCS = {
+    "cotizacion": ("cotizacion_pdf.html",
+                   "SELECT folio,fecha_actualizacion AS fecha,xmin::text AS xmin FROM cotizaciones WHERE id=%s"),
+    "remision":   ("remision_pdf.html",
+                   "SELECT folio,fecha_entrega AS fecha,xmin::text AS xmin FROM remisiones WHERE id=%s"),
+}
+
+_weasy = None
+
+def _weasyprint():
+    """El módulo weasyprint, o None si no está instalado (o le faltan Pango/Cairo)."""
+    global _weasy
+    if _weasy is None:
+        try:
+            import weasyprint
+            _weasy = weasyprint
+        except (ImportError, OSError) as e:
+            app.logger.info("PDF: sin WeasyPrint (%s), se sirve HTML imprimible", e)
+            _weasy = False
+    return _weasy or None
+
+def clave_pdf(tipo, doc_id):
+    """{folio, etag, ext, ruta} del documento en su versión actual; None si no existe."""
+    import hashlib
+    plantilla, sql = _PDF_DOCS[tipo]
+    doc = query(f"SELECT d.*,(SELECT version FROM config WHERE id=1) AS config_version FROM ({sql}) d",
+                (doc_id,), fetchone=True)
+    if not doc: return None
+    ext   = "pdf" if _weasyprint() else "html"
+    mtime = os.path.getmtime(os.path.join(app.root_path, app.template_folder, plantilla))
+    etag  = hashlib.sha256(f"{tipo}:{doc_id}:{doc['fecha']}:{doc['xmin']}:{doc['config_version']}:"
+                           f"{mtime}:{ext}".encode()).hexdigest()[:40]
+    return {"tipo": tipo, "id": doc_id, "folio": doc["folio"], "etag": etag, "ext": ext,
+            "ruta": os.path.join(PDF_CACHE_DIR, etag[:2], f"{etag}.{ext}")}
+
+def _contexto_pdf(tipo, doc_id):
+    config = query("SELECT * FROM config WHERE id=1",fetchone=True) or {}
+    if tipo == "cotizacion":
+        cot = query("""SELECT c.*,u.nombre AS creador_nombre
+                       FROM cotizaciones c LEFT JOIN usuarios u ON u.id=c.creado_por
+                       WHERE c.id=%s""",(doc_id,),fetchone=True)
+        items = query("SELECT * FROM cotizaciones_items WHERE cotizacion_id=%s ORDER BY id",
+                      (doc_id,),fetchall=True) or []
+        return dict(cot=cot, items=items, empresa=EMPRESA, config=config, IVA=IVA)
+    rem = query("""SELECT r.*,u.nombre AS creador,alm.nombre AS almacen_nombre
+                   FROM remisiones r LEFT JOIN usuarios u ON u.id=r.creado_por
+                   LEFT JOIN almacenes alm ON alm.id=r.almacen_id WHERE r.id=%s""",(doc_id,),fetchone=True)
+    items = query("SELECT * FROM remisiones_items WHERE remision_id=%s ORDER BY id",(doc_id,),fetchall=True) or []
+    return dict(rem=rem, items=items, empresa=EMPRESA, config=config)
+
+def generar_pdf(clave):
+    """Ruta del archivo en caché para `clave` (de clave_pdf); lo genera si falta."""
+    ruta = clave["ruta"]
+    try:
+        os.utime(ruta); return ruta
+    except FileNotFoundError:
+        pass
+    html = render_template(_PDF_DOCS[clave["tipo"]][0], **_contexto_pdf(clave["tipo"], clave["id"]))
+    wp   = _weasyprint() if clave["ext"] == "pdf" else None
+    data = wp.HTML(string=html).write_pdf() if wp else html.encode()
+    os.makedirs(os.path.dirname(ruta), exist_ok=True)
+    tmp = f"{ruta}.{uuid.uuid4().hex}.tmp"
+    with open(tmp, "wb") as fh: fh.write(data)
+    os.replace(tmp, ruta)
+    podar_cache(PDF_CACHE_DIR, PDF_CACHE_MAX, len(data))
+    return ruta
+
+def respuesta_pdf(tipo, doc_id):
+    """PDF del documento desde la caché, con ETag: si el navegador ya tiene la
+    versión actual responde 304 sin generar nada."""
+    from flask import send_file
+    clave = clave_pdf(tipo, doc_id)
+    if not clave: abort(404)
+    if request.if_none_match.contains(clave["etag"]):
+        resp = Response(status=304)
+        resp.set_etag(clave["etag"])
+    else:
+        resp = send_file(generar_pdf(clave), conditional=True, etag=clave["etag"],
+                         mimetype="application/pdf" if clave["ext"] == "pdf" else "text/html",
+                         download_name=f"{clave['folio']}.{clave['ext']}")
+    resp.cache_control.private  = True
+    resp.cache_control.no_cache = True   # siempre revalida: el documento puede cambiar
+    return resp
+
+def _get_pdf_pool():
+    """Pool acotado de hilos para generar PDF de lotes (PDF_WORKERS)."""
+    global _pdf_pool
+    if _pdf_pool is None:
+        from concurrent.futures import ThreadPoolExecutor
+        _pdf_pool = ThreadPoolExecutor(max_workers=PDF_WORKERS, thread_name_prefix="pdf")
+    return _pdf_pool
+
+def _generar_pdf_hilo(tipo, doc_id):
+    # render_template y los context processors necesitan un request activo
+    with app.test_request_context():
+        clave = clave_pdf(tipo, doc_id)
+        return clave, generar_pdf(clave) if clave else None
+
+def zip_pdf_stream(tipo, ids):
+    """ZIP con el PDF de cada documento de `ids`, escrito en streaming: se
+    generan en paralelo (a lo más 2×PDF_WORKERS en vuelo, reutilizando la caché
+    de PDF) y cada archivo se agrega y entrega en cuanto termina."""
+    import zipfile
+    from concurrent.futures import wait, FIRST_COMPLETED
+    pool, pendientes, errores = _get_pdf_pool(), set(), []
+    ids = iter(ids)
+    out = _SalidaZip()
+    try:
+        with zipfile.ZipFile(out, "w") as zf:
+            while True:
+                for doc_id in ids:
+                    f = pool.submit(_generar_pdf_hilo, tipo, doc_id); f.doc_id = doc_id
+                    pendientes.add(f)
+                    if len(pendientes) >= 2 * PDF_WORKERS: break
+                if not pendientes: break
+                listos, pendientes = wait(pendientes, return_when=FIRST_COMPLETED)
+                for f in listos:
+                    try:
+                        clave, ruta = f.result()
+                    except Exception as e:
+                        app.logger.warning("PDF %s %s: %s", tipo, f.doc_id, e)
+                        errores.append(f"{tipo} {f.doc_id}: {e}"); continue
+                    if not ruta: continue
+                    # El PDF ya viene comprimido; el HTML de respaldo sí se comprime
+                    zf.write(ruta, secure_filename(f"{clave['folio']}.{clave['ext']}") or f"{f.doc_id}.{clave['ext']}",
+                             compress_type=zipfile.ZIP_STORED if clave["ext"] == "pdf" else zipfile.ZIP_DEFLATED)
+                    yield out.vaciar()
+            if errores: zf.writestr("errores.txt", "\n".join(errores))
+        yield out.vaciar()
+    finally:
+        for f in pendientes: f.cancel()   # descarga interrumpida
+
+def respuesta_zip_pdf(nombre, tipo, sql, params):
+    """Descarga ZIP en streaming con los PDF de los documentos que devuelve `sql` (ids)."""
+    ids = [r["id"] for r in query(sql + f" LIMIT {PDF_LOTE_MAX + 1}", tuple(params), fetchall=True) or []]
+    if len(ids) > PDF_LOTE_MAX:
+        flash(f"Son más de {PDF_LOTE_MAX} documentos; acota los filtros.","warning")
+        return redirect(request.referrer or url_for("dashboard"))
+    archivo = f"{nombre}_{datetime.now().strftime('%Y%m%d_%H%M')}.zip"
+    return Response(zip_pdf_stream(tipo, ids), mimetype="application/zip",
+                    headers={"Content-Disposition": f'attachment; filename="{archivo}"',
+                             "X-Accel-Buffering": "no"})
+
+def _filtro_fechas(col):
+    """Condición para ?desde=AAAA-MM-DD&hasta=AAAA-MM-DD (inclusive) sobre `col`."""
+    cond, params = "", []
+    try:
+        desde = date.fromisoformat(request.args.get("desde","")) if request.args.get("desde") else None
+        hasta = date.fromisoformat(request.args.get("hasta","")) if request.args.get("hasta") else None
+    except ValueError:
+        return cond, params
+    if desde: cond += f" AND {col}>=%s"; params.append(desde.isoformat())
+    if hasta: cond += f" AND {col}<%s";  params.append((hasta + timedelta(days=1)).isoformat())
+    return cond, params
+
+# ── LIMPIEZA DE STORAGE ───────────────────────────────────
+def rutas_referenciadas():
+    """{bucket: set(rutas)} de todo lo que la base todavía enlaza
+    (fotos y sus miniaturas, firmas, avatares y logo)."""
+    refs = {BUCKET_FOTOS: set(), BUCKET_FIRMAS: set(), BUCKET_AVA: set()}
+    conn = get_db(); cur = conn.cursor(name="gc_refs")
+    try:
+        cur.itersize = 5000
+        cur.execute("""SELECT 'f' AS t, archivo AS url, miniaturas FROM fotos
+                       UNION ALL SELECT 'a', firma_archivo, NULL FROM actividades WHERE firma_archivo <> ''
+                       UNION ALL SELECT 'u', foto_url, NULL FROM usuarios WHERE foto_url <> ''
+                       UNION ALL SELECT 'c', logo_url, NULL FROM config WHERE logo_url <> ''""")
+        bucket_de = {"f": BUCKET_FOTOS, "a": BUCKET_FIRMAS, "u": BUCKET_AVA, "c": BUCKET_AVA}
+        for r in cur:
+            bucket = bucket_de[r["t"]]
+            ruta = ruta_storage(bucket, r["url"])
+            if not ruta: continue
+            refs[bucket].add(ruta)
+            if r["miniaturas"] and "_max." in ruta:
+                base, ext = ruta.rsplit("_max.", 1)
+                refs[bucket].update(f"{base}_w{a}.{ext}" for a in r["miniaturas"].split(",") if a.isdigit())
+    finally:
+        cur.close(); conn.rollback(); conn.close()
+    return refs
+
+def storage_gc(gracia_horas=24, dry_run=False, lote=100, echo=print):
+    """Borra objetos que ninguna fila referencia y que tienen más de
+    `gracia_horas` (cubre subidas directas y fotos en proceso). Retorna
+    {bucket: [rutas huérfanas]}."""
+    limite = datetime.utcnow() - timedelta(hours=gracia_horas)
+    storage = get_storage()
+    huerfanos = {}
+    for bucket, refs in rutas_referenciadas().items():
+        viejos = {ruta for ruta, fecha in storage.listar(bucket) if fecha < limite}
+        huerfanos[bucket] = sorted(viejos - refs)
+        echo(f"{bucket}: {len(huerfanos[bucket])} huérfanos de {len(viejos)} objetos con más de {gracia_horas} h")
+        if dry_run: continue
+        for i in range(0, len(huerfanos[bucket]), lote):
+            try: storage.borrar(bucket, huerfanos[bucket][i:i+lote])
+            except Exception as e: app.logger.warning("storage-gc: fallo borrando en %s: %s", bucket, e)
+    return huerfanos
+
+@app.cli.command("storage-gc")
+@click.option("--dry-run", is_flag=True, help="Sólo lista los huérfanos, no borra.")
+@click.option("--grace-hours", default=24, show_default=True, help="Antigüedad mínima para borrar.")
+@click.option("--verbose", "-v", is_flag=True, help="Muestra cada ruta huérfana.")
+def cli_storage_gc(dry_run, grace_hours, verbose):
+    """Elimina del storage los archivos que ya no referencia ninguna fila."""
+    huerfanos = storage_gc(grace_hours, dry_run, echo=click.echo)
+    if verbose:
+        for bucket, rutas in huerfanos.items():
+            for r in rutas: click.echo(f"  {bucket}/{r}")
 
 # ── SESSION HELPERS ───────────────────────────────────────
 def logged_in(): return "user_id" in session
@@ -399,8 +1101,132 @@ def inject_globals():
         "color_dark":     color_dark,
         "color_rgba":     color_rgba,
         "color_sidebar":  color_sidebar,
+        "filtros_url":    filtros_url,
     }
 
+def filtros_url(**valores):
+    """Query string actual para armar ligas de exportación: los `valores`
+    explícitos (p.ej. formato) mandan y se omiten los argumentos reservados
+    de url_for (_external, _anchor...)."""
+    args = {k: v for k, v in request.args.items() if not k.startswith("_")}
+    args.update(valores)
+    return args
+
+# ── EXPORTACIONES (CSV / XLSX en streaming) ───────────────
+# Las filas se leen con un cursor de servidor en lotes de EXPORT_LOTE y se
+# envían conforme se generan: la memoria no depende del tamaño del reporte.
+EXPORT_LOTE = int(os.environ.get("EXPORT_LOTE", "2000"))
+XLSX_MIME   = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+def filas_servidor(sql, params=()):
+    """Itera tuplas de `sql` con un cursor con nombre (server-side)."""
+    conn = get_db()
+    cur  = conn.cursor(name=f"export_{uuid.uuid4().hex[:12]}", cursor_factory=psycopg2.extensions.cursor)
+    cur.itersize = EXPORT_LOTE
+    try:
+        cur.execute(sql, tuple(params))
+        yield from cur
+    finally:
+        cur.close(); conn.rollback(); conn.close()
+
+def csv_stream(encabezados, filas):
+    import csv
+    buf = io.StringIO(); w = csv.writer(buf)
+    buf.write("\ufeff")   # BOM: Excel abre el UTF-8 sin desordenar acentos
+    w.writerow(encabezados)
+    for n, fila in enumerate(filas, 1):
+        w.writerow(fila)
+        if n % 500 == 0:
+            yield buf.getvalue().encode(); buf.seek(0); buf.truncate()
+    yield buf.getvalue().encode()
+
+class _SalidaZip:
+    """Destino sin seek() para zipfile: guarda lo escrito hasta que el generador lo entrega."""
+    def __init__(self): self.partes = []
+    def write(self, b): self.partes.append(bytes(b)); return len(b)
+    def flush(self): pass
+    def vaciar(self):
+        data = b"".join(self.partes); self.partes.clear(); return data
+
+_XLSX_NS = 'xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"'
+_XLSX_FIJOS = {
+    "[Content_Types].xml":
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>',
+    "_rels/.rels":
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+        '</Relationships>',
+    "xl/_rels/workbook.xml.rels":
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+        '</Relationships>',
+}
+
+_XML_INVALIDOS = None
+
+def _xlsx_fila(fila):
+    global _XML_INVALIDOS
+    if _XML_INVALIDOS is None:
+        import re
+        _XML_INVALIDOS = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f]")
+    celdas = []
+    for v in fila:
+        if v is None or v == "": celdas.append("<c/>")
+        elif isinstance(v, (int, float, Decimal)) and not isinstance(v, bool):
+            celdas.append(f'<c t="n"><v>{v}</v></c>')
+        else:
+            texto = _XML_INVALIDOS.sub("", str(v)).replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+            celdas.append(f'<c t="inlineStr"><is><t xml:space="preserve">{texto}</t></is></c>')
+    return "<row>" + "".join(celdas) + "</row>"
+
+def xlsx_stream(encabezados, filas, hoja="Datos"):
+    """XLSX mínimo (una hoja, celdas inline) escrito en streaming: el ZIP va
+    con descriptores de datos, así que no hace falta conocer tamaños antes."""
+    import zipfile
+    from xml.sax.saxutils import quoteattr
+    out = _SalidaZip()
+    with zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED) as zf:
+        for nombre, xml in _XLSX_FIJOS.items(): zf.writestr(nombre, xml)
+        zf.writestr("xl/workbook.xml",
+                    f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?><workbook {_XLSX_NS} '
+                    'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+                    f'<sheets><sheet name={quoteattr(hoja[:31])} sheetId="1" r:id="rId1"/></sheets></workbook>')
+        with zf.open("xl/worksheets/sheet1.xml", "w", force_zip64=True) as fh:
+            fh.write(f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?><worksheet {_XLSX_NS}>'
+                     '<sheetData>'.encode())
+            bloque = [_xlsx_fila(encabezados)]
+            for n, fila in enumerate(filas, 1):
+                bloque.append(_xlsx_fila(fila))
+                if n % 500 == 0:
+                    fh.write("".join(bloque).encode()); bloque.clear()
+                    yield out.vaciar()
+            fh.write("".join(bloque).encode())
+            fh.write(b"</sheetData></worksheet>")
+    yield out.vaciar()
+
+def respuesta_export(nombre, encabezados, sql, params):
+    """Respuesta en streaming con `sql` como CSV o XLSX (?formato=csv|xlsx)."""
+    formato = request.args.get("formato", "csv")
+    filas   = filas_servidor(sql, params)
+    if formato == "xlsx":
+        cuerpo, mime = xlsx_stream(encabezados, filas, nombre.capitalize()), XLSX_MIME
+    elif formato == "csv":
+        cuerpo, mime = csv_stream(encabezados, filas), "text/csv; charset=utf-8"
+    else:
+        abort(400)
+    archivo = f"{nombre}_{datetime.now().strftime('%Y%m%d_%H%M')}.{formato}"
+    return Response(stream_with_context(cuerpo), mimetype=mime,
+                    headers={"Content-Disposition": f'attachment; filename="{archivo}"',
+                             "X-Accel-Buffering": "no"})
+
 # ── LOGIN ─────────────────────────────────────────────────
 @app.route("/")
 def inicio(): return redirect(url_for("login"))
@@ -464,27 +1290,107 @@ def dashboard():
                            rol=session["rol"], stats=stats, visitas_recientes=vr, proximos=proximos)
 
 # ── VISITAS ───────────────────────────────────────────────
+def _filtro_visitas():
+    """Alcance por rol de /visitas como (condición, params); lo reusa la exportación."""
+    uid = session["user_id"]
+    if can_see_all(): return "", []
+    if session["rol"] == "supervisor":
+        # Supervisor ve a sus subordinados
+        return " AND (a.usuario_id=%s OR a.usuario_id IN (SELECT id FROM usuarios WHERE supervisor_id=%s))", [uid, uid]
+    return " AND a.usuario_id=%s", [uid]
+
 @app.route("/visitas")
 def visitas():
     if not logged_in(): return redirect(url_for("login"))
-    uid = session["user_id"]
-    rol = session["rol"]
+    cond, params = _filtro_visitas()
     base = """SELECT a.id,a.fecha,u.usuario,a.cliente,a.comentarios,
                      a.proxima_visita,a.firma_archivo,
                      (SELECT COUNT(*) FROM fotos f WHERE f.actividad_id=a.id) AS fotos_count
-              FROM actividades a JOIN usuarios u ON u.id=a.usuario_id"""
-    if can_see_all():
-        acts = query(base+" ORDER BY a.fecha DESC",fetchall=True)
-    elif rol == "supervisor":
-        # Supervisor ve a sus subordinados
-        subs = query("SELECT id FROM usuarios WHERE supervisor_id=%s",(uid,),fetchall=True)
-        ids  = [s["id"] for s in subs] + [uid]
-        ph   = ",".join(["%s"]*len(ids))
-        acts = query(f"{base} WHERE a.usuario_id IN ({ph}) ORDER BY a.fecha DESC",tuple(ids),fetchall=True)
-    else:
-        acts = query(base+" WHERE a.usuario_id=%s ORDER BY a.fecha DESC",(uid,),fetchall=True)
+              FROM actividades a JOIN usuarios u ON u.id=a.usuario_id WHERE 1=1"""
+    acts = query(base+cond+" ORDER BY a.fecha DESC",tuple(params),fetchall=True)
     return render_template("visitas.html", empresa=EMPRESA, logo=LOGO, actividades=acts)
 
+@app.route("/visitas/exportar")
+def exportar_visitas():
+    if not logged_in(): return redirect(url_for("login"))
+    cond, params = _filtro_visitas()
+    return respuesta_export("visitas",
+        ["ID","Fecha","Usuario","Cliente","Comentarios","Próxima visita","Fotos"],
+        """SELECT a.id,a.fecha,u.usuario,a.cliente,a.comentarios,a.proxima_visita,
+                  (SELECT COUNT(*) FROM fotos f WHERE f.actividad_id=a.id)
+           FROM actividades a JOIN usuarios u ON u.id=a.usuario_id WHERE 1=1"""
+        + cond + " ORDER BY a.fecha DESC, a.id DESC", params)
+
+@app.route("/visitas/subidas", methods=["POST"])
+def subidas_visita():
+    """Emite URLs firmadas para que el navegador suba firma y fotos directo al
+    storage; el formulario luego envía sólo las rutas (ver guardar_visita)."""
+    if not logged_in(): return jsonify({"ok":False,"msg":"No autenticado"}), 401
+    if not tiene_permiso("crear", "visitas"): return jsonify({"ok":False,"msg":"Sin permiso"}), 403
+    data = request.get_json(silent=True) or {}
+    exts = [str(e).lower() for e in data.get("fotos", [])][:2]
+    if len(exts) < 2 or any(e not in ALLOWED_EXT for e in exts):
+        return jsonify({"ok":False,"msg":"Debes subir 2 fotos (png, jpg, jpeg, webp)."}), 400
+    actividad_id = query("SELECT nextval(pg_get_serial_sequence('actividades','id')) AS id",
+                         fetchone=True)["id"]
+    try:
+        def subida(bucket, ext):
+            ruta = f"actividad_{actividad_id}/{uuid.uuid4().hex}.{ext}"
+            return {"ruta": ruta, "url": get_storage().url_subida(bucket, ruta),
+                    "content_type": f"image/{'jpeg' if ext == 'jpg' else ext}"}
+        firma = subida(BUCKET_FIRMAS, "png")
+        fotos = [subida(BUCKET_FOTOS, e) for e in exts]
+    except Exception as e:
+        return jsonify({"ok":False,"msg":f"Storage: {e}"}), 502
+    token = _firmador("subida-visita").dumps({"actividad_id": actividad_id, "uid": session["user_id"]})
+    return jsonify({"ok":True, "actividad_id":actividad_id, "token":token, "firma":firma, "fotos":fotos})
+
+@app.route("/storage/local/<bucket>/<path:ruta>", methods=["GET","PUT"])
+def storage_local(bucket, ruta):
+    """Sustituto local del storage (STORAGE_BACKEND=local): GET sirve el
+    archivo, PUT lo recibe con el token de url_subida()."""
+    if STORAGE_BACKEND != "local": abort(404)
+    from itsdangerous import BadSignature
+    try:
+        if request.method == "GET":
+            if not logged_in(): abort(403)
+            return get_storage().servir(bucket, ruta)
+        if _firmador("subida-local").loads(request.args.get("token",""), max_age=SUBIDA_TTL) != [bucket, ruta]:
+            abort(403)
+        get_storage().subir(bucket, ruta, request.stream, request.content_type)
+    except BadSignature:
+        abort(403)
+    except ValueError:
+        abort(404)
+    return jsonify({"ok":True, "ruta":ruta})
+
+def _subidas_directas():
+    """Valida las rutas que envía el formulario tras subir directo al storage.
+    Retorna (actividad_id, [(bucket, url)]), (actividad_id, None) si la visita
+    de ese token ya se registró (reenvío), o lanza ValueError."""
+    from itsdangerous import BadSignature
+    try:
+        datos = _firmador("subida-visita").loads(request.form.get("subida_token",""), max_age=SUBIDA_TTL)
+    except BadSignature:
+        raise ValueError("La autorización de subida expiró, vuelve a intentarlo.")
+    if datos.get("uid") != session["user_id"]: raise ValueError("Autorización de subida inválida.")
+    actividad_id = datos["actividad_id"]
+    # Antes de revisar archivos: procesar_foto ya pudo sustituir los originales.
+    if query("SELECT 1 FROM actividades WHERE id=%s",(actividad_id,),fetchone=True):
+        return actividad_id, None
+    firma = request.form.get("firma_ruta","").strip()
+    fotos = [r.strip() for r in request.form.getlist("fotos_rutas") if r.strip()][:2]
+    if not firma: raise ValueError("La firma es obligatoria.")
+    if len(fotos) < 2: raise ValueError("Debes subir 2 fotos obligatorias.")
+    subidas = []
+    for bucket, ruta in [(BUCKET_FIRMAS, firma)] + [(BUCKET_FOTOS, r) for r in fotos]:
+        if not ruta.startswith(f"actividad_{actividad_id}/") or ".." in ruta:
+            raise ValueError("Ruta de archivo inválida.")
+        if not get_storage().existe(bucket, ruta):
+            raise ValueError("No se encontró un archivo subido; vuelve a intentarlo.")
+        subidas.append((bucket, get_storage().url_publica(bucket, ruta)))
+    return actividad_id, subidas
+
 @app.route("/visitas/guardar", methods=["POST"])
 def guardar_visita():
     if not logged_in(): return redirect(url_for("login"))
@@ -498,28 +1404,59 @@ def guardar_visita():
     fotos      = request.files.getlist("fotos")
     if not cliente or not comentarios:
         flash("Cliente y comentarios son obligatorios.","danger"); return redirect(url_for("visitas"))
-    fotos_validas = [f for f in fotos if f and f.filename]
-    if len(fotos_validas) < 2:
-        flash("Debes subir 2 fotos obligatorias.","danger"); return redirect(url_for("visitas"))
-    if not firma_data or not firma_data.startswith("data:image"):
-        flash("La firma es obligatoria.","danger"); return redirect(url_for("visitas"))
+    directas = bool(request.form.get("subida_token"))
+    if directas:
+        # Los archivos ya están en el storage (subidas_visita): sólo verificar rutas.
+        try: actividad_id, subidas = _subidas_directas()
+        except Exception as e:
+            flash(str(e),"danger"); return redirect(url_for("visitas"))
+        if subidas is None:
+            flash("La visita ya estaba registrada.","warning"); return redirect(url_for("visitas"))
+    else:
+        fotos_validas = [f for f in fotos if f and f.filename]
+        if len(fotos_validas) < 2:
+            flash("Debes subir 2 fotos obligatorias.","danger"); return redirect(url_for("visitas"))
+        if not firma_data or not firma_data.startswith("data:image"):
+            flash("La firma es obligatoria.","danger"); return redirect(url_for("visitas"))
+        # Las subidas van primero y en paralelo; la transacción sólo guarda metadatos.
+        actividad_id = query("SELECT nextval(pg_get_serial_sequence('actividades','id')) AS id",
+                             fetchone=True)["id"]
+        pool  = _get_upload_pool()
+        tareas = [("firma", BUCKET_FIRMAS, pool.submit(upload_firma, firma_data, actividad_id))]
+        tareas += [("fotos", BUCKET_FOTOS, pool.submit(upload_foto, f, actividad_id)) for f in fotos_validas[:2]]
+        subidas, error = [], None
+        for tipo, bucket, fut in tareas:
+            try: subidas.append((bucket, fut.result()))
+            except Exception as e: error = error or (tipo, e)
+        if error:
+            borrar_subidas(subidas)
+            flash(f"Error guardando {error[0]}: {error[1]}","danger"); return redirect(url_for("visitas"))
+    firma_url = subidas[0][1]
+    fotos_urls = [url for bucket, url in subidas[1:]]
     conn = get_db(); cur = conn.cursor()
-    cur.execute("""INSERT INTO actividades (usuario_id,fecha,cliente,comentarios,proxima_visita,firma_archivo)
-                   VALUES (%s,%s,%s,%s,%s,%s) RETURNING id""",
-                (session["user_id"],datetime.now().strftime("%Y-%m-%d %H:%M"),cliente,comentarios,proxima,None))
-    actividad_id = cur.fetchone()["id"]
-    try:
-        firma_url = upload_firma(firma_data, actividad_id)
-        cur.execute("UPDATE actividades SET firma_archivo=%s WHERE id=%s",(firma_url,actividad_id))
-    except Exception as e:
-        conn.rollback(); conn.close(); flash(f"Error guardando firma: {e}","danger"); return redirect(url_for("visitas"))
     try:
-        for f in fotos_validas[:2]:
-            url = upload_foto(f, actividad_id)
-            cur.execute("INSERT INTO fotos (actividad_id,archivo) VALUES (%s,%s)",(actividad_id,url))
+        cur.execute("""INSERT INTO actividades (id,usuario_id,fecha,cliente,comentarios,proxima_visita,firma_archivo)
+                       VALUES (%s,%s,%s,%s,%s,%s,%s) ON CONFLICT (id) DO NOTHING""",
+                    (actividad_id,session["user_id"],datetime.now().strftime("%Y-%m-%d %H:%M"),
+                     cliente,comentarios,proxima,firma_url))
+        if not cur.rowcount:
+            # Reenvío del mismo subida_token (atrás, reintento): la visita ya existe
+            # y sus archivos son los suyos, no se tocan.
+            conn.rollback()
+            flash("La visita ya estaba registrada.","warning"); return redirect(url_for("visitas"))
+        foto_ids = []
+        for url in fotos_urls:
+            cur.execute("INSERT INTO fotos (actividad_id,archivo) VALUES (%s,%s) RETURNING id",(actividad_id,url))
+            foto_ids.append(cur.fetchone()["id"])
+        conn.commit()
     except Exception as e:
-        conn.rollback(); conn.close(); flash(f"Error guardando fotos: {e}","danger"); return redirect(url_for("visitas"))
-    conn.commit(); cur.close(); conn.close()
+        conn.rollback()
+        # Las subidas directas pueden reenviarse con el mismo token: no se borran.
+        if not directas: borrar_subidas(subidas)
+        flash(f"Error guardando visita: {e}","danger"); return redirect(url_for("visitas"))
+    finally:
+        cur.close(); conn.close()
+    encolar_fotos(foto_ids)
     flash("Visita registrada correctamente","success")
     return redirect(url_for("visitas"))
 
@@ -758,7 +1695,7 @@ def configuracion():
         if logo and logo.filename and allowed_file(logo.filename):
             try: logo_url = upload_avatar(logo, "logo")
             except Exception as e: flash(f"Error: {e}","danger")
-        query("UPDATE config SET empresa=%s,logo_url=%s,color_primario=%s,descripcion=%s WHERE id=1",
+        query("UPDATE config SET empresa=%s,logo_url=%s,color_primario=%s,descripcion=%s,version=version+1 WHERE id=1",
               (empresa,logo_url,color,descripcion),commit=True)
         flash("Configuracion guardada","success")
         return redirect(url_for("configuracion"))
@@ -780,8 +1717,7 @@ def extraer_colores():
     if not url: return jsonify({"ok":False,"msg":"URL requerida"})
     if not url.startswith("http"): url = "https://" + url
     try:
-        import requests as _r
-        resp = _r.get(url, timeout=8, headers={"User-Agent":"Mozilla/5.0"}, verify=False)
+        resp = _http().get(url, timeout=8, headers={"User-Agent":"Mozilla/5.0"}, verify=False)
         html = resp.text
         # Extract colors from CSS and inline styles
         import re
@@ -933,17 +1869,39 @@ SEMAFOROS = {"verde":"#16a34a","amarillo":"#f59e0b","rojo":"#c5221f"}
 INDUSTRIAS = ["Tecnología","Manufactura","Comercio","Servicios","Salud","Educación",
               "Construcción","Alimentos","Transporte","Finanzas","Otro"]
 FUENTES = ["Referido","Web","Redes sociales","Llamada en frío","Evento","Otro"]
+IMPORT_MAX_ERRORES = 1000   # errores por fila que se reportan en una importación
+
+def _filtro_clientes():
+    """Condiciones de /clientes (alcance por rol + filtros de la URL) como
+    (sql, params); las comparten el listado, su conteo y la exportación."""
+    buscar        = request.args.get("q","").strip()
+    clasificacion = request.args.get("clasificacion","")
+    semaforo      = request.args.get("semaforo","")
+    tipo_cliente  = request.args.get("tipo_cliente","")
+    cond   = " AND c.activo=1 AND (c.tipo_cliente IN ('C','L') OR c.tipo_cliente IS NULL OR c.tipo_cliente = '')"
+    params = []
+    if not can_see_all() and session["rol"] != "supervisor":
+        cond += " AND c.vendedor_id=%s"; params.append(session["user_id"])
+    if buscar:
+        cond += " AND (c.nombre ILIKE %s OR c.empresa ILIKE %s OR c.email ILIKE %s)"
+        params += [f"%{buscar}%",f"%{buscar}%",f"%{buscar}%"]
+    if clasificacion:
+        cond += " AND c.clasificacion=%s"; params.append(clasificacion)
+    if semaforo:
+        cond += " AND c.estado_semaforo=%s"; params.append(semaforo)
+    if tipo_cliente:
+        cond += " AND c.tipo_cliente=%s"; params.append(tipo_cliente)
+    return cond, params
 
 @app.route("/clientes")
 def clientes():
     if not logged_in(): return redirect(url_for("login"))
-    uid = session["user_id"]
-    rol = session["rol"]
     buscar = request.args.get("q","").strip()
     clasificacion = request.args.get("clasificacion","")
     semaforo = request.args.get("semaforo","")
 
     tipo_cliente  = request.args.get("tipo_cliente","")  # C=Cliente, L=Lead, S=Proveedor
+    cond, params = _filtro_clientes()
 
     base = """SELECT c.*,u.nombre AS vendedor_nombre, u.usuario AS vendedor_usuario,
               (SELECT COUNT(*) FROM actividades a WHERE a.cliente=c.nombre) AS total_visitas,
@@ -951,22 +1909,7 @@ def clientes():
               (SELECT MIN(a.proxima_visita) FROM actividades a WHERE a.cliente=c.nombre
                AND a.proxima_visita >= CURRENT_DATE::text) AS proxima_visita
               FROM clientes c LEFT JOIN usuarios u ON u.id=c.vendedor_id
-              WHERE c.activo=1
-              AND (c.tipo_cliente IN ('C','L') OR c.tipo_cliente IS NULL OR c.tipo_cliente = '')"""
-    params = []
-
-    if not can_see_all() and rol != "supervisor":
-        base += " AND c.vendedor_id=%s"; params.append(uid)
-
-    if buscar:
-        base += " AND (c.nombre ILIKE %s OR c.empresa ILIKE %s OR c.email ILIKE %s)"
-        params += [f"%{buscar}%",f"%{buscar}%",f"%{buscar}%"]
-    if clasificacion:
-        base += " AND c.clasificacion=%s"; params.append(clasificacion)
-    if semaforo:
-        base += " AND c.estado_semaforo=%s"; params.append(semaforo)
-    if tipo_cliente:
-        base += " AND c.tipo_cliente=%s"; params.append(tipo_cliente)
+              WHERE 1=1""" + cond
 
     # Paginación
     page     = int(request.args.get("page", 1))
@@ -975,20 +1918,7 @@ def clientes():
     offset   = (page - 1) * per_page
 
     # Total count — query simple separada
-    count_base = "SELECT COUNT(*) AS total FROM clientes c WHERE c.activo=1 AND (c.tipo_cliente IN ('C','L') OR c.tipo_cliente IS NULL OR c.tipo_cliente = '')"
-    count_params = []
-    if not can_see_all() and rol != "supervisor":
-        count_base += " AND c.vendedor_id=%s"; count_params.append(uid)
-    if buscar:
-        count_base += " AND (c.nombre ILIKE %s OR c.empresa ILIKE %s OR c.email ILIKE %s)"
-        count_params += [f"%{buscar}%",f"%{buscar}%",f"%{buscar}%"]
-    if clasificacion:
-        count_base += " AND c.clasificacion=%s"; count_params.append(clasificacion)
-    if semaforo:
-        count_base += " AND c.estado_semaforo=%s"; count_params.append(semaforo)
-    if tipo_cliente:
-        count_base += " AND c.tipo_cliente=%s"; count_params.append(tipo_cliente)
-    total_row = query(count_base, tuple(count_params), fetchone=True)
+    total_row = query("SELECT COUNT(*) AS total FROM clientes c WHERE 1=1" + cond, tuple(params), fetchone=True)
     total     = total_row["total"] if total_row else 0
     total_pages = max(1, -(-total // per_page))
 
@@ -1005,6 +1935,21 @@ def clientes():
                            fil_tipo=tipo_cliente,
                            page=page, per_page=per_page, total=total, total_pages=total_pages)
 
+@app.route("/clientes/exportar")
+def exportar_clientes():
+    if not logged_in(): return redirect(url_for("login"))
+    cond, params = _filtro_clientes()
+    return respuesta_export("clientes",
+        ["ID","Nombre","Empresa","Cargo","Email","Teléfono","Teléfono 2","Dirección","Ciudad","Estado",
+         "País","C.P.","RFC","Razón social","Uso CFDI","Clasificación","Semáforo","Tipo","Vendedor",
+         "Industria","Fuente","Sitio web","Creado","Actualizado"],
+        """SELECT c.id,c.nombre,c.empresa,c.cargo,c.email,c.telefono,c.telefono2,c.direccion,c.ciudad,
+                  c.estado_dir,c.pais,c.codigo_postal,c.rfc,c.razon_social,c.uso_cfdi,c.clasificacion,
+                  c.estado_semaforo,c.tipo_cliente,u.nombre,c.industria,c.fuente,c.sitio_web,
+                  c.fecha_creacion,c.fecha_actualizacion
+           FROM clientes c LEFT JOIN usuarios u ON u.id=c.vendedor_id WHERE 1=1"""
+        + cond + " ORDER BY c.id", params)
+
 @app.route("/clientes/crear", methods=["POST"])
 def crear_cliente():
     if not logged_in(): return redirect(url_for("login"))
@@ -1019,9 +1964,9 @@ def crear_cliente():
         query("""INSERT INTO clientes
             (nombre,empresa,cargo,email,telefono,telefono2,direccion,ciudad,estado_dir,
              pais,codigo_postal,rfc,razon_social,uso_cfdi,clasificacion,estado_semaforo,
-             vendedor_id,notas,sitio_web,industria,empleados,fuente,
+             vendedor_id,notas,sitio_web,industria,empleados,fuente,sap_card_code,
              activo,creado_por,fecha_creacion,fecha_actualizacion)
-            VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)""",
+            VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)""",
             (nombre,
              request.form.get("empresa","").strip(),
              request.form.get("cargo","").strip(),
@@ -1044,12 +1989,384 @@ def crear_cliente():
              request.form.get("industria","").strip(),
              request.form.get("empleados","").strip(),
              request.form.get("fuente","").strip(),
+             request.form.get("sap_card_code","").strip() or card_code_de_notas(request.form.get("notas","")),
              1, uid, now, now), commit=True)
+        invalidar_card_codes()
         flash("Cliente creado correctamente ✅","success")
     except Exception as e:
         flash(f"Error: {e}","danger")
     return redirect(url_for("clientes"))
 
+# ── Importación masiva ──
+# Columnas aceptadas en el archivo (encabezado normalizado → columna).
+IMPORT_COLUMNAS = ["nombre","empresa","cargo","email","telefono","telefono2","direccion","ciudad",
+                   "estado_dir","pais","codigo_postal","rfc","razon_social","uso_cfdi","clasificacion",
+                   "estado_semaforo","vendedor_id","notas","sitio_web","industria","empleados","fuente",
+                   "sap_card_code"]
+IMPORT_ALIAS = {"estado":"estado_dir","cp":"codigo_postal","c.p.":"codigo_postal","semaforo":"estado_semaforo",
+                "vendedor":"vendedor_id","correo":"email","razon social":"razon_social",
+                "codigo postal":"codigo_postal","uso cfdi":"uso_cfdi","sitio web":"sitio_web",
+                "telefono 2":"telefono2","cardcode":"sap_card_code","card code":"sap_card_code",
+                "card_code":"sap_card_code"}
+RFC_RE   = r"^[A-ZÑ&]{3,4}[0-9]{6}[A-Z0-9]{3}$"
+EMAIL_RE = r"^[^@\s]+@[^@\s]+\.[^@\s]+$"
+
+def _filas_archivo(archivo):
+    """Iterador de dicts {encabezado: valor} de un CSV o XLSX, sin cargarlo completo.
+    Lanza ValueError antes de leer si el formato no se puede procesar."""
+    nombre = (archivo.filename or "").lower()
+    if nombre.endswith(".xlsx"):
+        try: import openpyxl
+        except ImportError: raise ValueError("Para importar XLSX instala openpyxl (o sube CSV).")
+        def filas_xlsx():
+            wb = openpyxl.load_workbook(archivo.stream, read_only=True, data_only=True)
+            filas = wb.active.iter_rows(values_only=True)
+            encabezados = [str(h or "").strip() for h in next(filas, [])]
+            for fila in filas:
+                if any(v is not None for v in fila):
+                    yield dict(zip(encabezados, ["" if v is None else str(v) for v in fila]))
+            wb.close()
+        return filas_xlsx()
+    if nombre.endswith(".csv") or nombre.endswith(".txt"):
+        import csv
+        texto = io.TextIOWrapper(archivo.stream, encoding="utf-8-sig", newline="")
+        muestra = texto.read(4096); texto.seek(0)
+        try: dialecto = csv.Sniffer().sniff(muestra, delimiters=",;\t|")
+        except csv.Error: dialecto = csv.excel
+        return csv.DictReader(texto, dialect=dialecto)
+    raise ValueError("Formato no soportado: sube un archivo .csv o .xlsx")
+
+def _normalizar_encabezado(h):
+    import unicodedata
+    h = unicodedata.normalize("NFKD", str(h or "")).encode("ascii", "ignore").decode().strip().lower()
+    h = IMPORT_ALIAS.get(h, h)
+    return h.replace(" ", "_")
+
+def validar_fila_cliente(fila, vendedores):
+    """Normaliza una fila del archivo como lo hace crear_cliente. Las celdas
+    vacías quedan vacías (vendedor_id None): los valores por omisión sólo se
+    aplican al insertar, para no pisar clientes existentes. Con vendedores=None
+    la columna de vendedor se ignora (usuarios que no pueden reasignar clientes).
+    Retorna (valores, None) o (None, mensaje de error)."""
+    import re
+    v = {c: "" for c in IMPORT_COLUMNAS}
+    for h, val in fila.items():
+        col = _normalizar_encabezado(h)
+        if col in v: v[col] = (val or "").strip()
+    if not v["nombre"]: return None, "El nombre es obligatorio"
+    v["rfc"] = v["rfc"].upper().replace(" ", "").replace("-", "")
+    if v["rfc"] and not re.match(RFC_RE, v["rfc"]): return None, f"RFC inválido: {v['rfc']}"
+    if v["email"] and not re.match(EMAIL_RE, v["email"]): return None, f"Email inválido: {v['email']}"
+    v["clasificacion"] = v["clasificacion"].lower()
+    if v["clasificacion"] and v["clasificacion"] not in CLASIFICACIONES:
+        return None, f"Clasificación inválida: {v['clasificacion']} (usa {', '.join(CLASIFICACIONES)})"
+    v["estado_semaforo"] = v["estado_semaforo"].lower()
+    if v["estado_semaforo"] and v["estado_semaforo"] not in SEMAFOROS:
+        return None, f"Semáforo inválido: {v['estado_semaforo']} (usa {', '.join(SEMAFOROS)})"
+    if v["vendedor_id"] and vendedores is not None:
+        vid = vendedores.get(v["vendedor_id"].lower())
+        if vid is None: return None, f"Vendedor desconocido: {v['vendedor_id']}"
+        v["vendedor_id"] = vid
+    else:
+        v["vendedor_id"] = None
+    v["sap_card_code"] = v["sap_card_code"] or card_code_de_notas(v["notas"])
+    return v, None
+
+class _CopyBuffer:
+    """Archivo de sólo lectura sobre un generador de líneas, para COPY FROM STDIN."""
+    def __init__(self, lineas): self.lineas, self.resto = lineas, b""
+    def read(self, n=-1):
+        while n < 0 or len(self.resto) < n:
+            linea = next(self.lineas, None)
+            if linea is None: break
+            self.resto += linea.encode()
+        if n < 0: n = len(self.resto)
+        data, self.resto = self.resto[:n], self.resto[n:]
+        return data
+
+def _copy_texto(v):
+    if v is None: return "\\N"
+    return str(v).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+@app.route("/clientes/importar", methods=["POST"])
+def importar_clientes():
+    """Importación masiva CSV/XLSX: valida fila por fila, carga las válidas con
+    COPY a una tabla temporal y hace upsert por RFC (o email) en una sola
+    transacción. Responde JSON con conteos y errores por fila."""
+    if not logged_in(): return jsonify({"ok":False,"msg":"No autenticado"}), 401
+    if not tiene_permiso("crear","clientes"): return jsonify({"ok":False,"msg":"Sin permiso"}), 403
+    archivo = request.files.get("archivo")
+    if not archivo or not archivo.filename: return jsonify({"ok":False,"msg":"Selecciona un archivo"}), 400
+    uid = session["user_id"]
+    now = datetime.now().strftime("%Y-%m-%d %H:%M")
+    vendedores = None
+    if can_see_all():
+        vendedores = {}
+        for u in query("SELECT id,usuario,email FROM usuarios", fetchall=True) or []:
+            vendedores[str(u["id"])] = vendedores[u["usuario"].lower()] = u["id"]
+            if u["email"]: vendedores[u["email"].lower()] = u["id"]
+    try: filas = _filas_archivo(archivo)
+    except ValueError as e: return jsonify({"ok":False,"msg":str(e)}), 400
+    errores, vistos, total = [], {}, [0]
+
+    def lineas(filas):
+        for n, fila in enumerate(filas, 2):   # fila 1 = encabezados
+            total[0] += 1
+            v, error = validar_fila_cliente(fila, vendedores)
+            if not error:
+                claves = [k for k in ("rfc:" + v["rfc"] if v["rfc"] else "",
+                                      "email:" + v["email"].lower() if v["email"] else "") if k]
+                previa = next((vistos[k] for k in claves if k in vistos), None)
+                if previa: error = f"Duplicado en el archivo (fila {previa})"
+                else: vistos.update((k, n) for k in claves)
+            if error:
+                if len(errores) < IMPORT_MAX_ERRORES: errores.append({"fila": n, "error": error})
+                continue
+            yield "\t".join([str(n)] + [_copy_texto(v[c]) for c in IMPORT_COLUMNAS]) + "\n"
+
+    conn = get_db(); cur = conn.cursor()
+    try:
+        cur.execute(f"""CREATE TEMP TABLE _import_clientes (
+                            fila INTEGER, {", ".join(c + (" INTEGER" if c == "vendedor_id" else " TEXT") for c in IMPORT_COLUMNAS)},
+                            cliente_id INTEGER) ON COMMIT DROP""")
+        cur.copy_expert(f"COPY _import_clientes (fila,{','.join(IMPORT_COLUMNAS)}) FROM STDIN",
+                        _CopyBuffer(lineas(filas)), size=64 * 1024)
+        # Empatar contra clientes activos: primero RFC, luego email (el más antiguo si hay varios)
+        cur.execute("""UPDATE _import_clientes s SET cliente_id=m.id FROM (
+                           SELECT DISTINCT ON (upper(rfc)) upper(rfc) AS rfc, id FROM clientes
+                           WHERE activo=1 AND rfc <> '' ORDER BY upper(rfc), id) m
+                       WHERE s.rfc <> '' AND m.rfc=s.rfc""")
+        cur.execute("""UPDATE _import_clientes s SET cliente_id=m.id FROM (
+                           SELECT DISTINCT ON (lower(email)) lower(email) AS email, id FROM clientes
+                           WHERE activo=1 AND email <> '' ORDER BY lower(email), id) m
+                       WHERE s.cliente_id IS NULL AND s.email <> '' AND m.email=lower(s.email)""")
+        # Dos filas (una por RFC y otra por email) pueden caer en el mismo cliente: gana la primera
+        cur.execute("""DELETE FROM _import_clientes s USING _import_clientes p
+                       WHERE s.cliente_id=p.cliente_id AND p.fila < s.fila
+                       RETURNING s.fila, p.fila AS previa""")
+        errores += [{"fila": r["fila"], "error": f"Duplicado en el archivo (fila {r['previa']}, mismo cliente)"}
+                    for r in {r["fila"]: r for r in cur.fetchall()}.values()][:max(0, IMPORT_MAX_ERRORES - len(errores))]
+        if not tiene_permiso("editar","clientes"):
+            cur.execute("DELETE FROM _import_clientes WHERE cliente_id IS NOT NULL RETURNING fila")
+            errores += [{"fila": r["fila"], "error": "El cliente existe y no tienes permiso para actualizarlo"}
+                        for r in cur.fetchall()][:max(0, IMPORT_MAX_ERRORES - len(errores))]
+        elif not can_see_all() and session["rol"] != "supervisor":
+            cur.execute("""DELETE FROM _import_clientes s USING clientes c
+                           WHERE c.id=s.cliente_id AND c.vendedor_id IS DISTINCT FROM %s RETURNING s.fila""", (uid,))
+            errores += [{"fila": r["fila"], "error": "El cliente existe y pertenece a otro vendedor"}
+                        for r in cur.fetchall()][:max(0, IMPORT_MAX_ERRORES - len(errores))]
+        # Actualizar: sólo los campos que el archivo trae con valor
+        asignaciones = ",".join(f"{c}=COALESCE(NULLIF(s.{c},''),c.{c})" for c in IMPORT_COLUMNAS if c != "vendedor_id")
+        cur.execute(f"""UPDATE clientes c SET {asignaciones}, vendedor_id=COALESCE(s.vendedor_id,c.vendedor_id),
+                               fecha_actualizacion=%s
+                        FROM _import_clientes s WHERE c.id=s.cliente_id""", (now,))
+        actualizados = cur.rowcount
+        # Valores por omisión de crear_cliente, sólo para los nuevos
+        omision = {"clasificacion": "'prospecto'", "estado_semaforo": "'verde'", "pais": "'México'"}
+        valores = ",".join("COALESCE(vendedor_id,%(uid)s)" if c == "vendedor_id" else
+                           f"COALESCE(NULLIF({c},''),{omision[c]})" if c in omision else c
+                           for c in IMPORT_COLUMNAS)
+        cur.execute(f"""INSERT INTO clientes ({",".join(IMPORT_COLUMNAS)},activo,creado_por,fecha_creacion,fecha_actualizacion)
+                        SELECT {valores},1,%(uid)s,%(now)s,%(now)s FROM _import_clientes
+                        WHERE cliente_id IS NULL ORDER BY fila""", {"uid": uid, "now": now})
+        insertados = cur.rowcount
+        if request.form.get("simular") == "1": conn.rollback()
+        else: conn.commit(); invalidar_card_codes()
+    except Exception as e:
+        conn.rollback(); return jsonify({"ok":False,"msg":f"Error importando: {e}"}), 500
+    finally:
+        cur.close(); conn.close()
+    errores.sort(key=lambda e: e["fila"])
+    return jsonify({"ok":True, "simulado":request.form.get("simular") == "1", "total":total[0],
+                    "insertados":insertados, "actualizados":actualizados,
+                    "con_error":total[0] - insertados - actualizados, "errores":errores})
+
+# ── DUPLICADOS DE CLIENTES ────────────────────────────────
+# dedup-clientes agrupa los clientes activos en bloques (RFC normalizado, dominio
+# de email no público, palabras del nombre/empresa y prefijo del nombre) y sólo
+# compara pares dentro de cada bloque; los bloques más grandes que DEDUP_BLOQUE_MAX
+# (palabras comunes, dominios corporativos enormes) se ignoran. Los pares con
+# puntaje >= DEDUP_UMBRAL quedan en clientes_duplicados para revisión.
+DEDUP_UMBRAL      = 0.85
+DEDUP_BLOQUE_MAX  = 50
+DEDUP_RFC_GENERICOS = {"XAXX010101000", "XEXX010101000"}
+DEDUP_DOMINIOS_PUBLICOS = {"gmail.com","hotmail.com","outlook.com","yahoo.com","yahoo.com.mx","live.com",
+                           "live.com.mx","icloud.com","prodigy.net.mx","hotmail.es","msn.com","aol.com"}
+_PALABRAS_LEGALES = {"sa","de","cv","s","a","c","v","rl","srl","sapi","sab","sc","ac","inc","llc","ltd",
+                     "cia","co","y","la","el","los","las","del","the"}
+
+def normalizar_nombre(texto):
+    """'Acme, S.A. de C.V.' → 'acme': minúsculas, sin acentos, puntuación ni forma legal."""
+    import re, unicodedata
+    t = unicodedata.normalize("NFKD", texto or "").encode("ascii", "ignore").decode().lower()
+    return " ".join(w for w in re.sub(r"[^a-z0-9]+", " ", t).split() if w not in _PALABRAS_LEGALES)
+
+def _perfil_dedup(r):
+    email = (r["email"] or "").strip().lower()
+    dominio = email.rsplit("@", 1)[1] if "@" in email else ""
+    return {"nombre": normalizar_nombre(r["nombre"]), "empresa": normalizar_nombre(r["empresa"]),
+            "rfc": (r["rfc"] or "").upper().replace(" ", "").replace("-", ""),
+            "email": email, "dominio": "" if dominio in DEDUP_DOMINIOS_PUBLICOS else dominio,
+            "tel": "".join(ch for ch in (r["telefono"] or "") if ch.isdigit())[-10:]}
+
+def _claves_bloque(p):
+    claves = set()
+    if len(p["rfc"]) >= 12 and p["rfc"] not in DEDUP_RFC_GENERICOS: claves.add("r:" + p["rfc"])
+    if p["dominio"]: claves.add("d:" + p["dominio"])
+    for campo in ("nombre", "empresa"):
+        claves.update("w:" + w for w in p[campo].split() if len(w) >= 3 and not w.isdigit())
+        if len(p[campo]) >= 4: claves.add("p:" + p[campo].replace(" ", "")[:4])
+    return claves
+
+def puntaje_duplicado(a, b):
+    """(puntaje 0..1, motivo) de dos perfiles de _perfil_dedup."""
+    from difflib import SequenceMatcher
+    if a["rfc"] and a["rfc"] == b["rfc"] and a["rfc"] not in DEDUP_RFC_GENERICOS: return 1.0, "RFC"
+    puntaje, motivo = 0.0, ""
+    for campo in ("nombre", "empresa"):
+        x, y = a[campo], b[campo]
+        if not x or not y: continue
+        sm = SequenceMatcher(None, x, y)
+        if sm.real_quick_ratio() < DEDUP_UMBRAL - 0.15 or sm.quick_ratio() < DEDUP_UMBRAL - 0.15: continue
+        r = sm.ratio()
+        if r > puntaje: puntaje, motivo = r, campo
+    if a["email"] and a["email"] == b["email"] and puntaje < 0.95: puntaje, motivo = 0.95, "email"
+    extras = []
+    if a["tel"] and len(a["tel"]) >= 8 and a["tel"] == b["tel"]: puntaje += 0.1; extras.append("teléfono")
+    if a["dominio"] and a["dominio"] == b["dominio"]: puntaje += 0.05; extras.append("dominio")
+    return min(puntaje, 1.0), " + ".join([m for m in [motivo] + extras if m])
+
+def detectar_duplicados(umbral=DEDUP_UMBRAL, echo=print):
+    """Recorre los clientes activos por bloques y guarda las sugerencias.
+    Retorna (clientes, pares comparados, sugerencias)."""
+    from psycopg2.extras import execute_values
+    perfiles, bloques = {}, {}
+    for r in filas_servidor("""SELECT id,nombre,empresa,rfc,email,telefono FROM clientes
+                               WHERE activo=1 ORDER BY id"""):
+        r = dict(zip(("id","nombre","empresa","rfc","email","telefono"), r))
+        p = perfiles[r["id"]] = _perfil_dedup(r)
+        for k in _claves_bloque(p): bloques.setdefault(k, []).append(r["id"])
+    pares = set()
+    for ids in bloques.values():
+        if 1 < len(ids) <= DEDUP_BLOQUE_MAX:
+            pares.update((a, b) for i, a in enumerate(ids) for b in ids[i + 1:])
+    del bloques
+    echo(f"{len(perfiles)} clientes, {len(pares)} pares candidatos")
+    now = datetime.now().strftime("%Y-%m-%d %H:%M")
+    sugerencias = []
+    for a, b in pares:
+        puntaje, motivo = puntaje_duplicado(perfiles[a], perfiles[b])
+        if puntaje >= umbral: sugerencias.append((a, b, round(puntaje, 3), motivo, now))
+    conn = get_db(); cur = conn.cursor()
+    try:
+        # Las descartadas o ya fusionadas se conservan tal cual
+        execute_values(cur, """INSERT INTO clientes_duplicados (cliente_a,cliente_b,puntaje,motivo,fecha) VALUES %s
+                               ON CONFLICT (cliente_a,cliente_b) DO UPDATE
+                               SET puntaje=EXCLUDED.puntaje,motivo=EXCLUDED.motivo,fecha=EXCLUDED.fecha
+                               WHERE clientes_duplicados.estatus='pendiente'""", sugerencias, page_size=1000)
+        conn.commit()
+    finally:
+        cur.close(); conn.close()
+    return len(perfiles), len(pares), len(sugerencias)
+
+@app.cli.command("dedup-clientes")
+@click.option("--umbral", default=DEDUP_UMBRAL, show_default=True, help="Puntaje mínimo para sugerir")
+def cli_dedup_clientes(umbral):
+    """Busca clientes duplicados y deja sugerencias en /clientes/duplicados."""
+    import time
+    t = time.time()
+    n, pares, sug = detectar_duplicados(umbral, echo=click.echo)
+    click.echo(f"{sug} sugerencias de {pares} pares comparados en {time.time() - t:.1f}s")
+
+def fusionar_clientes(cur, conservar_id, duplicado_id, now):
+    """Reasigna al cliente `conservar_id` todo lo del duplicado, completa sus
+    datos vacíos y da de baja el duplicado, en la transacción de `cur`."""
+    cur.execute("SELECT * FROM clientes WHERE id IN (%s,%s) AND activo=1 ORDER BY id FOR UPDATE",
+                (conservar_id, duplicado_id))
+    filas = {r["id"]: r for r in cur.fetchall()}
+    if conservar_id == duplicado_id or len(filas) != 2:
+        raise ValueError("Ambos clientes deben existir, ser distintos y estar activos")
+    dup, nombre = filas[duplicado_id], filas[conservar_id]["nombre"]
+    # Las ventas por cliente de esos días cambian de cliente
+    cur.execute("SELECT id FROM ordenes_venta WHERE cliente_id=%s", (duplicado_id,))
+    marcar_reportes(cur, ordenes=[r["id"] for r in cur.fetchall()])
+    # La copia del nombre en cada documento se actualiza si era la del duplicado
+    for tabla, col, col_nombre in (("cotizaciones","cliente_id","cliente_nombre"),
+                                   ("llamadas_servicio","cliente_id","cliente_nombre"),
+                                   ("ordenes_venta","cliente_id","cliente_nombre"),
+                                   ("remisiones","cliente_id","cliente_nombre"),
+                                   ("ordenes_compra","proveedor_id","proveedor_nombre")):
+        cur.execute(f"""UPDATE {tabla} SET {col}=%s,
+                            {col_nombre}=CASE WHEN lower(trim({col_nombre}))=lower(trim(%s)) THEN %s
+                                              ELSE {col_nombre} END
+                        WHERE {col}=%s""", (conservar_id, dup["nombre"], nombre, duplicado_id))
+    # Las visitas ligan al cliente por nombre: sólo las de usuarios que ven al
+    # duplicado (roles que ven toda la cartera o su vendedor), y sólo si ningún
+    # otro cliente activo se llama igual
+    cur.execute("""UPDATE actividades a SET cliente=%s FROM usuarios u
+                   WHERE u.id=a.usuario_id AND lower(a.cliente)=lower(trim(%s))
+                     AND (u.rol IN ('admin','gerente','supervisor') OR u.id=%s)
+                     AND NOT EXISTS (SELECT 1 FROM clientes o WHERE o.activo=1 AND o.id NOT IN (%s,%s)
+                                     AND lower(trim(o.nombre))=lower(trim(%s)))""",
+                (nombre, dup["nombre"], dup["vendedor_id"], conservar_id, duplicado_id, dup["nombre"]))
+    campos = ("empresa","cargo","email","telefono","telefono2","direccion","ciudad","estado_dir",
+              "codigo_postal","rfc","razon_social","uso_cfdi","sitio_web","industria","empleados","sap_card_code")
+    cur.execute(f"""UPDATE clientes c SET {",".join(f"{k}=COALESCE(NULLIF(c.{k},''),d.{k})" for k in campos)},
+                        notas=CASE WHEN COALESCE(d.notas,'')='' THEN c.notas
+                                   ELSE concat_ws(E'\n', NULLIF(c.notas,''), d.notas) END,
+                        fecha_actualizacion=%s
+                    FROM clientes d WHERE c.id=%s AND d.id=%s""", (now, conservar_id, duplicado_id))
+    cur.execute("""UPDATE clientes SET activo=0,fecha_actualizacion=%s,
+                       notas=concat_ws(E'\n', NULLIF(notas,''), %s) WHERE id=%s""",
+                (now, f"Fusionado en cliente #{conservar_id} el {now}", duplicado_id))
+    a, b = sorted((conservar_id, duplicado_id))
+    cur.execute("UPDATE clientes_duplicados SET estatus='fusionado' WHERE cliente_a=%s AND cliente_b=%s", (a, b))
+    cur.execute("""DELETE FROM clientes_duplicados WHERE estatus='pendiente'
+                   AND (cliente_a=%s OR cliente_b=%s)""", (duplicado_id, duplicado_id))
+
+@app.route("/clientes/duplicados")
+def clientes_duplicados():
+    if not logged_in(): return redirect(url_for("login"))
+    if not (can_see_all() and tiene_permiso("editar","clientes")): abort(403)
+    sugerencias = query("""SELECT d.*,a.nombre AS a_nombre,a.empresa AS a_empresa,a.rfc AS a_rfc,a.email AS a_email,
+                                  a.telefono AS a_telefono,a.fecha_creacion AS a_fecha,
+                                  b.nombre AS b_nombre,b.empresa AS b_empresa,b.rfc AS b_rfc,b.email AS b_email,
+                                  b.telefono AS b_telefono,b.fecha_creacion AS b_fecha
+                           FROM clientes_duplicados d
+                           JOIN clientes a ON a.id=d.cliente_a AND a.activo=1
+                           JOIN clientes b ON b.id=d.cliente_b AND b.activo=1
+                           WHERE d.estatus='pendiente'
+                           ORDER BY d.puntaje DESC,d.cliente_a LIMIT 200""", fetchall=True) or []
+    return render_template("clientes_duplicados.html", empresa=EMPRESA, logo=LOGO, sugerencias=sugerencias)
+
+@app.route("/clientes/duplicados/resolver", methods=["POST"])
+def resolver_duplicado():
+    """accion=fusionar (conservar=<id>, duplicado=<id>) o accion=descartar."""
+    if not logged_in(): return redirect(url_for("login"))
+    if not (can_see_all() and tiene_permiso("editar","clientes")): abort(403)
+    try:
+        conservar, duplicado = int(request.form["conservar"]), int(request.form["duplicado"])
+    except (KeyError, ValueError):
+        flash("Selección inválida.","danger"); return redirect(url_for("clientes_duplicados"))
+    if request.form.get("accion") == "descartar":
+        a, b = sorted((conservar, duplicado))
+        query("UPDATE clientes_duplicados SET estatus='descartado' WHERE cliente_a=%s AND cliente_b=%s",
+              (a, b), commit=True)
+        flash("Sugerencia descartada","success")
+        return redirect(url_for("clientes_duplicados"))
+    now = datetime.now().strftime("%Y-%m-%d %H:%M")
+    conn = get_db(); cur = conn.cursor()
+    try:
+        fusionar_clientes(cur, conservar, duplicado, now)
+        conn.commit()
+        invalidar_card_codes(); programar_refresco_reportes()
+        flash(f"Cliente #{duplicado} fusionado en #{conservar} ✅","success")
+    except ValueError as e:
+        conn.rollback(); flash(str(e),"danger")
+    finally:
+        cur.close(); conn.close()
+    return redirect(url_for("clientes_duplicados"))
+
 @app.route("/clientes/<int:cliente_id>")
 def detalle_cliente(cliente_id):
     if not logged_in(): return redirect(url_for("login"))
@@ -1092,7 +2409,7 @@ def editar_cliente(cliente_id):
             direccion=%s,ciudad=%s,estado_dir=%s,pais=%s,codigo_postal=%s,
             rfc=%s,razon_social=%s,uso_cfdi=%s,clasificacion=%s,estado_semaforo=%s,
             vendedor_id=%s,notas=%s,sitio_web=%s,industria=%s,empleados=%s,
-            fuente=%s,fecha_actualizacion=%s WHERE id=%s""",
+            fuente=%s,sap_card_code=%s,fecha_actualizacion=%s WHERE id=%s""",
             (request.form.get("nombre","").strip(),
              request.form.get("empresa","").strip(),
              request.form.get("cargo","").strip(),
@@ -1115,7 +2432,9 @@ def editar_cliente(cliente_id):
              request.form.get("industria","").strip(),
              request.form.get("empleados","").strip(),
              request.form.get("fuente","").strip(),
+             request.form.get("sap_card_code","").strip() or card_code_de_notas(request.form.get("notas","")),
              now, cliente_id), commit=True)
+        invalidar_card_codes()
         flash("Cliente actualizado ✅","success")
     except Exception as e:
         flash(f"Error: {e}","danger")
@@ -1133,45 +2452,74 @@ def eliminar_cliente(cliente_id):
 
 
 
+# ── PRECIOS (cotizaciones, ventas, compras) ──────────────
+# Todo en Decimal con ROUND_HALF_UP a la escala de las columnas NUMERIC: lo que
+# se calcula es exactamente lo que se guarda, y el subtotal del encabezado es
+# la suma de los importes de renglón ya redondeados.
+IVA      = Decimal("0.16")
+CENTAVO  = Decimal("0.01")
+MILESIMA = Decimal("0.001")
+_CIEN    = Decimal(100)
+
+def _decimal(valor, escala, campo):
+    try: d = Decimal(str(valor)) if valor not in (None, "") else Decimal(0)
+    except InvalidOperation: raise ValueError(f"Valor inválido en {campo}: {valor!r}")
+    if not d.is_finite(): raise ValueError(f"Valor inválido en {campo}: {valor!r}")
+    return d.quantize(escala, ROUND_HALF_UP)
+
+def calcular_totales(items, descuento_global=0, precio="precio_unitario"):
+    """Precios de un documento en una sola pasada.
+    Retorna (lineas, totales): por renglón (cantidad, precio, descuento %, importe)
+    y {subtotal, descuento_monto, impuesto, total} del encabezado. `precio` es la
+    llave del precio en los renglones (las remisiones usan "precio").
+    Lanza ValueError con cantidades o precios no numéricos."""
+    q = Decimal.quantize
+    lineas, subtotal = [], Decimal(0)
+    for it in items:
+        cant  = _decimal(it.get("cantidad", 1), MILESIMA, "cantidad")
+        pu    = _decimal(it.get(precio, 0), CENTAVO, "precio")
+        desc  = _decimal(it.get("descuento", 0), CENTAVO, "descuento")
+        importe = q(cant * pu * (_CIEN - desc) / _CIEN, CENTAVO, ROUND_HALF_UP)
+        lineas.append((cant, pu, desc, importe))
+        subtotal += importe
+    desc_monto = q(subtotal * _decimal(descuento_global, CENTAVO, "descuento") / _CIEN, CENTAVO, ROUND_HALF_UP)
+    base       = subtotal - desc_monto
+    impuesto   = q(base * IVA, CENTAVO, ROUND_HALF_UP)
+    return lineas, {"subtotal": subtotal, "descuento_monto": desc_monto,
+                    "impuesto": impuesto, "total": base + impuesto}
+
 # ── COTIZACIONES ──────────────────────────────────────────
 ESTATUS_COT = ["borrador","enviada","aceptada","rechazada","vencida"]
-IVA = 0.16
 
 def gen_folio_cot():
     count = query("SELECT COUNT(*) AS c FROM cotizaciones", fetchone=True)["c"]
     return f"COT-{(count+1):04d}"
 
-def calcular_totales(items, descuento_global=0):
-    subtotal = sum(
-        float(i.get("cantidad",1)) * float(i.get("precio_unitario",0)) *
-        (1 - float(i.get("descuento",0))/100)
-        for i in items
-    )
-    desc_monto = subtotal * (float(descuento_global)/100)
-    base       = subtotal - desc_monto
-    impuesto   = round(base * IVA, 2)
-    total      = round(base + impuesto, 2)
-    return round(subtotal,2), round(desc_monto,2), impuesto, total
+def _filtro_cotizaciones():
+    """Alcance por rol y filtros de /cotizaciones como (condición, params)."""
+    q       = request.args.get("q","").strip()
+    fil_est = request.args.get("estatus","")
+    cond, params = "", []
+    if not can_see_all() and session["rol"] != "supervisor":
+        cond += " AND c.creado_por=%s"; params.append(session["user_id"])
+    if q:
+        cond += " AND (c.folio ILIKE %s OR c.cliente_nombre ILIKE %s)"
+        params += [f"%{q}%", f"%{q}%"]
+    if fil_est:
+        cond += " AND c.estatus=%s"; params.append(fil_est)
+    c_fecha, p_fecha = _filtro_fechas("c.fecha_creacion")
+    return cond + c_fecha, params + p_fecha
 
 @app.route("/cotizaciones")
 def cotizaciones():
     if not logged_in(): return redirect(url_for("login"))
-    uid = session["user_id"]
-    rol = session["rol"]
     q   = request.args.get("q","").strip()
     fil_est = request.args.get("estatus","")
+    cond, params = _filtro_cotizaciones()
 
     base = """SELECT c.*,u.nombre AS creador_nombre
               FROM cotizaciones c LEFT JOIN usuarios u ON u.id=c.creado_por
-              WHERE 1=1"""
-    params = []
-    if not can_see_all() and rol != "supervisor":
-        base += " AND c.creado_por=%s"; params.append(uid)
-    if q:
-        base += " AND (c.folio ILIKE %s OR c.cliente_nombre ILIKE %s)"
-        params += [f"%{q}%", f"%{q}%"]
-    if fil_est:
-        base += " AND c.estatus=%s"; params.append(fil_est)
+              WHERE 1=1""" + cond
     base += " ORDER BY c.fecha_creacion DESC"
     lista = query(base, tuple(params), fetchall=True) or []
 
@@ -1179,6 +2527,31 @@ def cotizaciones():
                            cotizaciones=lista, estatus_cot=ESTATUS_COT,
                            q=q, fil_est=fil_est)
 
+@app.route("/cotizaciones/exportar")
+def exportar_cotizaciones():
+    """Una fila por partida (los datos de la cotización se repiten)."""
+    if not logged_in(): return redirect(url_for("login"))
+    cond, params = _filtro_cotizaciones()
+    return respuesta_export("cotizaciones",
+        ["Folio","Fecha","Cliente","Estatus","Moneda","Subtotal","Descuento","Impuesto","Total",
+         "Vencimiento","Creada por","Código","Artículo","UdM","Cantidad","Precio unitario",
+         "Desc. %","Importe"],
+        """SELECT c.folio,c.fecha_creacion,c.cliente_nombre,c.estatus,c.moneda,c.subtotal,
+                  c.descuento_monto,c.impuesto,c.total,c.fecha_vencimiento,u.nombre,
+                  i.item_code,i.item_nombre,i.uom,i.cantidad,i.precio_unitario,i.descuento,i.subtotal
+           FROM cotizaciones c LEFT JOIN usuarios u ON u.id=c.creado_por
+           LEFT JOIN cotizaciones_items i ON i.cotizacion_id=c.id WHERE 1=1"""
+        + cond + " ORDER BY c.fecha_creacion DESC, c.id, i.id", params)
+
+@app.route("/cotizaciones/exportar-pdf")
+def exportar_cotizaciones_pdf():
+    """ZIP con el PDF de cada cotización del filtro actual."""
+    if not logged_in(): return redirect(url_for("login"))
+    cond, params = _filtro_cotizaciones()
+    return respuesta_zip_pdf("cotizaciones", "cotizacion",
+                             "SELECT c.id FROM cotizaciones c WHERE 1=1" + cond + " ORDER BY c.fecha_creacion,c.id",
+                             params)
+
 @app.route("/cotizaciones/crear", methods=["POST"])
 def crear_cotizacion():
     if not logged_in(): return redirect(url_for("login"))
@@ -1193,7 +2566,7 @@ def crear_cotizacion():
     cliente_nombre = request.form.get("cliente_nombre","").strip()
     notas          = request.form.get("notas","").strip()
     condiciones    = request.form.get("condiciones","").strip()
-    descuento_gbl  = float(request.form.get("descuento_global","0") or 0)
+    descuento_gbl  = request.form.get("descuento_global","0") or 0
     validez        = int(request.form.get("validez_dias","15") or 15)
 
     # Items enviados como JSON
@@ -1202,7 +2575,9 @@ def crear_cotizacion():
     try: items = _json.loads(items_raw)
     except: items = []
 
-    subtotal, desc_monto, impuesto, total = calcular_totales(items, descuento_gbl)
+    try: lineas, tot = calcular_totales(items, descuento_gbl)
+    except ValueError as e:
+        flash(str(e),"danger"); return redirect(url_for("cotizaciones"))
     folio = gen_folio_cot()
 
     try:
@@ -1213,20 +2588,16 @@ def crear_cotizacion():
              notas,condiciones,creado_por,fecha_creacion,fecha_actualizacion,fecha_vencimiento)
             VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s) RETURNING id""",
             (folio,cliente_id,cliente_nombre,"borrador",validez,"MXN",
-             descuento_gbl,subtotal,desc_monto,impuesto,total,
-             notas,condiciones,uid,now,now,valida))
+             _decimal(descuento_gbl,CENTAVO,"descuento"),tot["subtotal"],tot["descuento_monto"],
+             tot["impuesto"],tot["total"],notas,condiciones,uid,now,now,valida))
         cot_id = cur.fetchone()["id"]
-        for it in items:
-            cant  = float(it.get("cantidad",1))
-            precio= float(it.get("precio_unitario",0))
-            desc  = float(it.get("descuento",0))
-            sub   = round(cant * precio * (1 - desc/100), 2)
-            cur.execute("""INSERT INTO cotizaciones_items
-                (cotizacion_id,item_code,item_nombre,uom,cantidad,precio_unitario,descuento,subtotal)
-                VALUES (%s,%s,%s,%s,%s,%s,%s,%s)""",
-                (cot_id,it.get("item_code",""),it.get("item_nombre",""),
-                 it.get("uom",""),cant,precio,desc,sub))
+        insertar_filas(cur, "cotizaciones_items",
+                       ("cotizacion_id","item_code","item_nombre","uom","cantidad","precio_unitario","descuento","subtotal"),
+                       [(cot_id,it.get("item_code",""),it.get("item_nombre",""),it.get("uom",""))+linea
+                        for it,linea in zip(items,lineas)])
+        marcar_reportes(cur, cotizaciones=[cot_id])
         conn.commit(); cur.close(); conn.close()
+        programar_refresco_reportes()
         flash(f"Cotización {folio} creada ✅","success")
         return redirect(url_for("detalle_cotizacion", cotizacion_id=cot_id))
     except Exception as e:
@@ -1242,8 +2613,11 @@ def detalle_cotizacion(cotizacion_id):
     if not cot: abort(404)
     items = query("SELECT * FROM cotizaciones_items WHERE cotizacion_id=%s ORDER BY id",
                   (cotizacion_id,),fetchall=True) or []
+    ov = query("SELECT id,folio FROM ordenes_venta WHERE cotizacion_id=%s LIMIT 1",(cotizacion_id,),fetchone=True)
+    almacenes_list = query("SELECT id,nombre FROM almacenes WHERE activo=true ORDER BY nombre",fetchall=True) or []
     return render_template("cotizacion_detalle.html", empresa=EMPRESA, logo=LOGO,
-                           cot=cot, items=items, estatus_cot=ESTATUS_COT, IVA=IVA)
+                           cot=cot, items=items, estatus_cot=ESTATUS_COT, IVA=IVA,
+                           ov=ov, almacenes=almacenes_list)
 
 @app.route("/cotizaciones/<int:cotizacion_id>/actualizar-estatus", methods=["POST"])
 def actualizar_estatus_cotizacion(cotizacion_id):
@@ -1252,57 +2626,47 @@ def actualizar_estatus_cotizacion(cotizacion_id):
     now   = datetime.now().strftime("%Y-%m-%d %H:%M")
     query("UPDATE cotizaciones SET estatus=%s,fecha_actualizacion=%s WHERE id=%s",
           (nuevo,now,cotizacion_id),commit=True)
+    marcar_reportes(cotizaciones=[cotizacion_id])
     flash("Estatus actualizado","success")
     return redirect(url_for("detalle_cotizacion", cotizacion_id=cotizacion_id))
 
 @app.route("/cotizaciones/<int:cotizacion_id>/pdf")
 def cotizacion_pdf(cotizacion_id):
     if not logged_in(): return redirect(url_for("login"))
-    cot = query("""SELECT c.*,u.nombre AS creador_nombre
-                   FROM cotizaciones c LEFT JOIN usuarios u ON u.id=c.creado_por
-                   WHERE c.id=%s""",(cotizacion_id,),fetchone=True)
-    if not cot: abort(404)
-    items = query("SELECT * FROM cotizaciones_items WHERE cotizacion_id=%s ORDER BY id",
-                  (cotizacion_id,),fetchall=True) or []
-    config = query("SELECT * FROM config WHERE id=1",fetchone=True) or {}
-    return render_template("cotizacion_pdf.html",
-                           cot=cot, items=items, empresa=EMPRESA,
-                           config=config, IVA=IVA)
+    return respuesta_pdf("cotizacion", cotizacion_id)
 
 @app.route("/cotizaciones/<int:cotizacion_id>/duplicar", methods=["POST"])
 def duplicar_cotizacion(cotizacion_id):
     if not logged_in(): return redirect(url_for("login"))
-    cot   = query("SELECT * FROM cotizaciones WHERE id=%s",(cotizacion_id,),fetchone=True)
-    if not cot: abort(404)
-    items = query("SELECT * FROM cotizaciones_items WHERE cotizacion_id=%s ORDER BY id",
-                  (cotizacion_id,),fetchall=True) or []
     uid   = session["user_id"]
     now   = datetime.now().strftime("%Y-%m-%d %H:%M")
     folio = gen_folio_cot()
+    conn = get_db(); cur = conn.cursor()
     try:
-        conn = get_db(); cur = conn.cursor()
         cur.execute("""INSERT INTO cotizaciones
             (folio,cliente_id,cliente_nombre,estatus,validez_dias,moneda,
              descuento_global,subtotal,descuento_monto,impuesto,total,
              notas,condiciones,creado_por,fecha_creacion,fecha_actualizacion,fecha_vencimiento)
-            VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s) RETURNING id""",
-            (folio,cot["cliente_id"],cot["cliente_nombre"],"borrador",
-             cot["validez_dias"],cot["moneda"],cot["descuento_global"],
-             cot["subtotal"],cot["descuento_monto"],cot["impuesto"],cot["total"],
-             cot["notas"],cot["condiciones"],uid,now,now,cot["fecha_vencimiento"]))
-        new_id = cur.fetchone()["id"]
-        for it in items:
-            cur.execute("""INSERT INTO cotizaciones_items
-                (cotizacion_id,item_code,item_nombre,uom,cantidad,precio_unitario,descuento,subtotal)
-                VALUES (%s,%s,%s,%s,%s,%s,%s,%s)""",
-                (new_id,it["item_code"],it["item_nombre"],it["uom"],
-                 it["cantidad"],it["precio_unitario"],it["descuento"],it["subtotal"]))
-        conn.commit(); cur.close(); conn.close()
+            SELECT %s,cliente_id,cliente_nombre,'borrador',validez_dias,moneda,
+                   descuento_global,subtotal,descuento_monto,impuesto,total,
+                   notas,condiciones,%s,%s,%s,fecha_vencimiento
+            FROM cotizaciones WHERE id=%s RETURNING id""",
+            (folio,uid,now,now,cotizacion_id))
+        nueva = cur.fetchone()
+        if not nueva: abort(404)
+        cur.execute("""INSERT INTO cotizaciones_items
+            (cotizacion_id,item_code,item_nombre,uom,cantidad,precio_unitario,descuento,subtotal)
+            SELECT %s,item_code,item_nombre,uom,cantidad,precio_unitario,descuento,subtotal
+            FROM cotizaciones_items WHERE cotizacion_id=%s ORDER BY id""",(nueva["id"],cotizacion_id))
+        marcar_reportes(cur, cotizaciones=[nueva["id"]])
+        conn.commit(); programar_refresco_reportes()
         flash(f"Cotización duplicada como {folio} ✅","success")
-        return redirect(url_for("detalle_cotizacion", cotizacion_id=new_id))
-    except Exception as e:
-        flash(f"Error: {e}","danger")
+        return redirect(url_for("detalle_cotizacion", cotizacion_id=nueva["id"]))
+    except psycopg2.Error as e:
+        conn.rollback(); flash(f"Error: {e}","danger")
         return redirect(url_for("cotizaciones"))
+    finally:
+        cur.close(); conn.close()
 
 # ── SERVICIOS ─────────────────────────────────────────────
 PRIORIDADES  = ["baja","media","alta","urgente"]
@@ -1316,15 +2680,35 @@ def gen_folio():
     count = query("SELECT COUNT(*) AS c FROM llamadas_servicio", fetchone=True)["c"]
     return f"SVC-{(count+1):04d}"
 
+ORDEN_SERVICIOS = "CASE ls.prioridad WHEN 'urgente' THEN 1 WHEN 'alta' THEN 2 WHEN 'media' THEN 3 ELSE 4 END, ls.fecha_creacion DESC"
+
+def _filtro_servicios():
+    """Alcance por rol y filtros de /servicios como (condición, params)."""
+    filtro_est  = request.args.get("estatus","")
+    filtro_prio = request.args.get("prioridad","")
+    filtro_tec  = request.args.get("tecnico","")
+    q           = request.args.get("q","").strip()
+    cond, params = "", []
+    # Vendedor solo ve sus llamadas (donde es técnico o las creó)
+    if not can_see_all() and session["rol"] not in ["supervisor"]:
+        cond += " AND (ls.tecnico_id=%s OR ls.creado_por=%s)"
+        params += [session["user_id"]]*2
+    if filtro_est:  cond += " AND ls.estatus=%s";       params.append(filtro_est)
+    if filtro_prio: cond += " AND ls.prioridad=%s";     params.append(filtro_prio)
+    if filtro_tec:  cond += " AND ls.tecnico_id=%s";    params.append(filtro_tec)
+    if q:
+        cond += " AND (ls.folio ILIKE %s OR ls.cliente_nombre ILIKE %s OR ls.item_nombre ILIKE %s OR ls.problema ILIKE %s)"
+        params += [f"%{q}%"]*4
+    return cond, params
+
 @app.route("/servicios")
 def servicios():
     if not logged_in(): return redirect(url_for("login"))
-    uid = session["user_id"]
-    rol = session["rol"]
     filtro_est  = request.args.get("estatus","")
     filtro_prio = request.args.get("prioridad","")
     filtro_tec  = request.args.get("tecnico","")
     q           = request.args.get("q","").strip()
+    cond, params = _filtro_servicios()
 
     base = """SELECT ls.*,
               u.nombre AS tecnico_nombre, u.usuario AS tecnico_usuario,
@@ -1332,22 +2716,9 @@ def servicios():
               FROM llamadas_servicio ls
               LEFT JOIN usuarios u ON u.id=ls.tecnico_id
               LEFT JOIN clientes c ON c.id=ls.cliente_id
-              WHERE 1=1"""
-    params = []
+              WHERE 1=1""" + cond
 
-    # Vendedor solo ve sus llamadas (donde es técnico o las creó)
-    if not can_see_all() and rol not in ["supervisor"]:
-        base += " AND (ls.tecnico_id=%s OR ls.creado_por=%s)"
-        params += [uid, uid]
-
-    if filtro_est:  base += " AND ls.estatus=%s";       params.append(filtro_est)
-    if filtro_prio: base += " AND ls.prioridad=%s";     params.append(filtro_prio)
-    if filtro_tec:  base += " AND ls.tecnico_id=%s";    params.append(filtro_tec)
-    if q:
-        base += " AND (ls.folio ILIKE %s OR ls.cliente_nombre ILIKE %s OR ls.item_nombre ILIKE %s OR ls.problema ILIKE %s)"
-        params += [f"%{q}%"]*4
-
-    base += " ORDER BY CASE ls.prioridad WHEN 'urgente' THEN 1 WHEN 'alta' THEN 2 WHEN 'media' THEN 3 ELSE 4 END, ls.fecha_creacion DESC"
+    base += " ORDER BY " + ORDEN_SERVICIOS
     llamadas = query(base, tuple(params), fetchall=True) or []
 
     tecnicos = query("SELECT id,nombre,usuario FROM usuarios WHERE activo=1 ORDER BY nombre", fetchall=True) or []
@@ -1359,6 +2730,25 @@ def servicios():
                            fil_est=filtro_est, fil_prio=filtro_prio,
                            fil_tec=filtro_tec, q=q)
 
+@app.route("/servicios/exportar")
+def exportar_servicios():
+    """Una fila por movimiento de seguimiento (la llamada se repite)."""
+    if not logged_in(): return redirect(url_for("login"))
+    cond, params = _filtro_servicios()
+    return respuesta_export("servicios",
+        ["Folio","Creada","Cliente","Código","Artículo","Serie","Problema","Prioridad","Estatus",
+         "Técnico","Atención","Cierre","SAP","Seguimiento fecha","Seguimiento usuario","Acción",
+         "Nota","Estatus anterior","Estatus nuevo"],
+        """SELECT ls.folio,ls.fecha_creacion,ls.cliente_nombre,ls.item_code,ls.item_nombre,
+                  ls.serial_number,ls.problema,ls.prioridad,ls.estatus,u.nombre,ls.fecha_atencion,
+                  ls.fecha_cierre,ls.sap_doc_entry,s.fecha,us.nombre,s.accion,s.nota,
+                  s.estatus_anterior,s.estatus_nuevo
+           FROM llamadas_servicio ls
+           LEFT JOIN usuarios u ON u.id=ls.tecnico_id
+           LEFT JOIN llamadas_seguimiento s ON s.llamada_id=ls.id
+           LEFT JOIN usuarios us ON us.id=s.usuario_id WHERE 1=1"""
+        + cond + " ORDER BY " + ORDEN_SERVICIOS + ", ls.id, s.id", params)
+
 @app.route("/servicios/crear", methods=["POST"])
 def crear_servicio():
     if not logged_in(): return redirect(url_for("login"))
@@ -1402,6 +2792,7 @@ def crear_servicio():
         now_sap = datetime.now().strftime("%Y-%m-%d %H:%M")
         llamada_dict = {
             "folio":          folio,
+            "cliente_id":     cliente_id,
             "cliente_nombre": cliente_nombre,
             "item_code":      item_code,
             "item_nombre":    item_nombre,
@@ -1464,16 +2855,9 @@ def detalle_servicio(llamada_id):
     item = None
     if ls.get("item_code"):
         item = query("SELECT * FROM sap_items WHERE item_code=%s",(ls["item_code"],),fetchone=True)
-    # Seriales del artículo
-    seriales = []
-    if ls.get("item_code"):
-        seriales = query("""SELECT serial_number,warehouse_code,status,expiry_date
-                            FROM sap_item_serial WHERE item_code=%s AND serial_number IS NOT NULL
-                            ORDER BY serial_number LIMIT 50""",
-                         (ls["item_code"],), fetchall=True) or []
     tecnicos = query("SELECT id,nombre FROM usuarios WHERE activo=1 ORDER BY nombre",fetchall=True) or []
     return render_template("servicio_detalle.html", empresa=EMPRESA, logo=LOGO,
-                           ls=ls, seguimiento=seguimiento, item=item, seriales=seriales,
+                           ls=ls, seguimiento=seguimiento, item=item,
                            tecnicos=tecnicos, prioridades=PRIORIDADES, estatus_svc=ESTATUS_SVC,
                            color_prio=COLOR_PRIO, color_est=COLOR_EST,
                            bg_prio=BG_PRIO, bg_est=BG_EST)
@@ -1541,20 +2925,88 @@ def buscar_items():
         "price":      float(r["price"] or 0),
     } for r in rows])
 
+# ── Números de serie (réplica SAP) ──
+# Índices de la migración 0010: (item_code, serial_number, warehouse_code) para
+# paginar por artículo y upper(serial_number) COLLATE "C" para buscar una serie
+# exacta o por prefijo en todos los artículos (SERIE_C repite esa expresión).
+SERIALES_MAX = 500
+SERIE_C      = 'upper(s.serial_number) COLLATE "C"'
+
+def _limite_seriales():
+    try: return max(1, min(int(request.args.get("limite", 50)), SERIALES_MAX))
+    except ValueError: return 50
+
+def _prefijo_like(texto):
+    """Escapa los comodines de LIKE para buscar `texto` como prefijo literal."""
+    return texto.upper().replace("\\","\\\\").replace("%","\\%").replace("_","\\_") + "%"
+
 @app.route("/servicios/seriales/<item_code>")
 def seriales_item(item_code):
+    """Series de un artículo en orden; ?q= filtra por prefijo y
+    ?despues_de=<serie>&almacen=<wh> pide la página siguiente."""
     if not logged_in(): return jsonify([])
-    rows = query("""SELECT serial_number, warehouse_code, status
-                    FROM sap_item_serial WHERE item_code=%s
-                    AND serial_number IS NOT NULL
-                    ORDER BY serial_number LIMIT 50""",
-                 (item_code,), fetchall=True) or []
+    sql = """SELECT serial_number, warehouse_code, status
+             FROM sap_item_serial WHERE item_code=%s AND serial_number IS NOT NULL"""
+    params = [item_code]
+    q = request.args.get("q","").strip()
+    if q: sql += " AND upper(serial_number) LIKE %s"; params.append(_prefijo_like(q))
+    if request.args.get("despues_de") is not None:
+        sql += " AND (serial_number,warehouse_code) > (%s,%s)"
+        params += [request.args["despues_de"], request.args.get("almacen","")]
+    sql += " ORDER BY serial_number,warehouse_code LIMIT %s"; params.append(_limite_seriales())
+    rows = query(sql, tuple(params), fetchall=True) or []
     return jsonify([{
         "serial": r["serial_number"],
         "almacen": r["warehouse_code"] or "",
         "status": r["status"] or "",
     } for r in rows])
 
+@app.route("/api/seriales")
+def api_buscar_seriales():
+    """Busca series en todos los artículos: ?q=<prefijo> (o exacto=1), paginado
+    con ?despues_de=<serie>&articulo=<item>&almacen=<wh> (lo que trae `siguiente`):
+    la misma serie puede existir en varios artículos y almacenes."""
+    if not logged_in(): return jsonify({"ok":False,"msg":"No autenticado"}), 401
+    q = request.args.get("q","").strip()
+    if not q: return jsonify({"ok":True,"seriales":[]})
+    if request.args.get("exacto") == "1":
+        cond, params = f"{SERIE_C}=%s", [q.upper()]
+    else:
+        cond, params = f"{SERIE_C} LIKE %s", [_prefijo_like(q)]
+    if request.args.get("despues_de"):
+        # El >= acota el rango en el índice; la tupla desempata
+        despues = request.args["despues_de"].upper()
+        cond += f""" AND {SERIE_C} >= %s
+                     AND ({SERIE_C},s.item_code,COALESCE(s.warehouse_code,'')) > (%s,%s,%s)"""
+        params += [despues, despues, request.args.get("articulo",""), request.args.get("almacen","")]
+    limite = _limite_seriales()
+    rows = query(f"""SELECT s.serial_number,s.item_code,i.item_name,s.warehouse_code,
+                            COALESCE(alm.nombre,'') AS almacen_nombre,s.status,s.expiry_date
+                     FROM sap_item_serial s
+                     LEFT JOIN sap_items i ON i.item_code=s.item_code
+                     LEFT JOIN almacenes alm ON alm.codigo=s.warehouse_code
+                     WHERE s.serial_number IS NOT NULL AND {cond}
+                     ORDER BY {SERIE_C},s.item_code,COALESCE(s.warehouse_code,'')
+                     LIMIT %s""", tuple(params + [limite]), fetchall=True) or []
+    ultimo = rows[-1] if len(rows) == limite else None
+    return jsonify({"ok":True, "seriales":rows,
+                    "siguiente": {"despues_de": ultimo["serial_number"].upper(), "articulo": ultimo["item_code"],
+                                  "almacen": ultimo["warehouse_code"] or ""} if ultimo else None})
+
+@app.route("/api/seriales/<path:serial>")
+def api_serial(serial):
+    """Búsqueda inversa: a qué artículo, almacén y estatus pertenece una serie."""
+    if not logged_in(): return jsonify({"ok":False,"msg":"No autenticado"}), 401
+    rows = query("""SELECT s.serial_number,s.item_code,i.item_name,i.item_group,s.warehouse_code,
+                           COALESCE(alm.nombre,'') AS almacen_nombre,s.status,s.expiry_date
+                    FROM sap_item_serial s
+                    LEFT JOIN sap_items i ON i.item_code=s.item_code
+                    LEFT JOIN almacenes alm ON alm.codigo=s.warehouse_code
+                    WHERE upper(s.serial_number) COLLATE "C"=%s AND s.serial_number IS NOT NULL
+                    ORDER BY s.item_code,s.warehouse_code""", (serial.strip().upper(),), fetchall=True) or []
+    if not rows: return jsonify({"ok":False,"msg":"Serie no encontrada"}), 404
+    return jsonify({"ok":True, "seriales":rows})
+
 
 @app.route("/servicios/<int:llamada_id>/reintentar-sap", methods=["POST"])
 def reintentar_sap(llamada_id):
@@ -1760,6 +3212,7 @@ def sync_almacenes_sap():
                     creados+=1
                 except: actualizados+=1
         sap_logout(s)
+        programar_refresco_stock()
         flash(f"Sincronización SAP: {creados} nuevos, {actualizados} actualizados ✅","success")
     except Exception as e:
         flash(f"Error SAP: {e}","danger")
@@ -1892,36 +3345,74 @@ def buscar_articulos_unificado():
 # ══════════════════════════════════════════════════════════
 # ── INVENTARIO / TOMA DE INVENTARIO ───────────────────────
 # ══════════════════════════════════════════════════════════
+# ── STOCK CONSOLIDADO ──
+# /inventario lee mv_stock_consolidado (migración 0009). Tras cada documento que
+# mueve stock se programa un REFRESH ... CONCURRENTLY con retardo, para juntar
+# ráfagas en un solo refresco; un advisory lock evita refrescos simultáneos
+# entre workers. Tras la sincronización SAP externa: `flask refresh-stock`.
+STOCK_LIMITE      = 1000
+STOCK_MV_LOCK     = 72610042
+STOCK_MV_DEBOUNCE = float(os.environ.get("STOCK_MV_DEBOUNCE", "5"))
+_stock_mv_timer   = None
+_stock_mv_lock    = threading.Lock()
+
+def refrescar_stock_consolidado(esperar=False):
+    """Refresca la vista sin bloquear lecturas. Con esperar=False, si otro
+    proceso ya está refrescando retorna False sin hacer nada."""
+    conn = get_db(); cur = conn.cursor()
+    try:
+        cur.execute("SET LOCAL statement_timeout=0")
+        if esperar:
+            cur.execute("SELECT pg_advisory_xact_lock(%s)", (STOCK_MV_LOCK,))
+        else:
+            cur.execute("SELECT pg_try_advisory_xact_lock(%s) AS ok", (STOCK_MV_LOCK,))
+            if not cur.fetchone()["ok"]: return False
+        cur.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY mv_stock_consolidado")
+        conn.commit()
+        return True
+    finally:
+        cur.close(); conn.close()
+
+def _refresco_programado():
+    global _stock_mv_timer
+    with _stock_mv_lock: _stock_mv_timer = None
+    try:
+        if not refrescar_stock_consolidado(): programar_refresco_stock()
+    except Exception as e:
+        app.logger.warning("No se pudo refrescar mv_stock_consolidado: %s", e)
+
+def programar_refresco_stock():
+    """Pide un refresco de la vista en STOCK_MV_DEBOUNCE s; las peticiones
+    que lleguen mientras tanto se juntan en ese mismo refresco."""
+    global _stock_mv_timer
+    with _stock_mv_lock:
+        if _stock_mv_timer is not None: return
+        _stock_mv_timer = threading.Timer(STOCK_MV_DEBOUNCE, _refresco_programado)
+        _stock_mv_timer.daemon = True
+        _stock_mv_timer.start()
+
+@app.cli.command("refresh-stock")
+def cli_refresh_stock():
+    """Refresca mv_stock_consolidado (correr después de sincronizar SAP)."""
+    refrescar_stock_consolidado(esperar=True)
+    click.echo("Stock consolidado actualizado")
+
 @app.route("/inventario")
 def inventario():
     if not logged_in(): return redirect(url_for("login"))
     almacen_id = request.args.get("almacen_id","")
     q = request.args.get("q","").strip()
 
-    # Stock consolidado
-    base = """SELECT i.*,a.codigo,a.nombre,a.uom,a.grupo,
-              alm.nombre AS almacen_nombre, alm.codigo AS almacen_codigo
-              FROM inventario i
-              JOIN articulos a ON a.id=i.articulo_id
-              JOIN almacenes alm ON alm.id=i.almacen_id
-              WHERE a.activo=true"""
+    # Stock consolidado (portal + SAP) desde la vista materializada
+    base = """SELECT * FROM mv_stock_consolidado WHERE true"""
     params=[]
-    if almacen_id: base+=" AND i.almacen_id=%s"; params.append(almacen_id)
-    if q: base+=" AND (a.codigo ILIKE %s OR a.nombre ILIKE %s)"; params+=[f"%{q}%",f"%{q}%"]
-    base+=" ORDER BY alm.nombre,a.nombre"
+    if almacen_id:
+        base+=" AND almacen_codigo=(SELECT codigo FROM almacenes WHERE id=%s)"; params.append(almacen_id)
+    if q: base+=" AND (item_code ILIKE %s OR nombre ILIKE %s)"; params+=[f"%{q}%",f"%{q}%"]
+    base+=" ORDER BY almacen_nombre,nombre,fuente LIMIT %s"; params.append(STOCK_LIMITE+1)
     stock = query(base,tuple(params),fetchall=True) or []
-
-    # También mostrar SAP stock
-    sap_stock=[]
-    if not almacen_id:
-        try:
-            sap_stock = query("""SELECT w.item_code,i.item_name,w.warehouse_code,
-                                 w.warehouse_name,w.in_stock,w.available
-                                 FROM sap_item_warehouse w
-                                 JOIN sap_items i ON i.item_code=w.item_code
-                                 WHERE w.in_stock > 0
-                                 ORDER BY w.item_code LIMIT 100""",fetchall=True) or []
-        except: pass
+    truncado = len(stock) > STOCK_LIMITE
+    stock = stock[:STOCK_LIMITE]
 
     tomas = query("""SELECT t.*,alm.nombre AS almacen_nombre
                      FROM tomas_inventario t JOIN almacenes alm ON alm.id=t.almacen_id
@@ -1929,9 +3420,241 @@ def inventario():
     almacenes_list = query("SELECT id,codigo,nombre FROM almacenes WHERE activo=true ORDER BY nombre",fetchall=True) or []
 
     return render_template("inventario.html", empresa=EMPRESA, logo=LOGO,
-                           stock=stock, sap_stock=sap_stock, tomas=tomas,
+                           stock=stock, truncado=truncado, tomas=tomas,
                            almacenes=almacenes_list, almacen_id=almacen_id, q=q)
 
+# ── KARDEX (movimientos de inventario) ──
+# Todo cambio de existencia pasa por mover_stock() o cerrar_toma(): se ajusta
+# inventario.stock_actual (el saldo materializado) y se
+# agrega el movimiento con su saldo resultante, en la misma transacción. Los
+# renglones de inventario se bloquean siempre en orden (almacen_id, articulo_id);
+# quien además toca una orden de venta la bloquea antes que al inventario.
+
+def bloquear_inventario(cur, claves):
+    """Bloquea FOR UPDATE los renglones de inventario de `claves` [(articulo_id,
+    almacen_id)] en orden fijo. Retorna {(articulo_id, almacen_id): renglón}."""
+    claves = sorted({(a, w) for a, w in claves if a and w}, key=lambda k: (k[1], k[0]))
+    if not claves: return {}
+    cur.execute("""SELECT i.articulo_id,i.almacen_id,i.stock_actual,i.stock_reservado
+                   FROM inventario i
+                   JOIN unnest(%s::int[],%s::int[]) AS k(articulo_id,almacen_id)
+                     ON i.articulo_id=k.articulo_id AND i.almacen_id=k.almacen_id
+                   ORDER BY i.almacen_id,i.articulo_id FOR UPDATE OF i""",
+                ([a for a, _ in claves], [w for _, w in claves]))
+    return {(r["articulo_id"], r["almacen_id"]): r for r in cur.fetchall()}
+
+def mover_stock(cur, movimientos, tipo, documento, documento_id, now=None):
+    """movimientos = [(articulo_id, almacen_id, cantidad)] con cantidad + entra / - sale.
+    Un solo upsert para todos los renglones y un movimiento por (artículo, almacén)."""
+    from psycopg2.extras import execute_values
+    movimientos = [(a, w, c) for a, w, c in movimientos if a and w and c]
+    if not movimientos: return
+    now = now or datetime.now().strftime("%Y-%m-%d %H:%M")
+    uid = session.get("user_id") if has_request_context() else None
+    execute_values(cur, """
+        WITH v AS (SELECT articulo_id,almacen_id,SUM(cantidad) AS cantidad
+                   FROM (VALUES %s) AS t(articulo_id,almacen_id,cantidad) GROUP BY 1,2),
+        up AS (INSERT INTO inventario (articulo_id,almacen_id,stock_actual,ultima_actualizacion)
+               SELECT articulo_id,almacen_id,cantidad,""" + cur.mogrify("%s",(now,)).decode() + """
+               FROM v ORDER BY almacen_id,articulo_id
+               ON CONFLICT(articulo_id,almacen_id) DO UPDATE
+               SET stock_actual=inventario.stock_actual+EXCLUDED.stock_actual,
+                   ultima_actualizacion=EXCLUDED.ultima_actualizacion
+               RETURNING articulo_id,almacen_id,stock_actual)
+        INSERT INTO inventario_movimientos (articulo_id,almacen_id,tipo,cantidad,saldo,documento,documento_id,usuario_id)
+        SELECT up.articulo_id,up.almacen_id,""" + cur.mogrify("%s,v.cantidad,up.stock_actual,%s,%s,%s",
+                                                             (tipo,documento,documento_id,uid)).decode() + """
+        FROM up JOIN v USING (articulo_id,almacen_id) ORDER BY up.almacen_id,up.articulo_id""",
+        movimientos, template="(%s::int,%s::int,%s::numeric)", page_size=len(movimientos))
+
+# ── RESERVAS ──
+# Una OV confirmada aparta lo que pide en su almacén; stock_reservado es la
+# suma de reservas abiertas del renglón. Las funciones suponen que el llamador
+# ya tiene bloqueada la OV (SELECT ... FOR UPDATE).
+EST_OV_RESERVA = ("confirmada", "en proceso")
+
+class StockInsuficiente(Exception):
+    pass
+
+# Lo ya surtido (remisiones no canceladas) del renglón de OV `oi`, como `s.surtido`
+_SURTIDO_OI = """LEFT JOIN LATERAL (SELECT SUM(ri.cantidad) AS surtido FROM remisiones_items ri
+                                    JOIN remisiones r ON r.id=ri.remision_id AND r.estatus<>'cancelada'
+                                    WHERE ri.orden_item_id=oi.id) s ON true"""
+
+def _faltantes(pedido, inv, propio=None):
+    """Artículos de `pedido` {clave: (codigo, cantidad)} que no alcanzan con lo
+    libre del renglón más lo que ya reservó la propia orden."""
+    propio = propio or {}
+    faltan = []
+    for k, (codigo, cantidad) in pedido.items():
+        r = inv.get(k)
+        libre = float(r["stock_actual"] - r["stock_reservado"]) if r else 0.0
+        libre += propio.get(k, 0.0)
+        if cantidad > libre:
+            faltan.append(f"{codigo} (pide {cantidad:g}, disponible {max(libre,0):g})")
+    return faltan
+
+def reservar_ov(cur, ov_id, now):
+    """Reserva lo pendiente de surtir de la OV en su almacén. Si algo no
+    alcanza no reserva nada y lanza StockInsuficiente."""
+    from psycopg2.extras import execute_values
+    cur.execute(f"""SELECT a.id AS articulo_id,ov.almacen_id,a.codigo,SUM(oi.cantidad-COALESCE(s.surtido,0)) AS cantidad
+                    FROM ordenes_venta ov
+                    JOIN ordenes_venta_items oi ON oi.orden_id=ov.id
+                    JOIN articulos a ON a.codigo=oi.item_code
+                    {_SURTIDO_OI}
+                    WHERE ov.id=%s AND ov.almacen_id IS NOT NULL
+                    GROUP BY a.id,ov.almacen_id,a.codigo HAVING SUM(oi.cantidad-COALESCE(s.surtido,0))>0""", (ov_id,))
+    pedido = {(r["articulo_id"], r["almacen_id"]): (r["codigo"], float(r["cantidad"])) for r in cur.fetchall()}
+    if not pedido: return
+    faltan = _faltantes(pedido, bloquear_inventario(cur, pedido))
+    if faltan: raise StockInsuficiente("Stock insuficiente: " + ", ".join(faltan))
+    filas = [(a, w, c) for (a, w), (_, c) in sorted(pedido.items(), key=lambda x: (x[0][1], x[0][0]))]
+    execute_values(cur, """INSERT INTO inventario_reservas (orden_venta_id,articulo_id,almacen_id,cantidad,fecha)
+                           VALUES %s ON CONFLICT (orden_venta_id,articulo_id,almacen_id)
+                           DO UPDATE SET cantidad=inventario_reservas.cantidad+EXCLUDED.cantidad""",
+                   [(ov_id, a, w, c, now) for a, w, c in filas], page_size=len(filas))
+    execute_values(cur, """UPDATE inventario i SET stock_reservado=i.stock_reservado+v.cantidad
+                           FROM (VALUES %s) AS v(articulo_id,almacen_id,cantidad)
+                           WHERE i.articulo_id=v.articulo_id AND i.almacen_id=v.almacen_id""",
+                   filas, template="(%s::int,%s::int,%s::numeric)", page_size=len(filas))
+
+def reservas_ov(cur, ov_id):
+    cur.execute("SELECT articulo_id,almacen_id,cantidad FROM inventario_reservas WHERE orden_venta_id=%s", (ov_id,))
+    return {(r["articulo_id"], r["almacen_id"]): float(r["cantidad"]) for r in cur.fetchall()}
+
+def consumir_reservas(cur, ov_id, entregado, reservas):
+    """Descuenta de las reservas de la OV lo que sale en una entrega parcial.
+    `entregado` {clave: cantidad}; los renglones de inventario ya están bloqueados."""
+    from psycopg2.extras import execute_values
+    usado = sorted(((a, w, min(c, reservas[(a, w)])) for (a, w), c in entregado.items() if reservas.get((a, w))),
+                   key=lambda f: (f[1], f[0]))
+    if not usado: return
+    valores = dict(template="(%s::int,%s::int,%s::numeric)", page_size=len(usado))
+    execute_values(cur, """UPDATE inventario i SET stock_reservado=i.stock_reservado-v.cantidad
+                           FROM (VALUES %s) AS v(articulo_id,almacen_id,cantidad)
+                           WHERE i.articulo_id=v.articulo_id AND i.almacen_id=v.almacen_id""", usado, **valores)
+    execute_values(cur, f"""DELETE FROM inventario_reservas r USING (VALUES %s) AS v(articulo_id,almacen_id,cantidad)
+                            WHERE r.orden_venta_id={int(ov_id)} AND r.articulo_id=v.articulo_id
+                              AND r.almacen_id=v.almacen_id AND r.cantidad<=v.cantidad""", usado, **valores)
+    execute_values(cur, f"""UPDATE inventario_reservas r SET cantidad=r.cantidad-v.cantidad
+                            FROM (VALUES %s) AS v(articulo_id,almacen_id,cantidad)
+                            WHERE r.orden_venta_id={int(ov_id)} AND r.articulo_id=v.articulo_id
+                              AND r.almacen_id=v.almacen_id""", usado, **valores)
+
+def liberar_reservas(cur, ov_id):
+    """Devuelve al disponible todo lo que la OV tenga reservado."""
+    reservas = reservas_ov(cur, ov_id)
+    if not reservas: return
+    bloquear_inventario(cur, reservas)
+    cur.execute("""UPDATE inventario i SET stock_reservado=i.stock_reservado-r.cantidad
+                   FROM inventario_reservas r
+                   WHERE r.orden_venta_id=%s AND i.articulo_id=r.articulo_id AND i.almacen_id=r.almacen_id""",
+                (ov_id,))
+    cur.execute("DELETE FROM inventario_reservas WHERE orden_venta_id=%s", (ov_id,))
+
+def existencia_a_fecha(cur, hasta, almacen_id=None, articulo_id=None):
+    """Existencia por (artículo, almacén) al momento `hasta`: la foto más
+    reciente anterior + los movimientos posteriores a ella (rango acotado)."""
+    cond, params = "", [hasta, hasta]
+    if almacen_id:  cond += " AND i.almacen_id=%s";  params.append(almacen_id)
+    if articulo_id: cond += " AND i.articulo_id=%s"; params.append(articulo_id)
+    cur.execute(f"""SELECT i.articulo_id,a.codigo,a.nombre,i.almacen_id,alm.nombre AS almacen_nombre,
+                           COALESCE(s.saldo,0)+COALESCE(m.cantidad,0) AS existencia
+                    FROM inventario i
+                    JOIN articulos a ON a.id=i.articulo_id
+                    JOIN almacenes alm ON alm.id=i.almacen_id
+                    LEFT JOIN LATERAL (SELECT saldo,movimiento_id FROM inventario_snapshots
+                                       WHERE articulo_id=i.articulo_id AND almacen_id=i.almacen_id AND fecha<=%s
+                                       ORDER BY fecha DESC LIMIT 1) s ON true
+                    LEFT JOIN LATERAL (SELECT SUM(cantidad) AS cantidad FROM inventario_movimientos
+                                       WHERE articulo_id=i.articulo_id AND almacen_id=i.almacen_id
+                                         AND id > COALESCE(s.movimiento_id,0) AND fecha<=%s) m ON true
+                    WHERE 1=1{cond} ORDER BY alm.nombre,a.nombre""", tuple(params))
+    return cur.fetchall()
+
+def snapshot_inventario(cur):
+    """Foto del saldo de cada (artículo, almacén) con movimientos desde su foto anterior.
+    Debe ser lo primero de una transacción REPEATABLE READ (ver cli_inventario_snapshot)."""
+    # El lock espera a las transacciones con movimientos en curso y frena las nuevas
+    # hasta el commit: ningún id menor que el último visto puede confirmarse después
+    # de la foto (y quedar fuera del saldo y de "id > movimiento_id").
+    cur.execute("LOCK TABLE inventario_movimientos IN SHARE MODE")
+    # statement_timestamp(): ya con el lock; todo movimiento incluido tiene fecha anterior
+    cur.execute("""INSERT INTO inventario_snapshots (articulo_id,almacen_id,fecha,saldo,movimiento_id)
+                   SELECT i.articulo_id,i.almacen_id,statement_timestamp(),i.stock_actual,m.id
+                   FROM inventario i
+                   CROSS JOIN LATERAL (SELECT id FROM inventario_movimientos
+                                       WHERE articulo_id=i.articulo_id AND almacen_id=i.almacen_id
+                                       ORDER BY id DESC LIMIT 1) m
+                   WHERE NOT EXISTS (SELECT 1 FROM inventario_snapshots s
+                                     WHERE s.articulo_id=i.articulo_id AND s.almacen_id=i.almacen_id
+                                       AND s.movimiento_id >= m.id)""")
+    return cur.rowcount
+
+@app.cli.command("inventario-snapshot")
+def cli_inventario_snapshot():
+    """Guarda la foto periódica de saldos del kardex (programar diario en cron)."""
+    conn = get_db(); cur = conn.cursor()
+    try:
+        # REPEATABLE READ: saldos y último movimiento salen de la misma foto de la
+        # base, tomada después del LOCK de snapshot_inventario
+        cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+        n = snapshot_inventario(cur); conn.commit()
+    finally:
+        cur.close(); conn.close()
+    click.echo(f"{n} saldos guardados")
+
+def _fecha_hasta(texto):
+    """'YYYY-MM-DD' → fin de ese día; 'YYYY-MM-DD HH:MM' tal cual; vacío → ahora."""
+    texto = (texto or "").strip()
+    if not texto: return datetime.now()
+    if len(texto) == 10: return datetime.strptime(texto, "%Y-%m-%d") + timedelta(days=1, microseconds=-1)
+    return datetime.fromisoformat(texto)
+
+@app.route("/api/inventario/existencia")
+def api_existencia_a_fecha():
+    """Existencia a una fecha: ?fecha=YYYY-MM-DD[ HH:MM]&almacen_id=&articulo_id="""
+    if not logged_in(): return jsonify({"ok":False,"msg":"No autenticado"}), 401
+    try: hasta = _fecha_hasta(request.args.get("fecha"))
+    except ValueError: return jsonify({"ok":False,"msg":"Fecha inválida"}), 400
+    try:
+        almacen_id  = int(request.args["almacen_id"]) if request.args.get("almacen_id") else None
+        articulo_id = int(request.args["articulo_id"]) if request.args.get("articulo_id") else None
+    except ValueError:
+        return jsonify({"ok":False,"msg":"Parámetros inválidos"}), 400
+    conn = get_db(); cur = conn.cursor()
+    try:
+        filas = existencia_a_fecha(cur, hasta, almacen_id, articulo_id)
+    finally:
+        cur.close(); conn.close()
+    return jsonify({"ok":True, "fecha":hasta.strftime("%Y-%m-%d %H:%M:%S"), "existencias":filas})
+
+@app.route("/api/inventario/kardex/<int:articulo_id>")
+def api_kardex(articulo_id):
+    """Movimientos de un artículo, del más reciente al más antiguo, paginados por id.
+    ?almacen_id=&desde=&hasta=&antes_de=<id>&limite="""
+    if not logged_in(): return jsonify({"ok":False,"msg":"No autenticado"}), 401
+    sql = """SELECT m.id,to_char(m.fecha,'YYYY-MM-DD HH24:MI:SS') AS fecha,m.tipo,m.cantidad,m.saldo,m.documento,m.documento_id,
+                    m.almacen_id,alm.nombre AS almacen_nombre,u.usuario
+             FROM inventario_movimientos m
+             JOIN almacenes alm ON alm.id=m.almacen_id
+             LEFT JOIN usuarios u ON u.id=m.usuario_id
+             WHERE m.articulo_id=%s"""
+    params = [articulo_id]
+    try:
+        limite = max(1, min(int(request.args.get("limite", 100)), 1000))
+        if request.args.get("almacen_id"): sql += " AND m.almacen_id=%s"; params.append(int(request.args["almacen_id"]))
+        if request.args.get("desde"): sql += " AND m.fecha>=%s"; params.append(datetime.fromisoformat(request.args["desde"]))
+        if request.args.get("hasta"): sql += " AND m.fecha<=%s"; params.append(_fecha_hasta(request.args["hasta"]))
+        if request.args.get("antes_de"): sql += " AND m.id<%s"; params.append(int(request.args["antes_de"]))
+    except ValueError:
+        return jsonify({"ok":False,"msg":"Parámetros inválidos"}), 400
+    sql += " ORDER BY m.id DESC LIMIT %s"; params.append(limite)
+    movs = query(sql, tuple(params), fetchall=True) or []
+    return jsonify({"ok":True, "movimientos":movs,
+                    "siguiente": movs[-1]["id"] if len(movs) == limite else None})
+
 @app.route("/inventario/toma/crear", methods=["POST"])
 def crear_toma():
     if not logged_in(): return redirect(url_for("login"))
@@ -1939,26 +3662,28 @@ def crear_toma():
     almacen_id = request.form.get("almacen_id")
     count = query("SELECT COUNT(*) AS c FROM tomas_inventario",fetchone=True)["c"]
     folio = f"INV-{(count+1):04d}"
+    conn = get_db(); cur = conn.cursor()
     try:
-        # Crear toma
-        row = query("""INSERT INTO tomas_inventario (folio,almacen_id,estatus,observaciones,creado_por,fecha_creacion)
+        # Crear toma y precargarla con el stock actual del almacén en un solo INSERT ... SELECT
+        cur.execute("""INSERT INTO tomas_inventario (folio,almacen_id,estatus,observaciones,creado_por,fecha_creacion)
                        VALUES (%s,%s,%s,%s,%s,%s) RETURNING id""",
-                    (folio,almacen_id,"borrador",
-                     request.form.get("observaciones","").strip(),uid,now),
-                    fetchone=True, commit=True)
-        toma_id = row["id"]
-        # Precargar con stock actual del almacén
-        stock = query("""SELECT i.id AS articulo_id,i.stock_actual
-                         FROM inventario i WHERE i.almacen_id=%s""",(almacen_id,),fetchall=True) or []
-        for s in stock:
-            query("""INSERT INTO tomas_inventario_lineas
-                     (toma_id,articulo_id,stock_sistema,stock_contado,diferencia)
-                     VALUES (%s,%s,%s,%s,%s)""",
-                  (toma_id,s["articulo_id"],s["stock_actual"],0,0),commit=True)
-        flash(f"Toma {folio} creada ✅","success")
+                    (folio,almacen_id,"borrador",request.form.get("observaciones","").strip(),uid,now))
+        toma_id = cur.fetchone()["id"]
+        cur.execute("""INSERT INTO tomas_inventario_lineas
+                       (toma_id,articulo_id,stock_sistema,stock_contado,diferencia)
+                       SELECT %s,i.articulo_id,i.stock_actual,0,0
+                       FROM inventario i WHERE i.almacen_id=%s ORDER BY i.articulo_id""",
+                    (toma_id,almacen_id))
+        n = cur.rowcount
+        cur.execute("UPDATE tomas_inventario SET lineas=%s WHERE id=%s",(n,toma_id))
+        conn.commit()
+        flash(f"Toma {folio} creada con {n} artículos ✅","success")
         return redirect(url_for("detalle_toma",toma_id=toma_id))
     except Exception as e:
+        conn.rollback()
         flash(f"Error: {e}","danger"); return redirect(url_for("inventario"))
+    finally:
+        cur.close(); conn.close()
 
 @app.route("/inventario/toma/<int:toma_id>")
 def detalle_toma(toma_id):
@@ -1971,41 +3696,289 @@ def detalle_toma(toma_id):
                       WHERE l.toma_id=%s ORDER BY a.nombre""",(toma_id,),fetchall=True) or []
     return render_template("toma_detalle.html", empresa=EMPRESA, logo=LOGO, toma=toma, lineas=lineas)
 
+def cerrar_toma(cur, toma_id, now):
+    """Aplica los conteos de la toma al inventario (upsert set-based) y la
+    marca cerrada. Corre dentro de la transacción de `cur`; retorna el resumen
+    de diferencias o None si la toma ya estaba cerrada."""
+    cur.execute("""UPDATE tomas_inventario SET estatus='cerrada',fecha_cierre=%s
+                   WHERE id=%s AND estatus<>'cerrada' RETURNING almacen_id""",(now,toma_id))
+    toma = cur.fetchone()
+    if not toma: return None
+    cur.execute("""UPDATE tomas_inventario_lineas SET diferencia=stock_contado-stock_sistema
+                   WHERE toma_id=%s""",(toma_id,))
+    cur.execute("""SELECT COUNT(*) AS articulos,
+                          COUNT(*) FILTER (WHERE diferencia<>0) AS con_diferencia,
+                          COALESCE(SUM(diferencia) FILTER (WHERE diferencia>0),0) AS sobrantes,
+                          COALESCE(-SUM(diferencia) FILTER (WHERE diferencia<0),0) AS faltantes
+                   FROM tomas_inventario_lineas WHERE toma_id=%s""",(toma_id,))
+    resumen = cur.fetchone()
+    # Si un artículo aparece en varias líneas manda la última capturada. Se
+    # crean los renglones faltantes y se bloquean en orden antes de ajustar.
+    lineas = """SELECT DISTINCT ON (l.articulo_id) l.articulo_id,l.stock_contado
+                FROM tomas_inventario_lineas l WHERE l.toma_id=%(toma)s ORDER BY l.articulo_id,l.id DESC"""
+    p = {"toma": toma_id, "alm": toma["almacen_id"], "now": now,
+         "uid": session.get("user_id") if has_request_context() else None}
+    cur.execute(f"""INSERT INTO inventario (articulo_id,almacen_id,stock_actual,ultima_actualizacion)
+                    SELECT articulo_id,%(alm)s,0,%(now)s FROM ({lineas}) l ORDER BY articulo_id
+                    ON CONFLICT(articulo_id,almacen_id) DO NOTHING""", p)
+    cur.execute(f"""SELECT 1 FROM inventario WHERE almacen_id=%(alm)s
+                    AND articulo_id IN (SELECT articulo_id FROM ({lineas}) l)
+                    ORDER BY articulo_id FOR UPDATE""", p)
+    # El self-join `ant` lee el saldo previo; el movimiento es la diferencia contra él.
+    cur.execute(f"""WITH up AS (
+                        UPDATE inventario i SET stock_actual=l.stock_contado,ultima_actualizacion=%(now)s
+                        FROM ({lineas}) l, inventario ant
+                        WHERE i.almacen_id=%(alm)s AND i.articulo_id=l.articulo_id AND ant.id=i.id
+                          AND ant.stock_actual<>l.stock_contado
+                        RETURNING i.articulo_id,i.stock_actual,i.stock_actual-ant.stock_actual AS cantidad)
+                    INSERT INTO inventario_movimientos (articulo_id,almacen_id,tipo,cantidad,saldo,documento,documento_id,usuario_id)
+                    SELECT articulo_id,%(alm)s,'toma',cantidad,stock_actual,'toma',%(toma)s,%(uid)s
+                    FROM up ORDER BY articulo_id""", p)
+    return resumen
+
 @app.route("/inventario/toma/<int:toma_id>/guardar", methods=["POST"])
 def guardar_toma(toma_id):
     if not logged_in(): return redirect(url_for("login"))
+    from psycopg2.extras import execute_values
     accion = request.form.get("accion","guardar")
-    lineas_json = request.form.get("lineas_json","[]")
-    import json as _json
-    try: lineas = _json.loads(lineas_json)
-    except: lineas=[]
-    for l in lineas:
-        contado = float(l.get("contado",0))
-        sistema = float(l.get("sistema",0))
-        diff = contado - sistema
-        query("""UPDATE tomas_inventario_lineas SET stock_contado=%s,diferencia=%s,observacion=%s
-                 WHERE id=%s""",(contado,diff,l.get("obs",""),l.get("id")),commit=True)
+    try:
+        lineas = json.loads(request.form.get("lineas_json","[]"))
+        observaciones = [(int(l["id"]), str(l.get("obs",""))[:500]) for l in lineas]
+        # Un contado vacío (null) no se capturó: la línea sigue pendiente
+        contados = [(int(l["id"]), Decimal(str(l["contado"]))) for l in lineas
+                    if l.get("contado") not in (None, "")]
+        if any(not c.is_finite() for _, c in contados): raise ValueError
+    except (ValueError, TypeError, KeyError, ArithmeticError):
+        flash("Conteos inválidos.","danger"); return redirect(url_for("detalle_toma",toma_id=toma_id))
+    now = datetime.now().strftime("%Y-%m-%d %H:%M")
+    conn = get_db(); cur = conn.cursor()
+    try:
+        cur.execute("SELECT estatus FROM tomas_inventario WHERE id=%s FOR UPDATE",(toma_id,))
+        toma = cur.fetchone()
+        if not toma:
+            conn.rollback(); flash("Toma no encontrada.","danger"); return redirect(url_for("inventario"))
+        if toma["estatus"] == "cerrada":
+            conn.rollback()
+            flash("La toma ya está cerrada; no se aplicaron cambios.","warning")
+            return redirect(url_for("detalle_toma",toma_id=toma_id))
+        if observaciones:
+            execute_values(cur, cur.mogrify("""UPDATE tomas_inventario_lineas l SET observacion=v.obs
+                                               FROM (VALUES %%s) AS v(id,obs)
+                                               WHERE l.id=v.id AND l.toma_id=%s
+                                                 AND l.observacion IS DISTINCT FROM v.obs""", (toma_id,)).decode(),
+                           observaciones, template="(%s::int,%s::text)", page_size=1000)
+        if contados:
+            # El formulario captura el total de la línea: el subtotal del usuario
+            # (modo fijar) absorbe la diferencia contra lo de los demás contadores,
+            # así formulario y escáneres alimentan la misma suma.
+            ids = [r["linea_id"] for r in execute_values(cur, cur.mogrify("""
+                INSERT INTO tomas_inventario_conteos AS c (linea_id,usuario_id,toma_id,cantidad,escaneos,fecha)
+                SELECT l.id,%(uid)s,%(toma)s,v.contado-COALESCE(o.otros,0),1,%(now)s
+                FROM (VALUES %%s) AS v(id,contado)
+                JOIN tomas_inventario_lineas l ON l.id=v.id AND l.toma_id=%(toma)s
+                LEFT JOIN LATERAL (SELECT SUM(cantidad) AS otros FROM tomas_inventario_conteos
+                                   WHERE linea_id=l.id AND usuario_id<>%(uid)s) o ON true
+                WHERE NOT l.contada OR l.stock_contado<>v.contado
+                ORDER BY l.id
+                ON CONFLICT (linea_id,usuario_id) DO UPDATE
+                SET cantidad=EXCLUDED.cantidad,escaneos=c.escaneos+1,fecha=EXCLUDED.fecha
+                RETURNING c.linea_id""", {"uid": session["user_id"], "toma": toma_id, "now": now}).decode(),
+                contados, template="(%s::int,%s::numeric)", page_size=1000, fetch=True)]
+            recalcular_lineas_toma(cur, toma_id, ids)
+        resumen = cerrar_toma(cur, toma_id, now) if accion == "cerrar" else None
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        flash(f"Error guardando la toma: {e}","danger"); return redirect(url_for("detalle_toma",toma_id=toma_id))
+    finally:
+        cur.close(); conn.close()
     if accion == "cerrar":
-        now = datetime.now().strftime("%Y-%m-%d %H:%M")
-        # Aplicar diferencias al inventario
-        lineas_db = query("""SELECT l.*,a.id AS art_id FROM tomas_inventario_lineas l
-                             JOIN articulos a ON a.id=l.articulo_id WHERE l.toma_id=%s""",(toma_id,),fetchall=True) or []
-        toma = query("SELECT almacen_id FROM tomas_inventario WHERE id=%s",(toma_id,),fetchone=True)
-        for l in lineas_db:
-            query("""INSERT INTO inventario (articulo_id,almacen_id,stock_actual,ultima_actualizacion)
-                     VALUES (%s,%s,%s,%s)
-                     ON CONFLICT(articulo_id,almacen_id) DO UPDATE
-                     SET stock_actual=%s,ultima_actualizacion=%s""",
-                  (l["art_id"],toma["almacen_id"],l["stock_contado"],now,
-                   l["stock_contado"],now),commit=True)
-        query("UPDATE tomas_inventario SET estatus='cerrada',fecha_cierre=%s WHERE id=%s",
-              (now,toma_id),commit=True)
-        flash("Toma cerrada y stock actualizado ✅","success")
+        programar_refresco_stock()
+        flash(f"Toma cerrada y stock actualizado ✅ {resumen['articulos']} artículos, "
+              f"{resumen['con_diferencia']} con diferencia (sobrante {float(resumen['sobrantes']):g}, "
+              f"faltante {float(resumen['faltantes']):g})","success")
         return redirect(url_for("inventario"))
     flash("Conteos guardados","success")
     return redirect(url_for("detalle_toma",toma_id=toma_id))
 
 
+# ── API de conteo incremental (escáneres) ──
+# Cada contador acumula su propio subtotal por línea (tomas_inventario_conteos)
+# y stock_contado es la suma de todos. Los lotes llevan una clave de
+# idempotencia: reenviar el mismo lote devuelve la respuesta original.
+CONTEO_MAX_LOTE = 500
+
+def progreso_toma(cur, toma_id, lineas=0, contadas=0):
+    """Avance desde los contadores del encabezado, sumándoles antes las líneas
+    agregadas y las recién contadas de esta transacción."""
+    if lineas or contadas:
+        cur.execute("""UPDATE tomas_inventario SET lineas=lineas+%s,contadas=contadas+%s
+                       WHERE id=%s RETURNING lineas,contadas""",(lineas,contadas,toma_id))
+    else:
+        cur.execute("SELECT lineas,contadas FROM tomas_inventario WHERE id=%s",(toma_id,))
+    p = cur.fetchone()
+    return {"lineas": p["lineas"], "contadas": p["contadas"],
+            "porcentaje": round(100.0 * p["contadas"] / p["lineas"], 1) if p["lineas"] else 0.0}
+
+def recalcular_lineas_toma(cur, toma_id, lineas_ids, lineas_nuevas=0):
+    """stock_contado = suma de los subtotales de todos los contadores, sólo en
+    las líneas tocadas; las que pasan a contadas suben el contador de la toma.
+    Retorna (filas recalculadas, progreso)."""
+    cur.execute("""UPDATE tomas_inventario_lineas l
+                   SET stock_contado=s.total,diferencia=s.total-l.stock_sistema,contada=true
+                   FROM (SELECT linea_id,SUM(cantidad) AS total FROM tomas_inventario_conteos
+                         WHERE linea_id = ANY(%s) GROUP BY linea_id) s, tomas_inventario_lineas ant
+                   WHERE l.id=s.linea_id AND ant.id=l.id
+                   RETURNING l.id AS linea_id,l.articulo_id,l.stock_sistema,l.stock_contado,l.diferencia,
+                             NOT ant.contada AS recien_contada""",
+                (lineas_ids,))
+    filas = cur.fetchall()
+    nuevas = sum(1 for r in filas if r.pop("recien_contada"))
+    return filas, progreso_toma(cur, toma_id, lineas_nuevas, nuevas)
+
+@app.route("/api/tomas/<int:toma_id>")
+def api_toma(toma_id):
+    if not logged_in(): return jsonify({"ok":False,"msg":"No autenticado"}), 401
+    conn = get_db(); cur = conn.cursor()
+    try:
+        cur.execute("""SELECT t.id,t.folio,t.estatus,t.almacen_id,alm.nombre AS almacen_nombre,t.fecha_creacion
+                       FROM tomas_inventario t JOIN almacenes alm ON alm.id=t.almacen_id WHERE t.id=%s""",(toma_id,))
+        toma = cur.fetchone()
+        if not toma: return jsonify({"ok":False,"msg":"Toma no encontrada"}), 404
+        progreso = progreso_toma(cur, toma_id)
+        cur.execute("""SELECT u.usuario,COUNT(*) AS lineas,SUM(c.escaneos) AS escaneos
+                       FROM tomas_inventario_conteos c JOIN usuarios u ON u.id=c.usuario_id
+                       WHERE c.toma_id=%s GROUP BY u.usuario ORDER BY u.usuario""",(toma_id,))
+        contadores = cur.fetchall()
+    finally:
+        cur.close(); conn.close()
+    return jsonify({"ok":True, "toma":toma, "progreso":progreso, "contadores":contadores})
+
+@app.route("/api/tomas/<int:toma_id>/lineas")
+def api_toma_lineas(toma_id):
+    """Líneas de la toma paginadas por id (?despues_de=<id>&limite=), o ?codigo=."""
+    if not logged_in(): return jsonify({"ok":False,"msg":"No autenticado"}), 401
+    try:
+        limite = max(1, min(int(request.args.get("limite", 200)), 1000))
+        despues_de = int(request.args.get("despues_de", 0))
+    except ValueError:
+        return jsonify({"ok":False,"msg":"Parámetros inválidos"}), 400
+    sql = """SELECT l.id,a.codigo,a.nombre,a.uom,l.stock_sistema,l.stock_contado,l.diferencia,l.contada
+             FROM tomas_inventario_lineas l JOIN articulos a ON a.id=l.articulo_id WHERE l.toma_id=%s"""
+    params = [toma_id]
+    if request.args.get("codigo"):
+        sql += " AND a.codigo=%s"; params.append(request.args["codigo"].strip())
+    if request.args.get("pendientes") == "1":
+        sql += " AND NOT l.contada"
+    sql += " AND l.id > %s ORDER BY l.id LIMIT %s"
+    params += [despues_de, limite]
+    lineas = query(sql, tuple(params), fetchall=True) or []
+    return jsonify({"ok":True, "lineas":lineas,
+                    "siguiente": lineas[-1]["id"] if len(lineas) == limite else None})
+
+def _consolidar_conteos(conteos):
+    """[{codigo,cantidad,modo}] → {codigo: (modo, cantidad)} respetando el orden:
+    'fijar' reemplaza lo acumulado por el contador y 'sumar' agrega."""
+    por_codigo = {}
+    for c in conteos:
+        codigo = str(c.get("codigo") or "").strip()
+        if not codigo: raise ValueError("Cada conteo necesita 'codigo'")
+        cantidad = Decimal(str(c.get("cantidad", 1)))
+        if cantidad.is_nan() or cantidad.is_infinite(): raise ValueError(f"Cantidad inválida para {codigo}")
+        modo = c.get("modo", "sumar")
+        if modo not in ("sumar", "fijar"): raise ValueError(f"Modo inválido: {modo}")
+        previo = por_codigo.get(codigo)
+        if modo == "fijar" or previo is None: por_codigo[codigo] = (modo, cantidad)
+        else: por_codigo[codigo] = (previo[0], previo[1] + cantidad)
+    return por_codigo
+
+@app.route("/api/tomas/<int:toma_id>/conteos", methods=["POST"])
+def api_toma_conteos(toma_id):
+    """Registra conteos: {"clave": "<idempotencia>", "conteos": [{"codigo", "cantidad", "modo"}]}.
+    Un escaneo es un lote de un elemento. El costo depende del lote, no del tamaño de la toma."""
+    if not logged_in(): return jsonify({"ok":False,"msg":"No autenticado"}), 401
+    from psycopg2.extras import execute_values
+    data  = request.get_json(silent=True) or {}
+    clave = str(data.get("clave") or "").strip()[:100]
+    conteos = data.get("conteos") or []
+    if not clave: return jsonify({"ok":False,"msg":"Falta 'clave' (idempotencia)"}), 400
+    if not isinstance(conteos, list) or not 0 < len(conteos) <= CONTEO_MAX_LOTE:
+        return jsonify({"ok":False,"msg":f"Envía entre 1 y {CONTEO_MAX_LOTE} conteos"}), 400
+    try: por_codigo = _consolidar_conteos(conteos)
+    except (ValueError, ArithmeticError) as e: return jsonify({"ok":False,"msg":str(e)}), 400
+    uid = session["user_id"]; now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    conn = get_db(); cur = conn.cursor()
+    try:
+        # FOR KEY SHARE: los contadores no se bloquean entre sí (sólo al sumar al
+        # avance del encabezado), pero el guardado/cierre (FOR UPDATE) espera.
+        cur.execute("SELECT estatus,almacen_id FROM tomas_inventario WHERE id=%s FOR KEY SHARE",(toma_id,))
+        toma = cur.fetchone()
+        if not toma: conn.rollback(); return jsonify({"ok":False,"msg":"Toma no encontrada"}), 404
+        cur.execute("""INSERT INTO tomas_inventario_lotes (toma_id,clave,usuario_id,fecha) VALUES (%s,%s,%s,%s)
+                       ON CONFLICT (toma_id,clave) DO NOTHING""",(toma_id,clave,uid,now))
+        if cur.rowcount == 0:
+            cur.execute("SELECT respuesta FROM tomas_inventario_lotes WHERE toma_id=%s AND clave=%s",(toma_id,clave))
+            previa = json.loads(cur.fetchone()["respuesta"] or '{"ok":true}')
+            conn.rollback()
+            return jsonify(dict(previa, repetido=True))
+        if toma["estatus"] == "cerrada":
+            conn.rollback(); return jsonify({"ok":False,"msg":"La toma ya está cerrada"}), 409
+        cur.execute("SELECT id,codigo FROM articulos WHERE codigo = ANY(%s)",(list(por_codigo),))
+        articulos = {r["codigo"]: r["id"] for r in cur.fetchall()}
+        desconocidos = sorted(set(por_codigo) - set(articulos))
+        # Artículos sin línea en la toma (encontrados en el piso): se agregan con su stock de sistema.
+        cur.execute("""SELECT a.id FROM unnest(%s::int[]) AS a(id)
+                       WHERE NOT EXISTS (SELECT 1 FROM tomas_inventario_lineas l
+                                         WHERE l.toma_id=%s AND l.articulo_id=a.id) ORDER BY a.id""",
+                    (list(articulos.values()),toma_id))
+        nuevos = [r["id"] for r in cur.fetchall()]
+        for art_id in nuevos:   # orden fijo: sin interbloqueos entre contadores
+            cur.execute("SELECT pg_advisory_xact_lock(%s,%s)",(toma_id,art_id))
+        if nuevos:
+            cur.execute("""INSERT INTO tomas_inventario_lineas (toma_id,articulo_id,stock_sistema,stock_contado,diferencia)
+                           SELECT %s,a.id,COALESCE(i.stock_actual,0),0,-COALESCE(i.stock_actual,0)
+                           FROM unnest(%s::int[]) AS a(id)
+                           LEFT JOIN inventario i ON i.articulo_id=a.id AND i.almacen_id=%s
+                           WHERE NOT EXISTS (SELECT 1 FROM tomas_inventario_lineas l
+                                             WHERE l.toma_id=%s AND l.articulo_id=a.id)""",
+                        (toma_id,nuevos,toma["almacen_id"],toma_id))
+            agregadas = cur.rowcount
+        else:
+            agregadas = 0
+        filas = {"sumar": [], "fijar": []}
+        for codigo, (modo, cantidad) in por_codigo.items():
+            if codigo in articulos: filas[modo].append((articulos[codigo], cantidad))
+        lineas_ids = []
+        for modo, valores in filas.items():
+            if not valores: continue
+            nuevo = "EXCLUDED.cantidad" if modo == "fijar" else "c.cantidad+EXCLUDED.cantidad"
+            lineas_ids += [r["linea_id"] for r in execute_values(cur, cur.mogrify(f"""
+                INSERT INTO tomas_inventario_conteos AS c (linea_id,usuario_id,toma_id,cantidad,escaneos,fecha)
+                SELECT l.id,%(uid)s,%(toma)s,v.cantidad,1,%(now)s
+                FROM (VALUES %%s) AS v(articulo_id,cantidad)
+                JOIN LATERAL (SELECT id FROM tomas_inventario_lineas
+                              WHERE toma_id=%(toma)s AND articulo_id=v.articulo_id
+                              ORDER BY id LIMIT 1) l ON true
+                ORDER BY l.id
+                ON CONFLICT (linea_id,usuario_id) DO UPDATE
+                SET cantidad={nuevo},escaneos=c.escaneos+1,fecha=EXCLUDED.fecha
+                RETURNING c.linea_id""", {"uid": uid, "toma": toma_id, "now": now}).decode(),
+                valores, template="(%s::int,%s::numeric)", fetch=True)]
+        filas_rec, progreso = recalcular_lineas_toma(cur, toma_id, lineas_ids, agregadas)
+        codigos = {v: k for k, v in articulos.items()}
+        lineas = [dict(r, codigo=codigos[r.pop("articulo_id")]) for r in filas_rec]
+        respuesta = {"ok":True, "aplicados":len(lineas), "agregadas":len(nuevos),
+                     "desconocidos":desconocidos, "lineas":lineas}
+        cur.execute("UPDATE tomas_inventario_lotes SET respuesta=%s WHERE toma_id=%s AND clave=%s",
+                    (json.dumps(respuesta, default=str),toma_id,clave))
+        respuesta["progreso"] = progreso
+        conn.commit()
+    except Exception as e:
+        conn.rollback(); return jsonify({"ok":False,"msg":f"Error registrando conteos: {e}"}), 500
+    finally:
+        cur.close(); conn.close()
+    return jsonify(respuesta)
+
 # ══════════════════════════════════════════════════════════
 # ── ÓRDENES DE COMPRA ─────────────────────────────────────
 # ══════════════════════════════════════════════════════════
@@ -2041,19 +4014,24 @@ def sap_crear_orden_compra(oc, items):
     finally:
         sap_logout(s)
 
+def _filtro_compras():
+    fil_est = request.args.get("estatus",""); q = request.args.get("q","").strip()
+    cond, params = "", []
+    if fil_est: cond+=" AND oc.estatus=%s"; params.append(fil_est)
+    if q: cond+=" AND (oc.folio ILIKE %s OR oc.proveedor_nombre ILIKE %s)"; params+=[f"%{q}%",f"%{q}%"]
+    return cond, params
+
 @app.route("/compras")
 def compras():
     if not logged_in(): return redirect(url_for("login"))
     fil_est = request.args.get("estatus","")
     q = request.args.get("q","").strip()
+    cond, params = _filtro_compras()
     base = """SELECT oc.*,u.nombre AS creador_nombre,alm.nombre AS almacen_nombre
               FROM ordenes_compra oc
               LEFT JOIN usuarios u ON u.id=oc.creado_por
               LEFT JOIN almacenes alm ON alm.id=oc.almacen_id
-              WHERE 1=1"""
-    params=[]
-    if fil_est: base+=" AND oc.estatus=%s"; params.append(fil_est)
-    if q: base+=" AND (oc.folio ILIKE %s OR oc.proveedor_nombre ILIKE %s)"; params+=[f"%{q}%",f"%{q}%"]
+              WHERE 1=1"""+cond
     base+=" ORDER BY oc.fecha_creacion DESC"
     lista = query(base,tuple(params),fetchall=True) or []
     almacenes_list = query("SELECT id,codigo,nombre FROM almacenes WHERE activo=true ORDER BY nombre",fetchall=True) or []
@@ -2061,6 +4039,22 @@ def compras():
                            ordenes=lista, estatus_oc=EST_OC,
                            almacenes=almacenes_list, fil_est=fil_est, q=q)
 
+@app.route("/compras/exportar")
+def exportar_compras():
+    if not logged_in(): return redirect(url_for("login"))
+    cond, params = _filtro_compras()
+    return respuesta_export("compras",
+        ["Folio","Fecha","Proveedor","Estatus","Almacén","Moneda","Subtotal","Impuesto","Total",
+         "Entrega","Creada por","Código","Artículo","UdM","Cantidad","Precio unitario","Importe"],
+        """SELECT oc.folio,oc.fecha_creacion,oc.proveedor_nombre,oc.estatus,alm.nombre,oc.moneda,
+                  oc.subtotal,oc.impuesto,oc.total,oc.fecha_entrega,u.nombre,
+                  i.item_code,i.item_nombre,i.uom,i.cantidad,i.precio_unitario,i.subtotal
+           FROM ordenes_compra oc
+           LEFT JOIN usuarios u ON u.id=oc.creado_por
+           LEFT JOIN almacenes alm ON alm.id=oc.almacen_id
+           LEFT JOIN ordenes_compra_items i ON i.orden_id=oc.id WHERE 1=1"""
+        + cond + " ORDER BY oc.fecha_creacion DESC, oc.id, i.id", params)
+
 @app.route("/compras/crear", methods=["POST"])
 def crear_orden_compra():
     if not logged_in(): return redirect(url_for("login"))
@@ -2073,9 +4067,9 @@ def crear_orden_compra():
     if not items:
         flash("Agrega al menos un artículo.","danger"); return redirect(url_for("compras"))
 
-    subtotal = sum(float(i["cantidad"])*float(i["precio_unitario"]) for i in items)
-    impuesto = round(subtotal*0.16,2)
-    total    = round(subtotal+impuesto,2)
+    try: lineas, tot = calcular_totales(items)
+    except ValueError as e:
+        flash(str(e),"danger"); return redirect(url_for("compras"))
     folio    = gen_folio_oc()
     proveedor_id     = request.form.get("proveedor_id") or None
     proveedor_nombre = request.form.get("proveedor_nombre","").strip()
@@ -2090,26 +4084,17 @@ def crear_orden_compra():
              notas,fecha_entrega,sap_sync_status,creado_por,fecha_creacion,fecha_actualizacion)
             VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s) RETURNING id""",
             (folio,proveedor_id,proveedor_nombre,"borrador",almacen_id,"MXN",
-             subtotal,impuesto,total,notas,fecha_entrega,"pendiente",uid,now,now))
+             tot["subtotal"],tot["impuesto"],tot["total"],notas,fecha_entrega,"pendiente",uid,now,now))
         oc_id = cur.fetchone()["id"]
-        for it in items:
-            sub = round(float(it["cantidad"])*float(it["precio_unitario"]),2)
-            cur.execute("""INSERT INTO ordenes_compra_items
-                (orden_id,item_code,item_nombre,uom,cantidad,precio_unitario,subtotal)
-                VALUES (%s,%s,%s,%s,%s,%s,%s)""",
-                (oc_id,it["codigo"],it["nombre"],it.get("uom",""),
-                 float(it["cantidad"]),float(it["precio_unitario"]),sub))
+        insertar_filas(cur, "ordenes_compra_items",
+                       ("orden_id","item_code","item_nombre","uom","cantidad","precio_unitario","subtotal"),
+                       [(oc_id,it["codigo"],it["nombre"],it.get("uom",""),cant,pu,importe)
+                        for it,(cant,pu,_,importe) in zip(items,lineas)])
         conn.commit(); cur.close(); conn.close()
 
         # SAP
         almacen = query("SELECT codigo FROM almacenes WHERE id=%s",(almacen_id,),fetchone=True) if almacen_id else None
-        # Buscar CardCode del proveedor
-        prov_row = query("SELECT notas FROM clientes WHERE id=%s",(proveedor_id,),fetchone=True) if proveedor_id else None
-        card_code=""
-        if prov_row and prov_row.get("notas"):
-            import re
-            m=re.search(r"SAP CardCode:\s*(\S+)",prov_row["notas"] or "")
-            if m: card_code=m.group(1)
+        card_code=resolver_card_code(proveedor_id,proveedor_nombre)
 
         oc_data={"proveedor_cardcode":card_code,"fecha_entrega":fecha_entrega,
                  "notas":notas,"almacen_codigo":almacen["codigo"] if almacen else ""}
@@ -2207,26 +4192,22 @@ def crear_entrada(oc_id):
              request.form.get("notas","").strip(),
              "pendiente",uid,now,now))
         ent_id=cur.fetchone()["id"]
-        for it in items:
-            recibido=float(it.get("recibido",0))
-            cur.execute("""INSERT INTO entradas_mercancia_items
-                (entrada_id,item_code,item_nombre,uom,cantidad_pedida,cantidad_recibida,precio_unitario,numero_serie,numero_lote)
-                VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s)""",
-                (ent_id,it["codigo"],it["nombre"],it.get("uom",""),
-                 float(it.get("pedido",0)),recibido,
-                 float(it.get("precio",0)),it.get("serie",""),it.get("lote","")))
-            # Actualizar stock
-            if almacen_id and recibido>0:
-                art=query("SELECT id FROM articulos WHERE codigo=%s",(it["codigo"],),fetchone=True)
-                if art:
-                    cur.execute("""INSERT INTO inventario (articulo_id,almacen_id,stock_actual,ultima_actualizacion)
-                                   VALUES (%s,%s,%s,%s)
-                                   ON CONFLICT(articulo_id,almacen_id) DO UPDATE
-                                   SET stock_actual=inventario.stock_actual+%s,ultima_actualizacion=%s""",
-                                (art["id"],almacen_id,recibido,now,recibido,now))
+        insertar_filas(cur, "entradas_mercancia_items",
+                       ("entrada_id","item_code","item_nombre","uom","cantidad_pedida","cantidad_recibida",
+                        "precio_unitario","numero_serie","numero_lote"),
+                       [(ent_id,it["codigo"],it["nombre"],it.get("uom",""),
+                         float(it.get("pedido",0)),float(it.get("recibido",0)),
+                         float(it.get("precio",0)),it.get("serie",""),it.get("lote","")) for it in items])
+        # Actualizar stock
+        if almacen_id:
+            ids=ids_articulos(cur,[it["codigo"] for it in items])
+            mover_stock(cur,[(ids.get(it["codigo"]),int(almacen_id),float(it.get("recibido",0)))
+                             for it in items if float(it.get("recibido",0))>0],
+                        "entrada","entrada",ent_id,now)
         # Actualizar estatus OC
         cur.execute("UPDATE ordenes_compra SET estatus='recibida',fecha_actualizacion=%s WHERE id=%s",(now,oc_id))
         conn.commit(); cur.close(); conn.close()
+        programar_refresco_stock()
 
         # SAP
         almacen=query("SELECT codigo FROM almacenes WHERE id=%s",(almacen_id,),fetchone=True) if almacen_id else None
@@ -2278,32 +4259,53 @@ def sap_crear_orden_venta(ov,items):
     except Exception as e: return False,str(e),None
     finally: sap_logout(s)
 
+def _filtro_ventas():
+    fil_est=request.args.get("estatus",""); q=request.args.get("q","").strip()
+    cond, params = "", []
+    if not can_see_all() and session["rol"]!="supervisor":
+        cond+=" AND ov.creado_por=%s"; params.append(session["user_id"])
+    if fil_est: cond+=" AND ov.estatus=%s"; params.append(fil_est)
+    if q: cond+=" AND (ov.folio ILIKE %s OR ov.cliente_nombre ILIKE %s)"; params+=[f"%{q}%",f"%{q}%"]
+    return cond, params
+
 @app.route("/ventas")
 def ventas():
     if not logged_in(): return redirect(url_for("login"))
-    uid=session["user_id"]; rol=session["rol"]
     fil_est=request.args.get("estatus",""); q=request.args.get("q","").strip()
+    cond, params = _filtro_ventas()
     base="""SELECT ov.*,u.nombre AS creador_nombre,alm.nombre AS almacen_nombre
             FROM ordenes_venta ov
             LEFT JOIN usuarios u ON u.id=ov.creado_por
-            LEFT JOIN almacenes alm ON alm.id=ov.almacen_id WHERE 1=1"""
-    params=[]
-    if not can_see_all() and rol!="supervisor":
-        base+=" AND ov.creado_por=%s"; params.append(uid)
-    if fil_est: base+=" AND ov.estatus=%s"; params.append(fil_est)
-    if q: base+=" AND (ov.folio ILIKE %s OR ov.cliente_nombre ILIKE %s)"; params+=[f"%{q}%",f"%{q}%"]
+            LEFT JOIN almacenes alm ON alm.id=ov.almacen_id WHERE 1=1"""+cond
     base+=" ORDER BY ov.fecha_creacion DESC"
     lista=query(base,tuple(params),fetchall=True) or []
     almacenes_list=query("SELECT id,codigo,nombre FROM almacenes WHERE activo=true ORDER BY nombre",fetchall=True) or []
     cots_pendientes=query("""SELECT c.id,c.folio,c.cliente_nombre,c.total
                               FROM cotizaciones c WHERE c.estatus='aceptada'
-                              AND c.id NOT IN (SELECT cotizacion_id FROM ordenes_venta WHERE cotizacion_id IS NOT NULL)
+                              AND NOT EXISTS (SELECT 1 FROM ordenes_venta ov WHERE ov.cotizacion_id=c.id)
                               ORDER BY c.fecha_creacion DESC LIMIT 20""",fetchall=True) or []
     return render_template("ventas.html", empresa=EMPRESA, logo=LOGO,
                            ordenes=lista, estatus_ov=EST_OV,
                            almacenes=almacenes_list, cots_pendientes=cots_pendientes,
                            fil_est=fil_est, q=q)
 
+@app.route("/ventas/exportar")
+def exportar_ventas():
+    if not logged_in(): return redirect(url_for("login"))
+    cond, params = _filtro_ventas()
+    return respuesta_export("ventas",
+        ["Folio","Fecha","Cliente","Estatus","Almacén","Moneda","Subtotal","Descuento","Impuesto",
+         "Total","Entrega","Creada por","Código","Artículo","UdM","Cantidad","Precio unitario",
+         "Desc. %","Importe"],
+        """SELECT ov.folio,ov.fecha_creacion,ov.cliente_nombre,ov.estatus,alm.nombre,ov.moneda,
+                  ov.subtotal,ov.descuento_monto,ov.impuesto,ov.total,ov.fecha_entrega,u.nombre,
+                  i.item_code,i.item_nombre,i.uom,i.cantidad,i.precio_unitario,i.descuento,i.subtotal
+           FROM ordenes_venta ov
+           LEFT JOIN usuarios u ON u.id=ov.creado_por
+           LEFT JOIN almacenes alm ON alm.id=ov.almacen_id
+           LEFT JOIN ordenes_venta_items i ON i.orden_id=ov.id WHERE 1=1"""
+        + cond + " ORDER BY ov.fecha_creacion DESC, ov.id, i.id", params)
+
 @app.route("/ventas/crear", methods=["POST"])
 def crear_orden_venta():
     if not logged_in(): return redirect(url_for("login"))
@@ -2316,8 +4318,9 @@ def crear_orden_venta():
     if not items:
         flash("Agrega al menos un artículo.","danger"); return redirect(url_for("ventas"))
 
-    subtotal=sum(float(i["cantidad"])*float(i["precio_unitario"])*(1-float(i.get("descuento",0))/100) for i in items)
-    impuesto=round(subtotal*0.16,2); total=round(subtotal+impuesto,2)
+    try: lineas,tot=calcular_totales(items)
+    except ValueError as e:
+        flash(str(e),"danger"); return redirect(url_for("ventas"))
     folio=gen_folio_ov()
     cliente_id=request.form.get("cliente_id") or None
     cliente_nombre=request.form.get("cliente_nombre","").strip()
@@ -2333,25 +4336,18 @@ def crear_orden_venta():
              subtotal,impuesto,total,notas,fecha_entrega,sap_sync_status,creado_por,fecha_creacion,fecha_actualizacion)
             VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s) RETURNING id""",
             (folio,cotizacion_id,cliente_id,cliente_nombre,almacen_id,"borrador","MXN",
-             subtotal,impuesto,total,notas,fecha_entrega,"pendiente",uid,now,now))
+             tot["subtotal"],tot["impuesto"],tot["total"],notas,fecha_entrega,"pendiente",uid,now,now))
         ov_id=cur.fetchone()["id"]
-        for it in items:
-            sub=round(float(it["cantidad"])*float(it["precio_unitario"])*(1-float(it.get("descuento",0))/100),2)
-            cur.execute("""INSERT INTO ordenes_venta_items
-                (orden_id,item_code,item_nombre,uom,cantidad,precio_unitario,descuento,subtotal)
-                VALUES (%s,%s,%s,%s,%s,%s,%s,%s)""",
-                (ov_id,it["codigo"],it["nombre"],it.get("uom",""),
-                 float(it["cantidad"]),float(it["precio_unitario"]),float(it.get("descuento",0)),sub))
+        insertar_filas(cur, "ordenes_venta_items",
+                       ("orden_id","item_code","item_nombre","uom","cantidad","precio_unitario","descuento","subtotal"),
+                       [(ov_id,it["codigo"],it["nombre"],it.get("uom",""))+linea for it,linea in zip(items,lineas)])
+        marcar_reportes(cur, ordenes=[ov_id])
         conn.commit(); cur.close(); conn.close()
+        programar_refresco_reportes()
 
         # SAP
         almacen=query("SELECT codigo FROM almacenes WHERE id=%s",(almacen_id,),fetchone=True) if almacen_id else None
-        import re
-        cli=query("SELECT notas FROM clientes WHERE id=%s",(cliente_id,),fetchone=True) if cliente_id else None
-        card_code=""
-        if cli and cli.get("notas"):
-            m=re.search(r"SAP CardCode:\s*(\S+)",cli["notas"] or "")
-            if m: card_code=m.group(1)
+        card_code=resolver_card_code(cliente_id,cliente_nombre)
         ov_data={"cliente_cardcode":card_code,"fecha_entrega":fecha_entrega,
                  "notas":notas,"almacen_codigo":almacen["codigo"] if almacen else ""}
         sap_ok,sap_msg,sap_de=sap_crear_orden_venta(ov_data,items)
@@ -2364,6 +4360,62 @@ def crear_orden_venta():
     except Exception as e:
         flash(f"Error: {e}","danger"); return redirect(url_for("ventas"))
 
+@app.route("/cotizaciones/<int:cotizacion_id>/convertir-ov", methods=["POST"])
+def convertir_cotizacion_ov(cotizacion_id):
+    """OV a partir de una cotización aceptada: encabezado y renglones se copian
+    con INSERT ... SELECT. Una cotización sólo genera una OV."""
+    if not logged_in(): return redirect(url_for("login"))
+    if not tiene_permiso("crear","ventas"): abort(403)
+    uid=session["user_id"]; now=datetime.now().strftime("%Y-%m-%d %H:%M")
+    almacen_id=request.form.get("almacen_id") or None
+    fecha_entrega=request.form.get("fecha_entrega","").strip()
+    folio=gen_folio_ov()
+    conn=get_db(); cur=conn.cursor()
+    try:
+        # El bloqueo de la cotización serializa dos conversiones simultáneas
+        cur.execute("SELECT estatus FROM cotizaciones WHERE id=%s FOR UPDATE",(cotizacion_id,))
+        cot=cur.fetchone()
+        if not cot: abort(404)
+        cur.execute("SELECT id,folio FROM ordenes_venta WHERE cotizacion_id=%s LIMIT 1",(cotizacion_id,))
+        existente=cur.fetchone()
+        if existente or cot["estatus"]!="aceptada":
+            conn.rollback()
+            flash(f"La cotización ya tiene la OV {existente['folio']}." if existente
+                  else "Sólo una cotización aceptada se convierte en OV.","warning")
+            return redirect(url_for("detalle_venta",ov_id=existente["id"]) if existente
+                            else url_for("detalle_cotizacion",cotizacion_id=cotizacion_id))
+        cur.execute("""INSERT INTO ordenes_venta
+            (folio,cotizacion_id,cliente_id,cliente_nombre,almacen_id,estatus,moneda,
+             subtotal,descuento_monto,impuesto,total,notas,fecha_entrega,sap_sync_status,
+             creado_por,fecha_creacion,fecha_actualizacion)
+            SELECT %s,id,cliente_id,cliente_nombre,%s,'borrador',moneda,
+                   subtotal,descuento_monto,impuesto,total,notas,%s,'pendiente',%s,%s,%s
+            FROM cotizaciones WHERE id=%s RETURNING id""",
+            (folio,almacen_id,fecha_entrega,uid,now,now,cotizacion_id))
+        ov_id=cur.fetchone()["id"]
+        cur.execute("""INSERT INTO ordenes_venta_items
+            (orden_id,item_code,item_nombre,uom,cantidad,precio_unitario,descuento,subtotal)
+            SELECT %s,item_code,item_nombre,uom,cantidad,precio_unitario,descuento,subtotal
+            FROM cotizaciones_items WHERE cotizacion_id=%s ORDER BY id""",(ov_id,cotizacion_id))
+        marcar_reportes(cur, ordenes=[ov_id])
+        conn.commit(); programar_refresco_reportes()
+    finally:
+        cur.close(); conn.close()
+
+    # SAP
+    ov=query("""SELECT ov.cliente_id,ov.cliente_nombre,ov.notas,alm.codigo AS almacen_codigo
+                FROM ordenes_venta ov LEFT JOIN almacenes alm ON alm.id=ov.almacen_id
+                WHERE ov.id=%s""",(ov_id,),fetchone=True)
+    items=query("SELECT * FROM ordenes_venta_items WHERE orden_id=%s ORDER BY id",(ov_id,),fetchall=True) or []
+    ov_data={"cliente_cardcode":resolver_card_code(ov["cliente_id"],ov["cliente_nombre"]),
+             "fecha_entrega":fecha_entrega,"notas":ov["notas"],"almacen_codigo":ov["almacen_codigo"] or ""}
+    sap_ok,sap_msg,sap_de=sap_crear_orden_venta(ov_data,items)
+    query("UPDATE ordenes_venta SET sap_doc_entry=%s,sap_sync_status=%s,sap_sync_msg=%s WHERE id=%s",
+          (sap_de,"ok" if sap_ok else "error",sap_msg,ov_id),commit=True)
+    if sap_ok: flash(f"OV {folio} creada ✅ SAP:{sap_de}","success")
+    else: flash(f"OV {folio} guardada ⚠ SAP:{sap_msg}","warning")
+    return redirect(url_for("detalle_venta",ov_id=ov_id))
+
 @app.route("/ventas/<int:ov_id>")
 def detalle_venta(ov_id):
     if not logged_in(): return redirect(url_for("login"))
@@ -2372,7 +4424,9 @@ def detalle_venta(ov_id):
                 LEFT JOIN usuarios u ON u.id=ov.creado_por
                 LEFT JOIN almacenes alm ON alm.id=ov.almacen_id WHERE ov.id=%s""",(ov_id,),fetchone=True)
     if not ov: abort(404)
-    items=query("SELECT * FROM ordenes_venta_items WHERE orden_id=%s ORDER BY id",(ov_id,),fetchall=True) or []
+    items=query(f"""SELECT oi.*,COALESCE(s.surtido,0) AS surtido,oi.cantidad-COALESCE(s.surtido,0) AS pendiente
+                    FROM ordenes_venta_items oi {_SURTIDO_OI}
+                    WHERE oi.orden_id=%s ORDER BY oi.id""",(ov_id,),fetchall=True) or []
     remisiones=query("""SELECT r.*,u.nombre AS creador FROM remisiones r
                         LEFT JOIN usuarios u ON u.id=r.creado_por
                         WHERE r.orden_venta_id=%s ORDER BY r.fecha_creacion DESC""",(ov_id,),fetchall=True) or []
@@ -2386,8 +4440,24 @@ def actualizar_estatus_venta(ov_id):
     if not logged_in(): return redirect(url_for("login"))
     nuevo=request.form.get("estatus","borrador")
     now=datetime.now().strftime("%Y-%m-%d %H:%M")
-    query("UPDATE ordenes_venta SET estatus=%s,fecha_actualizacion=%s WHERE id=%s",(nuevo,now,ov_id),commit=True)
-    flash("Estatus actualizado","success")
+    conn=get_db(); cur=conn.cursor()
+    try:
+        cur.execute("SELECT estatus FROM ordenes_venta WHERE id=%s FOR UPDATE",(ov_id,))
+        ov=cur.fetchone()
+        if not ov: abort(404)
+        # Entrar a confirmada/en proceso reserva; salir de ellas libera
+        reservaba, reserva = ov["estatus"] in EST_OV_RESERVA, nuevo in EST_OV_RESERVA
+        if reserva and not reservaba: reservar_ov(cur,ov_id,now)
+        elif reservaba and not reserva: liberar_reservas(cur,ov_id)
+        cur.execute("UPDATE ordenes_venta SET estatus=%s,fecha_actualizacion=%s WHERE id=%s",(nuevo,now,ov_id))
+        marcar_reportes(cur, ordenes=[ov_id])
+        conn.commit(); programar_refresco_reportes()
+        if reserva != reservaba: programar_refresco_stock()
+        flash("Estatus actualizado","success")
+    except StockInsuficiente as e:
+        conn.rollback(); flash(str(e),"danger")
+    finally:
+        cur.close(); conn.close()
     return redirect(url_for("detalle_venta",ov_id=ov_id))
 
 
@@ -2424,15 +4494,75 @@ def sap_crear_delivery(rem,items):
     except Exception as e: return False,str(e),None
     finally: sap_logout(s)
 
+def registrar_remision(cur, ov, folio, almacen_id, entregas, notas, uid, now):
+    """Surte la OV: inserta la remisión copiando del lado del servidor los
+    renglones de la OV, descuenta stock y reservas y actualiza el estatus, todo
+    en la transacción de `cur`. `entregas` es {orden_item_id: (cantidad, serie)};
+    None surte todo lo pendiente. Retorna el id de la remisión.
+    Lo que la OV tenga reservado cubre la remisión; el resto debe estar libre
+    o se lanza StockInsuficiente. Cantidades mayores a lo pendiente → ValueError."""
+    cur.execute("SELECT estatus FROM ordenes_venta WHERE id=%s FOR UPDATE",(ov["id"],))
+    estatus=previo=cur.fetchone()["estatus"]
+    cur.execute(f"""SELECT oi.id,oi.item_code,a.id AS articulo_id,oi.cantidad-COALESCE(s.surtido,0) AS pendiente
+                    FROM ordenes_venta_items oi
+                    LEFT JOIN articulos a ON a.codigo=oi.item_code
+                    {_SURTIDO_OI}
+                    WHERE oi.orden_id=%s ORDER BY oi.id""",(ov["id"],))
+    renglones=cur.fetchall()
+    ids,cantidades,series,pedido=[],[],[],{}
+    for r in renglones:
+        cant,serie=(r["pendiente"],"") if entregas is None else entregas.get(r["id"],(0,""))
+        cant=_decimal(cant,MILESIMA,"cantidad")
+        if cant<=0: continue
+        if cant>r["pendiente"]:
+            raise ValueError(f"{r['item_code']}: se piden {cant.normalize():f}, "
+                             f"quedan {max(r['pendiente'],Decimal(0)).normalize():f} por surtir")
+        ids.append(r["id"]); cantidades.append(cant); series.append(serie or "")
+        if almacen_id and r["articulo_id"]:
+            k=(r["articulo_id"],int(almacen_id))
+            pedido[k]=(r["item_code"],pedido.get(k,("",0.0))[1]+float(cant))
+    if not ids: raise ValueError("No hay cantidades pendientes por surtir.")
+    reservas=reservas_ov(cur,ov["id"])
+    if pedido:
+        # Pedido y reservas se bloquean juntos para no romper el orden de bloqueo
+        faltan=_faltantes(pedido,bloquear_inventario(cur,set(pedido)|set(reservas)),reservas)
+        if faltan: raise StockInsuficiente("Stock insuficiente: "+", ".join(faltan))
+    cur.execute("""INSERT INTO remisiones
+        (folio,orden_venta_id,cliente_id,cliente_nombre,almacen_id,estatus,
+         notas,sap_sync_status,creado_por,fecha_creacion,fecha_entrega)
+        VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s) RETURNING id""",
+        (folio,ov["id"],ov["cliente_id"],ov["cliente_nombre"],almacen_id,"entregada",
+         notas,"pendiente",uid,now,now))
+    rem_id=cur.fetchone()["id"]
+    cur.execute("""INSERT INTO remisiones_items
+        (remision_id,orden_item_id,item_code,item_nombre,uom,cantidad,precio_unitario,subtotal,numero_serie,numero_lote)
+        SELECT %s,oi.id,oi.item_code,oi.item_nombre,oi.uom,e.cantidad,oi.precio_unitario,
+               round(e.cantidad*oi.precio_unitario,2),e.serie,''
+        FROM unnest(%s::int[],%s::numeric[],%s::text[]) WITH ORDINALITY AS e(id,cantidad,serie,n)
+        JOIN ordenes_venta_items oi ON oi.id=e.id ORDER BY e.n""",
+        (rem_id,ids,cantidades,series))
+    surte=dict(zip(ids,cantidades))
+    completa=all(surte.get(r["id"],0)>=r["pendiente"] for r in renglones)
+    # Surtida: se suelta toda la reserva; parcial: sólo lo que salió
+    if completa: liberar_reservas(cur,ov["id"])
+    else: consumir_reservas(cur,ov["id"],{k:c for k,(_,c) in pedido.items()},reservas)
+    mover_stock(cur,[(a,w,-c) for (a,w),(_,c) in pedido.items()],"remision","remision",rem_id,now)
+    if completa: estatus="surtida"
+    elif estatus in EST_OV_RESERVA: estatus="en proceso"
+    cur.execute("UPDATE ordenes_venta SET estatus=%s,fecha_actualizacion=%s WHERE id=%s",(estatus,now,ov["id"]))
+    if estatus != previo: marcar_reportes(cur, ordenes=[ov["id"]])
+    return rem_id
+
 @app.route("/ventas/<int:ov_id>/remision/crear", methods=["POST"])
 def crear_remision(ov_id):
+    """Campos cant_<renglón OV> / serie_<renglón OV>; sin ninguno surte todo lo pendiente."""
     if not logged_in(): return redirect(url_for("login"))
     if not tiene_permiso("crear","ventas"): abort(403)
     uid=session["user_id"]; now=datetime.now().strftime("%Y-%m-%d %H:%M")
-    import json as _json
-    items_raw=request.form.get("items_json","[]")
-    try: items=_json.loads(items_raw)
-    except: items=[]
+    entregas={}
+    for k,v in request.form.items():
+        if k.startswith("cant_") and k[5:].isdigit():
+            entregas[int(k[5:])]=(v or 0,request.form.get(f"serie_{k[5:]}","").strip())
 
     ov=query("SELECT * FROM ordenes_venta WHERE id=%s",(ov_id,),fetchone=True)
     if not ov: abort(404)
@@ -2441,42 +4571,22 @@ def crear_remision(ov_id):
 
     try:
         conn=get_db(); cur=conn.cursor()
-        cur.execute("""INSERT INTO remisiones
-            (folio,orden_venta_id,cliente_id,cliente_nombre,almacen_id,estatus,
-             notas,sap_sync_status,creado_por,fecha_creacion,fecha_entrega)
-            VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s) RETURNING id""",
-            (folio,ov_id,ov["cliente_id"],ov["cliente_nombre"],almacen_id,"entregada",
-             request.form.get("notas","").strip(),"pendiente",uid,now,now))
-        rem_id=cur.fetchone()["id"]
-        for it in items:
-            sub=round(float(it["cantidad"])*float(it["precio"]),2)
-            cur.execute("""INSERT INTO remisiones_items
-                (remision_id,item_code,item_nombre,uom,cantidad,precio_unitario,subtotal,numero_serie,numero_lote)
-                VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s)""",
-                (rem_id,it["codigo"],it["nombre"],it.get("uom",""),
-                 float(it["cantidad"]),float(it["precio"]),sub,
-                 it.get("serie",""),it.get("lote","")))
-            # Reducir stock
-            if almacen_id:
-                art=query("SELECT id FROM articulos WHERE codigo=%s",(it["codigo"],),fetchone=True)
-                if art:
-                    cur.execute("""UPDATE inventario SET stock_actual=stock_actual-%s,ultima_actualizacion=%s
-                                   WHERE articulo_id=%s AND almacen_id=%s""",
-                                (float(it["cantidad"]),now,art["id"],almacen_id))
-        # Actualizar OV
-        cur.execute("UPDATE ordenes_venta SET estatus='surtida',fecha_actualizacion=%s WHERE id=%s",(now,ov_id))
-        conn.commit(); cur.close(); conn.close()
+        try:
+            rem_id=registrar_remision(cur,ov,folio,almacen_id,entregas or None,
+                                      request.form.get("notas","").strip(),uid,now)
+        except (StockInsuficiente, ValueError) as e:
+            conn.rollback(); cur.close(); conn.close()
+            flash(str(e),"danger"); return redirect(url_for("detalle_venta",ov_id=ov_id))
+        conn.commit()
+        programar_refresco_stock(); programar_refresco_reportes(); cur.close(); conn.close()
 
         # SAP
         almacen=query("SELECT codigo FROM almacenes WHERE id=%s",(almacen_id,),fetchone=True) if almacen_id else None
-        import re
-        cli=query("SELECT notas FROM clientes WHERE id=%s",(ov["cliente_id"],),fetchone=True) if ov.get("cliente_id") else None
-        card_code=""
-        if cli and cli.get("notas"):
-            m=re.search(r"SAP CardCode:\s*(\S+)",cli["notas"] or "")
-            if m: card_code=m.group(1)
+        card_code=resolver_card_code(ov.get("cliente_id"),ov.get("cliente_nombre"))
         rem_data={"cliente_cardcode":card_code,"almacen_codigo":almacen["codigo"] if almacen else "",
                   "sap_ov_entry":ov.get("sap_doc_entry")}
+        items=query("""SELECT item_code,cantidad,precio_unitario,numero_serie AS serie
+                       FROM remisiones_items WHERE remision_id=%s ORDER BY id""",(rem_id,),fetchall=True) or []
         sap_ok,sap_msg,sap_de=sap_crear_delivery(rem_data,items)
         query("UPDATE remisiones SET sap_doc_entry=%s,sap_sync_status=%s,sap_sync_msg=%s WHERE id=%s",
               (sap_de,"ok" if sap_ok else "error",sap_msg,rem_id),commit=True)
@@ -2489,12 +4599,33 @@ def crear_remision(ov_id):
 
 
 # ── REMISIONES (lista independiente) ─────────────────────
+def _filtro_remisiones():
+    """Alcance por rol y filtros de /remisiones como (condición, params)."""
+    q = request.args.get("q","").strip()
+    fil_est = request.args.get("estatus","")
+    cond, params = "", []
+    if not can_see_all() and session["rol"]!="supervisor":
+        cond+=" AND r.creado_por=%s"; params.append(session["user_id"])
+    if q: cond+=" AND (r.folio ILIKE %s OR r.cliente_nombre ILIKE %s)"; params+=[f"%{q}%",f"%{q}%"]
+    if fil_est: cond+=" AND r.estatus=%s"; params.append(fil_est)
+    c_fecha, p_fecha = _filtro_fechas("r.fecha_creacion")
+    return cond + c_fecha, params + p_fecha
+
+@app.route("/remisiones/exportar-pdf")
+def exportar_remisiones_pdf():
+    """ZIP con el PDF de cada remisión del filtro actual (p.ej. un cliente en un mes)."""
+    if not logged_in(): return redirect(url_for("login"))
+    cond, params = _filtro_remisiones()
+    return respuesta_zip_pdf("remisiones", "remision",
+                             "SELECT r.id FROM remisiones r WHERE 1=1" + cond + " ORDER BY r.fecha_creacion,r.id",
+                             params)
+
 @app.route("/remisiones")
 def remisiones():
     if not logged_in(): return redirect(url_for("login"))
-    uid = session["user_id"]; rol = session["rol"]
     q = request.args.get("q","").strip()
     fil_est = request.args.get("estatus","")
+    cond, params = _filtro_remisiones()
 
     base = """SELECT r.*,u.nombre AS creador,
               alm.nombre AS almacen_nombre,
@@ -2503,12 +4634,7 @@ def remisiones():
               LEFT JOIN usuarios u ON u.id=r.creado_por
               LEFT JOIN almacenes alm ON alm.id=r.almacen_id
               LEFT JOIN ordenes_venta ov ON ov.id=r.orden_venta_id
-              WHERE 1=1"""
-    params=[]
-    if not can_see_all() and rol!="supervisor":
-        base+=" AND r.creado_por=%s"; params.append(uid)
-    if q: base+=" AND (r.folio ILIKE %s OR r.cliente_nombre ILIKE %s)"; params+=[f"%{q}%",f"%{q}%"]
-    if fil_est: base+=" AND r.estatus=%s"; params.append(fil_est)
+              WHERE 1=1"""+cond
     base+=" ORDER BY r.fecha_creacion DESC"
     lista = query(base,tuple(params),fetchall=True) or []
 
@@ -2518,11 +4644,186 @@ def remisiones():
 @app.route("/remisiones/<int:rem_id>/pdf")
 def remision_pdf(rem_id):
     if not logged_in(): return redirect(url_for("login"))
-    rem=query("""SELECT r.*,u.nombre AS creador,alm.nombre AS almacen_nombre
-                 FROM remisiones r LEFT JOIN usuarios u ON u.id=r.creado_por
-                 LEFT JOIN almacenes alm ON alm.id=r.almacen_id WHERE r.id=%s""",(rem_id,),fetchone=True)
-    if not rem: abort(404)
-    items=query("SELECT * FROM remisiones_items WHERE remision_id=%s ORDER BY id",(rem_id,),fetchall=True) or []
-    config=query("SELECT * FROM config WHERE id=1",fetchone=True) or {}
-    return render_template("remision_pdf.html", rem=rem, items=items, empresa=EMPRESA, config=config)
+    return respuesta_pdf("remision", rem_id)
+
+
+# ══════════════════════════════════════════════════════════
+# ── REPORTES ──────────────────────────────────────────────
+# ══════════════════════════════════════════════════════════
+# /reportes lee agregados diarios por vendedor (migración 0015), nunca las tablas
+# de documentos. Crear o cambiar una cotización/OV marca su día (y el de la
+# cotización de origen) en rep_dias_pendientes dentro de la misma transacción;
+# un refresco programado con retardo recalcula sólo esos días. Para reconstruir
+# todo: `flask refresh-reportes --todo`.
+EST_OV_VENTA    = ("confirmada", "en proceso", "surtida")
+REPORTES_LOCK   = 72610050
+REPORTES_MESES  = 12
+REPORTES_LOTE   = 31      # días por refresco programado; el resto queda para el siguiente
+_reportes_timer = None
+_reportes_lock  = threading.Lock()
+
+_SQL_DIAS_TODOS = r"""INSERT INTO rep_dias_pendientes (dia)
+    SELECT DISTINCT left(fecha_creacion,10)::date FROM (
+        SELECT fecha_creacion FROM cotizaciones
+        UNION ALL SELECT fecha_creacion FROM ordenes_venta) f
+    WHERE fecha_creacion ~ '^\d{4}-\d{2}-\d{2}'
+    ON CONFLICT DO NOTHING"""
+
+# (tabla, INSERT ... SELECT con %(dias)s y %(venta)s)
+_SQL_REPORTES = (
+    ("rep_cotizaciones_dia", """
+        INSERT INTO rep_cotizaciones_dia (dia,vendedor_id,estatus,cotizaciones,total,convertidas,total_convertido)
+        SELECT left(c.fecha_creacion,10)::date, COALESCE(c.creado_por,0), COALESCE(c.estatus,''),
+               count(*), COALESCE(sum(c.total),0), count(ov.id), COALESCE(sum(ov.total),0)
+        FROM cotizaciones c
+        LEFT JOIN LATERAL (SELECT o.id,o.total FROM ordenes_venta o
+                           WHERE o.cotizacion_id=c.id AND o.estatus<>'cancelada'
+                           ORDER BY o.id LIMIT 1) ov ON true
+        WHERE left(c.fecha_creacion,10) = ANY(%(dias)s)
+        GROUP BY 1,2,3"""),
+    ("rep_ventas_cliente_dia", """
+        INSERT INTO rep_ventas_cliente_dia (dia,vendedor_id,cliente_id,cliente_nombre,ordenes,subtotal,total)
+        SELECT left(o.fecha_creacion,10)::date, COALESCE(o.creado_por,0), COALESCE(o.cliente_id,0),
+               COALESCE(o.cliente_nombre,''), count(*), COALESCE(sum(o.subtotal),0), COALESCE(sum(o.total),0)
+        FROM ordenes_venta o
+        WHERE left(o.fecha_creacion,10) = ANY(%(dias)s) AND o.estatus = ANY(%(venta)s)
+        GROUP BY 1,2,3,4"""),
+    ("rep_ventas_articulo_dia", """
+        INSERT INTO rep_ventas_articulo_dia (dia,vendedor_id,item_code,item_nombre,cantidad,importe)
+        SELECT left(o.fecha_creacion,10)::date, COALESCE(o.creado_por,0), COALESCE(i.item_code,''),
+               max(i.item_nombre), COALESCE(sum(i.cantidad),0), COALESCE(sum(i.subtotal),0)
+        FROM ordenes_venta o JOIN ordenes_venta_items i ON i.orden_id=o.id
+        WHERE left(o.fecha_creacion,10) = ANY(%(dias)s) AND o.estatus = ANY(%(venta)s)
+        GROUP BY 1,2,3"""),
+)
+
+def marcar_reportes(cur=None, cotizaciones=(), ordenes=()):
+    """Marca para recalcular los días de las cotizaciones/OV dadas (y el de la
+    cotización de cada OV). Sin `cur` usa su propia transacción y programa el
+    refresco; con `cur` lo programa el llamador después de su commit."""
+    sql = r"""INSERT INTO rep_dias_pendientes (dia)
+        SELECT DISTINCT left(fecha_creacion,10)::date FROM (
+            SELECT fecha_creacion FROM cotizaciones WHERE id = ANY(%s)
+            UNION ALL SELECT fecha_creacion FROM ordenes_venta WHERE id = ANY(%s)
+            UNION ALL SELECT c.fecha_creacion FROM ordenes_venta o
+                      JOIN cotizaciones c ON c.id=o.cotizacion_id WHERE o.id = ANY(%s)) f
+        WHERE fecha_creacion ~ '^\d{4}-\d{2}-\d{2}'
+        ON CONFLICT DO NOTHING"""
+    params = ([int(i) for i in cotizaciones], [int(i) for i in ordenes], [int(i) for i in ordenes])
+    if cur is None:
+        query(sql, params, commit=True); programar_refresco_reportes()
+    else: cur.execute(sql, params)
+
+def refrescar_reportes(esperar=False, todo=False, limite=None):
+    """Recalcula los días pendientes (a lo más `limite`, los más recientes
+    primero; todos con todo=True). Retorna cuántos días se recalcularon, o None
+    si otro proceso ya está refrescando (esperar=False)."""
+    conn = get_db(); cur = conn.cursor()
+    try:
+        cur.execute("SET LOCAL statement_timeout=0")
+        if esperar:
+            cur.execute("SELECT pg_advisory_xact_lock(%s)", (REPORTES_LOCK,))
+        else:
+            cur.execute("SELECT pg_try_advisory_xact_lock(%s) AS ok", (REPORTES_LOCK,))
+            if not cur.fetchone()["ok"]: return None
+        if todo:
+            for tabla, _ in _SQL_REPORTES: cur.execute(f"DELETE FROM {tabla}")
+            cur.execute(_SQL_DIAS_TODOS)
+        cur.execute("""DELETE FROM rep_dias_pendientes WHERE dia IN (
+                           SELECT dia FROM rep_dias_pendientes ORDER BY dia DESC LIMIT %s)
+                       RETURNING dia::text AS dia""", (limite,))
+        dias = [r["dia"] for r in cur.fetchall()]
+        if dias:
+            for tabla, sql in _SQL_REPORTES:
+                cur.execute(f"DELETE FROM {tabla} WHERE dia = ANY(%s::date[])", (dias,))
+                cur.execute(sql, {"dias": dias, "venta": list(EST_OV_VENTA)})
+        conn.commit()
+        return len(dias)
+    finally:
+        cur.close(); conn.close()
 
+def _refresco_reportes_programado():
+    global _reportes_timer
+    with _reportes_lock: _reportes_timer = None
+    try:
+        n = refrescar_reportes(limite=REPORTES_LOTE)
+        # Otro proceso refrescando, o quedan días (p.ej. la historia tras la migración)
+        if n is None or n == REPORTES_LOTE: programar_refresco_reportes()
+    except Exception as e:
+        app.logger.warning("No se pudieron refrescar los reportes: %s", e)
+
+def programar_refresco_reportes():
+    """Pide un refresco de los agregados en STOCK_MV_DEBOUNCE s (se juntan ráfagas)."""
+    global _reportes_timer
+    with _reportes_lock:
+        if _reportes_timer is not None: return
+        _reportes_timer = threading.Timer(STOCK_MV_DEBOUNCE, _refresco_reportes_programado)
+        _reportes_timer.daemon = True
+        _reportes_timer.start()
+
+@app.cli.command("refresh-reportes")
+@click.option("--todo", is_flag=True, help="Reconstruir todos los agregados, no sólo los días pendientes")
+def cli_refresh_reportes(todo):
+    """Recalcula los agregados de /reportes (para cron o después de cargas masivas)."""
+    n = refrescar_reportes(esperar=True, todo=todo)
+    click.echo(f"Reportes actualizados: {n} días recalculados")
+
+def _mes(texto, defecto):
+    try: return date.fromisoformat(texto + "-01")
+    except (TypeError, ValueError): return defecto
+
+@app.route("/reportes")
+def reportes():
+    if not logged_in(): return redirect(url_for("login"))
+    if not tiene_permiso("ver","reportes"): abort(403)
+    # La página sólo lee agregados; si hay días pendientes se pide el refresco
+    # programado y se avisa que las cifras se están actualizando
+    pendientes = query("SELECT COUNT(*) AS c FROM rep_dias_pendientes", fetchone=True)["c"]
+    if pendientes: programar_refresco_reportes()
+
+    hoy = date.today().replace(day=1)
+    m = hoy.year * 12 + hoy.month - REPORTES_MESES             # últimos REPORTES_MESES meses
+    inicio_def = date(m // 12, m % 12 + 1, 1)
+    desde = _mes(request.args.get("desde"), inicio_def)
+    hasta = _mes(request.args.get("hasta"), hoy)
+    fin = (hasta + timedelta(days=32)).replace(day=1)            # exclusivo
+    vendedor = request.args.get("vendedor","")
+    cond, params = " AND r.dia>=%s AND r.dia<%s", [desde, fin]
+    ver_todo = can_see_all() or session["rol"] == "supervisor"
+    if not ver_todo:
+        cond += " AND r.vendedor_id=%s"; params.append(session["user_id"])
+    elif vendedor.isdigit():
+        cond += " AND r.vendedor_id=%s"; params.append(int(vendedor))
+
+    filas = query(f"""SELECT to_char(r.dia,'YYYY-MM') AS mes,r.estatus,sum(r.cotizaciones) AS n,
+                             sum(r.total) AS total,sum(r.convertidas) AS convertidas
+                      FROM rep_cotizaciones_dia r WHERE true{cond}
+                      GROUP BY 1,2 ORDER BY 1""", tuple(params), fetchall=True) or []
+    por_mes = {}
+    for f in filas:
+        m = por_mes.setdefault(f["mes"], {"mes": f["mes"], "estatus": {}, "n": 0, "total": 0, "convertidas": 0})
+        m["estatus"][f["estatus"]] = f["n"]
+        m["n"] += f["n"]; m["total"] += f["total"]; m["convertidas"] += f["convertidas"]
+    por_vendedor = query(f"""SELECT r.vendedor_id,COALESCE(u.nombre,'—') AS nombre,sum(r.cotizaciones) AS n,
+                                    sum(r.total) AS total,sum(r.convertidas) AS convertidas,
+                                    sum(r.total_convertido) AS total_convertido,
+                                    sum(r.cotizaciones) FILTER (WHERE r.estatus='aceptada') AS aceptadas
+                             FROM rep_cotizaciones_dia r LEFT JOIN usuarios u ON u.id=r.vendedor_id
+                             WHERE true{cond} GROUP BY 1,2 ORDER BY total DESC""",
+                         tuple(params), fetchall=True) or []
+    por_cliente = query(f"""SELECT r.cliente_id,max(r.cliente_nombre) AS cliente_nombre,sum(r.ordenes) AS ordenes,
+                                   sum(r.subtotal) AS subtotal,sum(r.total) AS total
+                            FROM rep_ventas_cliente_dia r WHERE true{cond}
+                            GROUP BY r.cliente_id, CASE WHEN r.cliente_id=0 THEN r.cliente_nombre END
+                            ORDER BY total DESC LIMIT 50""", tuple(params), fetchall=True) or []
+    por_articulo = query(f"""SELECT r.item_code,max(r.item_nombre) AS item_nombre,sum(r.cantidad) AS cantidad,
+                                    sum(r.importe) AS importe
+                             FROM rep_ventas_articulo_dia r WHERE true{cond}
+                             GROUP BY 1 ORDER BY importe DESC LIMIT 50""", tuple(params), fetchall=True) or []
+    vendedores = query("SELECT id,nombre FROM usuarios WHERE activo=1 ORDER BY nombre",
+                       fetchall=True) if ver_todo else []
+    return render_template("reportes.html", empresa=EMPRESA, logo=LOGO,
+                           por_mes=list(por_mes.values()), por_vendedor=por_vendedor,
+                           por_cliente=por_cliente, por_articulo=por_articulo,
+                           estatus_cot=ESTATUS_COT, vendedores=vendedores or [], vendedor=vendedor,
+                           desde=desde.strftime("%Y-%m"), hasta=hasta.strftime("%Y-%m"), pendientes=pendientes)
@@ -0,0 +1,105 @@
+"""Comparativa de carga: worker sync vs gevent con el mismo número de procesos.
+
+    python bench/carga_workers.py [--ruta /dashboard] [--workers 2]
+                                  [--concurrencia 50] [--segundos 20]
+
+Levanta gunicorn dos veces (GUNICORN_WORKER_CLASS=sync y =gevent) con los
+mismos workers, inicia sesión con BENCH_USUARIO/BENCH_PASSWORD (admin/admin123
+por defecto) y golpea la ruta con N clientes concurrentes. Reporta req/s,
+latencia p50/p95 y la memoria RSS total de los procesos de gunicorn, para
+comparar el rendimiento a igual memoria. Necesita DATABASE_URL apuntando a una
+base con datos y requirements-gevent.txt instalado.
+"""
+import argparse, http.cookiejar, os, signal, statistics, subprocess, sys, threading, time
+import urllib.parse, urllib.request
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def rss_mb(pid_master):
+    """RSS total (MB) del master y sus workers, leído de /proc."""
+    pids = [pid_master]
+    for d in os.listdir("/proc"):
+        if not d.isdigit(): continue
+        try:
+            with open(f"/proc/{d}/stat") as fh:
+                if int(fh.read().split(")")[1].split()[1]) == pid_master: pids.append(int(d))
+        except OSError:
+            pass
+    total = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/status") as fh:
+                for linea in fh:
+                    if linea.startswith("VmRSS:"): total += int(linea.split()[1])
+        except OSError:
+            pass
+    return total / 1024
+
+def esperar(url, segundos=20):
+    fin = time.time() + segundos
+    while time.time() < fin:
+        try:
+            urllib.request.urlopen(url, timeout=1); return
+        except Exception:
+            time.sleep(0.2)
+    raise RuntimeError(f"gunicorn no respondió en {url}")
+
+def opener_con_sesion(base):
+    jar = http.cookiejar.CookieJar()
+    op  = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(jar))
+    datos = urllib.parse.urlencode({"usuario": os.environ.get("BENCH_USUARIO", "admin"),
+                                    "password": os.environ.get("BENCH_PASSWORD", "admin123")}).encode()
+    op.open(f"{base}/login", datos, timeout=10)
+    return op
+
+def cargar(base, ruta, concurrencia, segundos):
+    latencias, errores = [], [0]
+    lock = threading.Lock()
+    fin  = time.time() + segundos
+
+    def cliente():
+        op = opener_con_sesion(base)
+        while time.time() < fin:
+            t = time.perf_counter()
+            try:
+                op.open(base + ruta, timeout=30).read()
+                with lock: latencias.append(time.perf_counter() - t)
+            except Exception:
+                with lock: errores[0] += 1
+
+    hilos = [threading.Thread(target=cliente) for _ in range(concurrencia)]
+    for h in hilos: h.start()
+    for h in hilos: h.join()
+    return latencias, errores[0]
+
+def correr(clase, args, puerto):
+    env = dict(os.environ, GUNICORN_WORKER_CLASS=clase, WEB_CONCURRENCY=str(args.workers),
+               PORT=str(puerto))
+    proc = subprocess.Popen([sys.executable, "-m", "gunicorn", "app:app"], cwd=RAIZ, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base = f"http://127.0.0.1:{puerto}"
+    try:
+        esperar(f"{base}/login")
+        latencias, errores = cargar(base, args.ruta, args.concurrencia, args.segundos)
+        mem = rss_mb(proc.pid)
+    finally:
+        proc.send_signal(signal.SIGTERM); proc.wait(15)
+    lat = sorted(latencias) or [0]
+    return {"clase": clase, "rps": len(latencias) / args.segundos, "errores": errores,
+            "p50": statistics.median(lat) * 1000, "p95": lat[int(len(lat) * .95) - 1] * 1000,
+            "rss": mem}
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--ruta", default="/dashboard")
+    ap.add_argument("--workers", type=int, default=2)
+    ap.add_argument("--concurrencia", type=int, default=50)
+    ap.add_argument("--segundos", type=int, default=20)
+    args = ap.parse_args()
+    print(f"{'worker':8} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'RSS MB':>8} {'errores':>8}")
+    for i, clase in enumerate(["sync", "gevent"]):
+        r = correr(clase, args, 18100 + i)
+        print(f"{r['clase']:8} {r['rps']:8.1f} {r['p50']:8.1f} {r['p95']:8.1f} {r['rss']:8.1f} {r['errores']:8}")
+
+if __name__ == "__main__":
+    main()
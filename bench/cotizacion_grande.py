@@ -0,0 +1,74 @@
+"""Precio e inserción de cotizaciones grandes (BOMs importados).
+
+    python bench/cotizacion_grande.py [--lineas 10000] [--repeticiones 5] [--crear]
+
+Genera renglones con cantidades, precios y descuentos al azar y mide
+calcular_totales (Decimal) contra el cálculo anterior en float, contando los
+renglones cuyo importe difiere por redondeo. Con --crear además da de alta la
+cotización por POST /cotizaciones/crear (test client de Flask, sesión de
+BENCH_USUARIO/BENCH_PASSWORD) y compara el total guardado con la suma de sus
+renglones; necesita DATABASE_URL apuntando a una base migrada.
+"""
+import argparse, json, os, random, statistics, sys, time
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+
+def renglones(n, semilla=7):
+    rnd = random.Random(semilla)
+    return [{"item_code": f"BOM-{i:05d}", "item_nombre": f"Componente {i}", "uom": "PZA",
+             "cantidad": str(rnd.choice([1, 2, 3, 0.5, 1.25, 12, 100]) * rnd.randint(1, 9)),
+             "precio_unitario": f"{rnd.uniform(0.05, 5000):.2f}",
+             "descuento": rnd.choice(["0", "0", "5", "7.5", "12.5", "33.33"])} for i in range(n)]
+
+def totales_float(items, descuento_global=0):
+    """El cálculo que había antes: float y redondeo sólo al final."""
+    importes = [round(float(i["cantidad"]) * float(i["precio_unitario"]) *
+                      (1 - float(i["descuento"]) / 100), 2) for i in items]
+    subtotal = sum(float(i["cantidad"]) * float(i["precio_unitario"]) *
+                   (1 - float(i["descuento"]) / 100) for i in items)
+    base = subtotal - subtotal * descuento_global / 100
+    return importes, round(base + round(base * 0.16, 2), 2)
+
+def medir(fn, repeticiones):
+    tiempos = []
+    for _ in range(repeticiones):
+        t = time.perf_counter(); r = fn(); tiempos.append(time.perf_counter() - t)
+    return r, statistics.median(tiempos) * 1000
+
+def crear(app, items):
+    c = app.app.test_client()
+    c.post("/login", data={"usuario": os.environ.get("BENCH_USUARIO", "admin"),
+                           "password": os.environ.get("BENCH_PASSWORD", "admin123")})
+    t = time.perf_counter()
+    r = c.post("/cotizaciones/crear", data={"cliente_nombre": "Bench BOM", "descuento_global": "3",
+                                            "items_json": json.dumps(items)})
+    ms = (time.perf_counter() - t) * 1000
+    cot_id = int(r.headers["Location"].rstrip("/").rsplit("/", 1)[1])
+    cot = app.query("""SELECT c.subtotal, (SELECT sum(subtotal) FROM cotizaciones_items
+                                           WHERE cotizacion_id=c.id) AS suma,
+                              (SELECT count(*) FROM cotizaciones_items WHERE cotizacion_id=c.id) AS n
+                       FROM cotizaciones c WHERE c.id=%s""", (cot_id,), fetchone=True)
+    return cot_id, ms, cot
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--lineas", type=int, default=10000)
+    ap.add_argument("--repeticiones", type=int, default=5)
+    ap.add_argument("--crear", action="store_true")
+    args = ap.parse_args()
+    import app
+    items = renglones(args.lineas)
+    (lineas, tot), ms_dec = medir(lambda: app.calcular_totales(items, 3), args.repeticiones)
+    (importes, total_f), ms_flt = medir(lambda: totales_float(items, 3), args.repeticiones)
+    difieren = sum(1 for (_, _, _, d), f in zip(lineas, importes) if float(d) != f)
+    print(f"{args.lineas} renglones")
+    print(f"  Decimal : {ms_dec:8.1f} ms  total {tot['total']}")
+    print(f"  float   : {ms_flt:8.1f} ms  total {total_f:.2f}  ({difieren} importes difieren)")
+    if args.crear:
+        cot_id, ms, cot = crear(app, items)
+        print(f"  crear   : {ms:8.1f} ms  cotización #{cot_id}, {cot['n']} renglones, "
+              f"subtotal {cot['subtotal']} = suma renglones {cot['suma']}")
+
+if __name__ == "__main__":
+    main()
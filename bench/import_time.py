@@ -0,0 +1,43 @@
+"""Mide la latencia de arranque: cuánto tarda `import app` en un proceso nuevo.
+
+    python bench/import_time.py [-n 10] [--detalle]
+
+Cada corrida usa un intérprete limpio (como un worker nuevo de gunicorn) con
+SCHEMA_CHECK=0 para no medir la red hacia Postgres. --detalle imprime los
+módulos más lentos según `python -X importtime`.
+"""
+import argparse, os, statistics, subprocess, sys
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CODIGO = "import time; t=time.perf_counter(); import app; print(time.perf_counter()-t)"
+
+def correr(env):
+    out = subprocess.run([sys.executable, "-c", CODIGO], cwd=RAIZ, env=env,
+                         capture_output=True, text=True, check=True)
+    return float(out.stdout.strip().splitlines()[-1])
+
+def detalle(env, top=15):
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c", "import app"],
+                         cwd=RAIZ, env=env, capture_output=True, text=True)
+    filas = []
+    for linea in out.stderr.splitlines():
+        if not linea.startswith("import time:") or "cumulative" in linea: continue
+        propio, acumulado, modulo = [p.strip() for p in linea.split(":", 1)[1].split("|")]
+        filas.append((int(acumulado), modulo))
+    for us, modulo in sorted(filas, reverse=True)[:top]:
+        print(f"  {us/1000:8.1f} ms  {modulo}")
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-n", type=int, default=10)
+    ap.add_argument("--detalle", action="store_true")
+    args = ap.parse_args()
+    env = dict(os.environ, SCHEMA_CHECK="0", PYTHONDONTWRITEBYTECODE="1")
+    tiempos = [correr(env) for _ in range(args.n)]
+    print(f"import app  n={args.n}  min={min(tiempos)*1000:.1f} ms  "
+          f"mediana={statistics.median(tiempos)*1000:.1f} ms  max={max(tiempos)*1000:.1f} ms")
+    if args.detalle:
+        detalle(env)
+
+if __name__ == "__main__":
+    main()
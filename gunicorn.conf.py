@@ -0,0 +1,42 @@
+# Configuración de gunicorn (se lee sola desde el directorio de trabajo).
+# Con preload_app la app se importa una vez en el master y los workers
+# nacen por fork: el arranque de cada worker es casi instantáneo.
+import os
+
+# GUNICORN_WORKER_CLASS=gevent activa el modo cooperativo: cada worker atiende
+# worker_connections peticiones concurrentes mientras esperan a Postgres,
+# Supabase o SAP. Requiere requirements-gevent.txt.
+worker_class       = os.environ.get("GUNICORN_WORKER_CLASS", "sync")
+worker_connections = int(os.environ.get("GUNICORN_WORKER_CONNECTIONS", "100"))
+GEVENT = worker_class == "gevent"
+
+if GEVENT:
+    # Parchear antes de importar la app (preload) para que requests/httpx y
+    # los locks del pool de conexiones sean cooperativos.
+    from gevent import monkey
+    monkey.patch_all()
+    # Pool dimensionado para greenlets: muchas peticiones, pocas conexiones.
+    os.environ.setdefault("DB_POOL_MAX", "20")
+
+bind             = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+workers          = int(os.environ.get("WEB_CONCURRENCY", "2"))
+timeout          = int(os.environ.get("GUNICORN_TIMEOUT", "60"))
+preload_app      = os.environ.get("GUNICORN_PRELOAD", "1") == "1"
+
+def pre_fork(server, worker):
+    # El master no debe llegar al fork con conexiones a Postgres abiertas: el
+    # worker heredaría el socket y al liberarlo cerraría la sesión del master.
+    from app import cerrar_pool
+    cerrar_pool()
+
+def post_fork(server, worker):
+    # Los clientes HTTP/SDK no se comparten entre procesos: cada worker
+    # construye los suyos en el primer uso.
+    from app import reset_clients
+    reset_clients()
+
+def post_worker_init(worker):
+    if GEVENT:
+        # psycopg2 es C: sin esto cada consulta bloquearía el hub de gevent.
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
@@ -0,0 +1,108 @@
+-- Esquema base: tablas que antes creaba init_db() en cada arranque.
+-- Idempotente para bases existentes (CREATE TABLE IF NOT EXISTS).
+
+CREATE TABLE IF NOT EXISTS usuarios (
+    id SERIAL PRIMARY KEY, usuario TEXT UNIQUE NOT NULL,
+    nombre TEXT DEFAULT '', apellido TEXT DEFAULT '',
+    email TEXT UNIQUE NOT NULL, password TEXT NOT NULL,
+    rol TEXT DEFAULT 'vendedor', activo INTEGER DEFAULT 1,
+    fecha_creacion TEXT DEFAULT '',
+    telefono TEXT DEFAULT '', zona TEXT DEFAULT '', foto_url TEXT DEFAULT '',
+    supervisor_id INTEGER DEFAULT NULL
+);
+
+CREATE TABLE IF NOT EXISTS actividades (
+    id SERIAL PRIMARY KEY, usuario_id INTEGER REFERENCES usuarios(id),
+    fecha TEXT NOT NULL, cliente TEXT NOT NULL,
+    comentarios TEXT DEFAULT '', proxima_visita TEXT DEFAULT NULL,
+    firma_archivo TEXT DEFAULT NULL
+);
+
+CREATE TABLE IF NOT EXISTS fotos (
+    id SERIAL PRIMARY KEY, actividad_id INTEGER REFERENCES actividades(id),
+    archivo TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS eventos (
+    id SERIAL PRIMARY KEY, usuario_id INTEGER REFERENCES usuarios(id),
+    titulo TEXT NOT NULL, descripcion TEXT DEFAULT '',
+    fecha_inicio TEXT NOT NULL, fecha_fin TEXT DEFAULT NULL,
+    hora_inicio TEXT DEFAULT '', hora_fin TEXT DEFAULT '',
+    tipo TEXT DEFAULT 'visita', color TEXT DEFAULT '#714B67',
+    cliente TEXT DEFAULT '', ubicacion TEXT DEFAULT '',
+    todo_el_dia INTEGER DEFAULT 0, creado_en TEXT DEFAULT ''
+);
+
+CREATE TABLE IF NOT EXISTS config (
+    id INTEGER PRIMARY KEY, empresa TEXT DEFAULT 'Altasolucion',
+    logo_url TEXT DEFAULT '', color_primario TEXT DEFAULT '#714B67',
+    descripcion TEXT DEFAULT ''
+);
+
+CREATE TABLE IF NOT EXISTS solicitudes_reset (
+    id SERIAL PRIMARY KEY, usuario_id INTEGER REFERENCES usuarios(id),
+    email TEXT, fecha TEXT, atendido INTEGER DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS clientes (
+    id SERIAL PRIMARY KEY,
+    nombre TEXT NOT NULL, empresa TEXT DEFAULT '', cargo TEXT DEFAULT '',
+    email TEXT DEFAULT '', telefono TEXT DEFAULT '', telefono2 TEXT DEFAULT '',
+    direccion TEXT DEFAULT '', ciudad TEXT DEFAULT '', estado_dir TEXT DEFAULT '',
+    pais TEXT DEFAULT 'Mexico', codigo_postal TEXT DEFAULT '',
+    rfc TEXT DEFAULT '', razon_social TEXT DEFAULT '', uso_cfdi TEXT DEFAULT '',
+    clasificacion TEXT DEFAULT 'prospecto', estado_semaforo TEXT DEFAULT 'verde',
+    vendedor_id INTEGER REFERENCES usuarios(id),
+    notas TEXT DEFAULT '', sitio_web TEXT DEFAULT '', industria TEXT DEFAULT '',
+    empleados TEXT DEFAULT '', fuente TEXT DEFAULT '',
+    activo INTEGER DEFAULT 1, creado_por INTEGER REFERENCES usuarios(id),
+    fecha_creacion TEXT DEFAULT '', fecha_actualizacion TEXT DEFAULT ''
+);
+
+CREATE TABLE IF NOT EXISTS cotizaciones (
+    id SERIAL PRIMARY KEY, folio TEXT UNIQUE,
+    cliente_id INTEGER REFERENCES clientes(id),
+    cliente_nombre TEXT DEFAULT '', estatus TEXT DEFAULT 'borrador',
+    validez_dias INTEGER DEFAULT 15, moneda TEXT DEFAULT 'MXN',
+    descuento_global NUMERIC(5,2) DEFAULT 0,
+    subtotal NUMERIC(18,2) DEFAULT 0,
+    descuento_monto NUMERIC(18,2) DEFAULT 0,
+    impuesto NUMERIC(18,2) DEFAULT 0,
+    total NUMERIC(18,2) DEFAULT 0,
+    notas TEXT DEFAULT '', condiciones TEXT DEFAULT '',
+    creado_por INTEGER REFERENCES usuarios(id),
+    fecha_creacion TEXT DEFAULT '', fecha_actualizacion TEXT DEFAULT '',
+    fecha_vencimiento TEXT DEFAULT ''
+);
+
+CREATE TABLE IF NOT EXISTS cotizaciones_items (
+    id SERIAL PRIMARY KEY,
+    cotizacion_id INTEGER REFERENCES cotizaciones(id) ON DELETE CASCADE,
+    item_code TEXT, item_nombre TEXT, uom TEXT DEFAULT '',
+    cantidad NUMERIC(18,3) DEFAULT 1,
+    precio_unitario NUMERIC(18,2) DEFAULT 0,
+    descuento NUMERIC(5,2) DEFAULT 0,
+    subtotal NUMERIC(18,2) DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS llamadas_servicio (
+    id SERIAL PRIMARY KEY, folio TEXT UNIQUE,
+    cliente_id INTEGER REFERENCES clientes(id),
+    cliente_nombre TEXT DEFAULT '',
+    item_code TEXT, item_nombre TEXT DEFAULT '',
+    serial_number TEXT DEFAULT '', problema TEXT NOT NULL,
+    prioridad TEXT DEFAULT 'media', estatus TEXT DEFAULT 'abierta',
+    tecnico_id INTEGER REFERENCES usuarios(id),
+    fecha_atencion TEXT DEFAULT '', fecha_cierre TEXT DEFAULT '',
+    creado_por INTEGER REFERENCES usuarios(id),
+    fecha_creacion TEXT DEFAULT '', fecha_actualizacion TEXT DEFAULT ''
+);
+
+CREATE TABLE IF NOT EXISTS llamadas_seguimiento (
+    id SERIAL PRIMARY KEY,
+    llamada_id INTEGER REFERENCES llamadas_servicio(id) ON DELETE CASCADE,
+    usuario_id INTEGER REFERENCES usuarios(id),
+    accion TEXT NOT NULL, nota TEXT DEFAULT '',
+    estatus_anterior TEXT DEFAULT '', estatus_nuevo TEXT DEFAULT '',
+    fecha TEXT DEFAULT ''
+);
@@ -0,0 +1,13 @@
+"""Usuarios iniciales (admin / demo) que antes sembraba init_db()."""
+from datetime import datetime
+from werkzeug.security import generate_password_hash
+
+def upgrade(cur):
+    now = datetime.now().strftime("%Y-%m-%d %H:%M")
+    for usuario, nombre, apellido, email, pw, rol in [
+        ("admin", "Admin", "Sistema",  "admin@demo.com", "admin123", "admin"),
+        ("demo",  "Demo",  "Vendedor", "demo@demo.com",  "1234",     "vendedor"),
+    ]:
+        cur.execute("""INSERT INTO usuarios (usuario,nombre,apellido,email,password,rol,activo,fecha_creacion)
+            VALUES (%s,%s,%s,%s,%s,%s,%s,%s) ON CONFLICT (usuario) DO NOTHING""",
+            (usuario, nombre, apellido, email, generate_password_hash(pw), rol, 1, now))
@@ -0,0 +1,164 @@
+-- Tablas y columnas que ya usaba el código pero sólo existían en la base
+-- de producción (creadas a mano / por la sincronización SAP).
+-- Todo es IF NOT EXISTS para que la migración sea un no-op donde ya existen.
+
+-- ── Columnas agregadas fuera de init_db ──────────────────
+ALTER TABLE clientes ADD COLUMN IF NOT EXISTS tipo_cliente TEXT DEFAULT '';
+ALTER TABLE config   ADD COLUMN IF NOT EXISTS sitio_web TEXT DEFAULT '';
+ALTER TABLE llamadas_servicio ADD COLUMN IF NOT EXISTS sap_doc_entry INTEGER;
+ALTER TABLE llamadas_servicio ADD COLUMN IF NOT EXISTS sap_sync_status TEXT DEFAULT '';
+ALTER TABLE llamadas_servicio ADD COLUMN IF NOT EXISTS sap_sync_msg TEXT DEFAULT '';
+ALTER TABLE llamadas_servicio ADD COLUMN IF NOT EXISTS sap_sync_fecha TEXT DEFAULT '';
+
+-- ── Permisos ─────────────────────────────────────────────
+CREATE TABLE IF NOT EXISTS permisos_usuario (
+    id SERIAL PRIMARY KEY,
+    usuario_id INTEGER REFERENCES usuarios(id) ON DELETE CASCADE,
+    modulo TEXT NOT NULL,
+    puede_ver INTEGER DEFAULT 1, puede_crear INTEGER DEFAULT 0,
+    puede_editar INTEGER DEFAULT 0, puede_eliminar INTEGER DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS ix_permisos_usuario_modulo ON permisos_usuario (usuario_id, modulo);
+
+-- ── Réplica SAP (la llena la sincronización externa) ─────
+CREATE TABLE IF NOT EXISTS sap_items (
+    item_code TEXT PRIMARY KEY, item_name TEXT DEFAULT '',
+    item_group TEXT DEFAULT '', uom TEXT DEFAULT '',
+    price NUMERIC(18,2) DEFAULT 0, active BOOLEAN DEFAULT true
+);
+CREATE TABLE IF NOT EXISTS sap_item_warehouse (
+    item_code TEXT NOT NULL, warehouse_code TEXT NOT NULL,
+    warehouse_name TEXT DEFAULT '',
+    in_stock NUMERIC(18,3) DEFAULT 0, available NUMERIC(18,3) DEFAULT 0,
+    PRIMARY KEY (item_code, warehouse_code)
+);
+CREATE TABLE IF NOT EXISTS sap_item_serial (
+    item_code TEXT NOT NULL, serial_number TEXT,
+    warehouse_code TEXT DEFAULT '', status TEXT DEFAULT '',
+    expiry_date TEXT DEFAULT NULL
+);
+CREATE TABLE IF NOT EXISTS sap_business_partners (
+    card_code TEXT PRIMARY KEY, card_name TEXT DEFAULT '',
+    card_type TEXT DEFAULT ''
+);
+
+-- ── Almacenes / artículos / inventario ───────────────────
+CREATE TABLE IF NOT EXISTS almacenes (
+    id SERIAL PRIMARY KEY, codigo TEXT UNIQUE NOT NULL, nombre TEXT NOT NULL,
+    descripcion TEXT DEFAULT '', ubicacion TEXT DEFAULT '',
+    responsable_id INTEGER REFERENCES usuarios(id),
+    tipo TEXT DEFAULT 'general', activo BOOLEAN DEFAULT true,
+    fuente TEXT DEFAULT 'portal',
+    fecha_creacion TEXT DEFAULT '', fecha_actualizacion TEXT DEFAULT ''
+);
+CREATE TABLE IF NOT EXISTS articulos (
+    id SERIAL PRIMARY KEY, codigo TEXT UNIQUE NOT NULL, nombre TEXT NOT NULL,
+    descripcion TEXT DEFAULT '', grupo TEXT DEFAULT '', categoria TEXT DEFAULT '',
+    uom TEXT DEFAULT '',
+    precio_compra NUMERIC(18,2) DEFAULT 0, precio_venta NUMERIC(18,2) DEFAULT 0,
+    impuesto NUMERIC(5,2) DEFAULT 16, activo BOOLEAN DEFAULT true,
+    manage_serial TEXT DEFAULT 'N', manage_batch TEXT DEFAULT 'N',
+    fuente TEXT DEFAULT 'portal', item_code_sap TEXT DEFAULT '',
+    fecha_creacion TEXT DEFAULT '', fecha_actualizacion TEXT DEFAULT ''
+);
+CREATE TABLE IF NOT EXISTS inventario (
+    id SERIAL PRIMARY KEY,
+    articulo_id INTEGER REFERENCES articulos(id),
+    almacen_id INTEGER REFERENCES almacenes(id),
+    stock_actual NUMERIC(18,3) DEFAULT 0, stock_minimo NUMERIC(18,3) DEFAULT 0,
+    ultima_actualizacion TEXT DEFAULT '',
+    UNIQUE (articulo_id, almacen_id)
+);
+CREATE TABLE IF NOT EXISTS tomas_inventario (
+    id SERIAL PRIMARY KEY, folio TEXT UNIQUE,
+    almacen_id INTEGER REFERENCES almacenes(id),
+    estatus TEXT DEFAULT 'borrador', observaciones TEXT DEFAULT '',
+    creado_por INTEGER REFERENCES usuarios(id),
+    fecha_creacion TEXT DEFAULT '', fecha_cierre TEXT DEFAULT ''
+);
+CREATE TABLE IF NOT EXISTS tomas_inventario_lineas (
+    id SERIAL PRIMARY KEY,
+    toma_id INTEGER REFERENCES tomas_inventario(id) ON DELETE CASCADE,
+    articulo_id INTEGER REFERENCES articulos(id),
+    stock_sistema NUMERIC(18,3) DEFAULT 0, stock_contado NUMERIC(18,3) DEFAULT 0,
+    diferencia NUMERIC(18,3) DEFAULT 0, observacion TEXT DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS ix_tomas_lineas_toma ON tomas_inventario_lineas (toma_id);
+
+-- ── Compras ──────────────────────────────────────────────
+CREATE TABLE IF NOT EXISTS ordenes_compra (
+    id SERIAL PRIMARY KEY, folio TEXT UNIQUE,
+    proveedor_id INTEGER REFERENCES clientes(id), proveedor_nombre TEXT DEFAULT '',
+    estatus TEXT DEFAULT 'borrador', almacen_id INTEGER REFERENCES almacenes(id),
+    moneda TEXT DEFAULT 'MXN',
+    subtotal NUMERIC(18,2) DEFAULT 0, impuesto NUMERIC(18,2) DEFAULT 0,
+    total NUMERIC(18,2) DEFAULT 0,
+    notas TEXT DEFAULT '', fecha_entrega TEXT DEFAULT '',
+    sap_doc_entry INTEGER, sap_sync_status TEXT DEFAULT '', sap_sync_msg TEXT DEFAULT '',
+    creado_por INTEGER REFERENCES usuarios(id),
+    fecha_creacion TEXT DEFAULT '', fecha_actualizacion TEXT DEFAULT ''
+);
+CREATE TABLE IF NOT EXISTS ordenes_compra_items (
+    id SERIAL PRIMARY KEY,
+    orden_id INTEGER REFERENCES ordenes_compra(id) ON DELETE CASCADE,
+    item_code TEXT, item_nombre TEXT, uom TEXT DEFAULT '',
+    cantidad NUMERIC(18,3) DEFAULT 1, precio_unitario NUMERIC(18,2) DEFAULT 0,
+    subtotal NUMERIC(18,2) DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS entradas_mercancia (
+    id SERIAL PRIMARY KEY, folio TEXT UNIQUE,
+    orden_compra_id INTEGER REFERENCES ordenes_compra(id),
+    almacen_id INTEGER REFERENCES almacenes(id),
+    estatus TEXT DEFAULT 'recibida', notas TEXT DEFAULT '',
+    sap_doc_entry INTEGER, sap_sync_status TEXT DEFAULT '', sap_sync_msg TEXT DEFAULT '',
+    creado_por INTEGER REFERENCES usuarios(id),
+    fecha_creacion TEXT DEFAULT '', fecha_recepcion TEXT DEFAULT ''
+);
+CREATE TABLE IF NOT EXISTS entradas_mercancia_items (
+    id SERIAL PRIMARY KEY,
+    entrada_id INTEGER REFERENCES entradas_mercancia(id) ON DELETE CASCADE,
+    item_code TEXT, item_nombre TEXT, uom TEXT DEFAULT '',
+    cantidad_pedida NUMERIC(18,3) DEFAULT 0, cantidad_recibida NUMERIC(18,3) DEFAULT 0,
+    precio_unitario NUMERIC(18,2) DEFAULT 0,
+    numero_serie TEXT DEFAULT '', numero_lote TEXT DEFAULT ''
+);
+
+-- ── Ventas ───────────────────────────────────────────────
+CREATE TABLE IF NOT EXISTS ordenes_venta (
+    id SERIAL PRIMARY KEY, folio TEXT UNIQUE,
+    cotizacion_id INTEGER REFERENCES cotizaciones(id),
+    cliente_id INTEGER REFERENCES clientes(id), cliente_nombre TEXT DEFAULT '',
+    almacen_id INTEGER REFERENCES almacenes(id),
+    estatus TEXT DEFAULT 'borrador', moneda TEXT DEFAULT 'MXN',
+    subtotal NUMERIC(18,2) DEFAULT 0, descuento_monto NUMERIC(18,2) DEFAULT 0,
+    impuesto NUMERIC(18,2) DEFAULT 0, total NUMERIC(18,2) DEFAULT 0,
+    notas TEXT DEFAULT '', fecha_entrega TEXT DEFAULT '',
+    sap_doc_entry INTEGER, sap_sync_status TEXT DEFAULT '', sap_sync_msg TEXT DEFAULT '',
+    creado_por INTEGER REFERENCES usuarios(id),
+    fecha_creacion TEXT DEFAULT '', fecha_actualizacion TEXT DEFAULT ''
+);
+CREATE TABLE IF NOT EXISTS ordenes_venta_items (
+    id SERIAL PRIMARY KEY,
+    orden_id INTEGER REFERENCES ordenes_venta(id) ON DELETE CASCADE,
+    item_code TEXT, item_nombre TEXT, uom TEXT DEFAULT '',
+    cantidad NUMERIC(18,3) DEFAULT 1, precio_unitario NUMERIC(18,2) DEFAULT 0,
+    descuento NUMERIC(5,2) DEFAULT 0, subtotal NUMERIC(18,2) DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS remisiones (
+    id SERIAL PRIMARY KEY, folio TEXT UNIQUE,
+    orden_venta_id INTEGER REFERENCES ordenes_venta(id),
+    cliente_id INTEGER REFERENCES clientes(id), cliente_nombre TEXT DEFAULT '',
+    almacen_id INTEGER REFERENCES almacenes(id),
+    estatus TEXT DEFAULT 'entregada', notas TEXT DEFAULT '',
+    sap_doc_entry INTEGER, sap_sync_status TEXT DEFAULT '', sap_sync_msg TEXT DEFAULT '',
+    creado_por INTEGER REFERENCES usuarios(id),
+    fecha_creacion TEXT DEFAULT '', fecha_entrega TEXT DEFAULT ''
+);
+CREATE TABLE IF NOT EXISTS remisiones_items (
+    id SERIAL PRIMARY KEY,
+    remision_id INTEGER REFERENCES remisiones(id) ON DELETE CASCADE,
+    item_code TEXT, item_nombre TEXT, uom TEXT DEFAULT '',
+    cantidad NUMERIC(18,3) DEFAULT 0, precio_unitario NUMERIC(18,2) DEFAULT 0,
+    subtotal NUMERIC(18,2) DEFAULT 0,
+    numero_serie TEXT DEFAULT '', numero_lote TEXT DEFAULT ''
+);
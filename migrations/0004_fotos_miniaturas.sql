@@ -0,0 +1,2 @@
+-- Anchos (px) de las miniaturas generadas para cada foto, p.ej. '320,640'.
+ALTER TABLE fotos ADD COLUMN IF NOT EXISTS miniaturas TEXT DEFAULT '';
@@ -0,0 +1,3 @@
+-- Búsqueda de clientes existentes por RFC / email (importación masiva).
+CREATE INDEX IF NOT EXISTS ix_clientes_rfc   ON clientes (upper(rfc))   WHERE rfc <> '';
+CREATE INDEX IF NOT EXISTS ix_clientes_email ON clientes (lower(email)) WHERE email <> '';
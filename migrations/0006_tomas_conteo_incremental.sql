@@ -0,0 +1,24 @@
+-- Conteo incremental de tomas (API para escáneres): subtotal por contador y
+-- por línea, lotes idempotentes y avance barato con índice parcial.
+ALTER TABLE tomas_inventario_lineas ADD COLUMN IF NOT EXISTS contada BOOLEAN DEFAULT false;
+UPDATE tomas_inventario_lineas SET contada=true WHERE stock_contado <> 0 AND NOT contada;
+CREATE INDEX IF NOT EXISTS ix_tomas_lineas_contadas ON tomas_inventario_lineas (toma_id) WHERE contada;
+CREATE INDEX IF NOT EXISTS ix_tomas_lineas_articulo ON tomas_inventario_lineas (toma_id, articulo_id);
+
+CREATE TABLE IF NOT EXISTS tomas_inventario_conteos (
+    linea_id INTEGER REFERENCES tomas_inventario_lineas(id) ON DELETE CASCADE,
+    usuario_id INTEGER REFERENCES usuarios(id),
+    toma_id INTEGER REFERENCES tomas_inventario(id) ON DELETE CASCADE,
+    cantidad NUMERIC(18,3) DEFAULT 0, escaneos INTEGER DEFAULT 0,
+    fecha TEXT DEFAULT '',
+    PRIMARY KEY (linea_id, usuario_id)
+);
+CREATE INDEX IF NOT EXISTS ix_tomas_conteos_toma ON tomas_inventario_conteos (toma_id, usuario_id);
+
+CREATE TABLE IF NOT EXISTS tomas_inventario_lotes (
+    toma_id INTEGER REFERENCES tomas_inventario(id) ON DELETE CASCADE,
+    clave TEXT NOT NULL,
+    usuario_id INTEGER REFERENCES usuarios(id),
+    respuesta TEXT DEFAULT '', fecha TEXT DEFAULT '',
+    PRIMARY KEY (toma_id, clave)
+);
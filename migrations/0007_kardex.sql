@@ -0,0 +1,34 @@
+-- Kardex: bitácora de movimientos de inventario (sólo se agregan filas) y
+-- fotos periódicas del saldo por (artículo, almacén) para consultas a fecha.
+CREATE TABLE IF NOT EXISTS inventario_movimientos (
+    id BIGSERIAL PRIMARY KEY,
+    articulo_id INTEGER NOT NULL REFERENCES articulos(id),
+    almacen_id INTEGER NOT NULL REFERENCES almacenes(id),
+    fecha TIMESTAMP NOT NULL DEFAULT now(),
+    tipo TEXT NOT NULL,                -- inicial | entrada | remision | toma
+    cantidad NUMERIC(18,3) NOT NULL,   -- positiva entra, negativa sale
+    saldo NUMERIC(18,3) NOT NULL,      -- existencia después del movimiento
+    documento TEXT DEFAULT '', documento_id INTEGER,
+    usuario_id INTEGER REFERENCES usuarios(id)
+);
+CREATE INDEX IF NOT EXISTS ix_movimientos_articulo ON inventario_movimientos (articulo_id, almacen_id, id);
+CREATE INDEX IF NOT EXISTS ix_movimientos_fecha    ON inventario_movimientos (articulo_id, almacen_id, fecha);
+CREATE INDEX IF NOT EXISTS ix_movimientos_documento ON inventario_movimientos (documento, documento_id);
+
+CREATE TABLE IF NOT EXISTS inventario_snapshots (
+    articulo_id INTEGER NOT NULL REFERENCES articulos(id),
+    almacen_id INTEGER NOT NULL REFERENCES almacenes(id),
+    fecha TIMESTAMP NOT NULL,
+    saldo NUMERIC(18,3) NOT NULL,
+    movimiento_id BIGINT NOT NULL,     -- último movimiento incluido en el saldo
+    PRIMARY KEY (articulo_id, almacen_id, fecha)
+);
+CREATE INDEX IF NOT EXISTS ix_snapshots_movimiento ON inventario_snapshots (articulo_id, almacen_id, movimiento_id);
+
+-- Saldo de arranque: la existencia actual entra como movimiento inicial.
+INSERT INTO inventario_movimientos (articulo_id,almacen_id,tipo,cantidad,saldo,documento)
+SELECT articulo_id,almacen_id,'inicial',stock_actual,stock_actual,'saldo inicial'
+FROM inventario
+WHERE articulo_id IS NOT NULL AND almacen_id IS NOT NULL
+  AND NOT EXISTS (SELECT 1 FROM inventario_movimientos)
+ORDER BY almacen_id,articulo_id;
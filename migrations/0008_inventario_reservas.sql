@@ -0,0 +1,34 @@
+-- Reservas de stock por orden de venta. inventario.stock_reservado es la suma
+-- materializada de las reservas abiertas del renglón; disponible = stock_actual
+-- - stock_reservado sin recorrer órdenes.
+ALTER TABLE inventario ADD COLUMN IF NOT EXISTS stock_reservado NUMERIC(18,3) NOT NULL DEFAULT 0;
+
+CREATE TABLE IF NOT EXISTS inventario_reservas (
+    orden_venta_id INTEGER NOT NULL REFERENCES ordenes_venta(id) ON DELETE CASCADE,
+    articulo_id INTEGER NOT NULL REFERENCES articulos(id),
+    almacen_id INTEGER NOT NULL REFERENCES almacenes(id),
+    cantidad NUMERIC(18,3) NOT NULL CHECK (cantidad > 0),
+    fecha TEXT DEFAULT '',
+    PRIMARY KEY (orden_venta_id, articulo_id, almacen_id)
+);
+CREATE INDEX IF NOT EXISTS ix_reservas_articulo ON inventario_reservas (almacen_id, articulo_id);
+
+-- Órdenes ya confirmadas reservan lo que piden (aunque el disponible quede negativo).
+INSERT INTO inventario_reservas (orden_venta_id,articulo_id,almacen_id,cantidad,fecha)
+SELECT ov.id,a.id,ov.almacen_id,SUM(i.cantidad),ov.fecha_actualizacion
+FROM ordenes_venta ov
+JOIN ordenes_venta_items i ON i.orden_id=ov.id
+JOIN articulos a ON a.codigo=i.item_code
+WHERE ov.estatus IN ('confirmada','en proceso') AND ov.almacen_id IS NOT NULL
+GROUP BY ov.id,a.id,ov.almacen_id,ov.fecha_actualizacion
+HAVING SUM(i.cantidad) > 0
+ON CONFLICT DO NOTHING;
+
+INSERT INTO inventario (articulo_id,almacen_id,stock_actual)
+SELECT DISTINCT articulo_id,almacen_id,0 FROM inventario_reservas
+ON CONFLICT (articulo_id,almacen_id) DO NOTHING;
+
+UPDATE inventario i SET stock_reservado=r.cantidad
+FROM (SELECT articulo_id,almacen_id,SUM(cantidad) AS cantidad
+      FROM inventario_reservas GROUP BY 1,2) r
+WHERE i.articulo_id=r.articulo_id AND i.almacen_id=r.almacen_id;
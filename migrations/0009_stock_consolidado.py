@@ -0,0 +1,53 @@
+"""Vista materializada con el stock consolidado (portal + réplica SAP) por
+artículo y almacén, con totales por artículo. La lee /inventario y se refresca
+con REFRESH ... CONCURRENTLY (por eso el índice único)."""
+
+VISTA = """
+CREATE MATERIALIZED VIEW IF NOT EXISTS mv_stock_consolidado AS
+WITH s AS (
+    SELECT 'portal'::text AS fuente, a.codigo AS item_code, a.nombre, a.uom, a.grupo,
+           alm.codigo AS almacen_codigo, alm.nombre AS almacen_nombre,
+           i.articulo_id, i.almacen_id,
+           i.stock_actual AS stock, i.stock_reservado AS reservado,
+           i.stock_actual - i.stock_reservado AS disponible, i.stock_minimo
+    FROM inventario i
+    JOIN articulos a ON a.id=i.articulo_id
+    JOIN almacenes alm ON alm.id=i.almacen_id
+    WHERE a.activo
+    UNION ALL
+    SELECT 'sap', w.item_code, si.item_name, si.uom, si.item_group,
+           w.warehouse_code, COALESCE(NULLIF(w.warehouse_name,''), alm.nombre, w.warehouse_code),
+           a.id, alm.id,
+           w.in_stock, w.in_stock - w.available, w.available, 0
+    FROM sap_item_warehouse w
+    JOIN sap_items si ON si.item_code=w.item_code
+    LEFT JOIN articulos a ON a.codigo=w.item_code
+    LEFT JOIN almacenes alm ON alm.codigo=w.warehouse_code
+    WHERE w.in_stock <> 0 OR w.available <> 0
+)
+SELECT s.*,
+       SUM(s.stock)      OVER (PARTITION BY s.fuente, s.item_code) AS stock_total,
+       SUM(s.disponible) OVER (PARTITION BY s.fuente, s.item_code) AS disponible_total
+FROM s
+"""
+
+def upgrade(cur):
+    cur.execute(VISTA)
+    cur.execute("""CREATE UNIQUE INDEX IF NOT EXISTS ux_mv_stock_clave
+                   ON mv_stock_consolidado (fuente, item_code, almacen_codigo)""")
+    cur.execute("""CREATE INDEX IF NOT EXISTS ix_mv_stock_almacen
+                   ON mv_stock_consolidado (almacen_codigo, almacen_nombre, nombre)""")
+    # Búsqueda por código/nombre con ILIKE '%texto%': trigramas si la extensión
+    # está disponible; si no, al menos búsquedas por prefijo.
+    cur.execute("SAVEPOINT trgm")
+    try:
+        cur.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        cur.execute("""CREATE INDEX IF NOT EXISTS ix_mv_stock_texto ON mv_stock_consolidado
+                       USING gin (item_code gin_trgm_ops, nombre gin_trgm_ops)""")
+    except Exception:
+        cur.execute("ROLLBACK TO SAVEPOINT trgm")
+        cur.execute("""CREATE INDEX IF NOT EXISTS ix_mv_stock_codigo
+                       ON mv_stock_consolidado (lower(item_code) text_pattern_ops)""")
+        cur.execute("""CREATE INDEX IF NOT EXISTS ix_mv_stock_nombre
+                       ON mv_stock_consolidado (lower(nombre) text_pattern_ops)""")
+    cur.execute("RELEASE SAVEPOINT trgm")
@@ -0,0 +1,9 @@
+-- Búsqueda de números de serie: paginación por artículo y búsqueda exacta o
+-- por prefijo (sin distinguir mayúsculas) sobre todos los artículos. El índice
+-- va en collation "C": sirve igual para LIKE 'ABC%', rangos y ORDER BY.
+CREATE INDEX IF NOT EXISTS ix_serial_item
+    ON sap_item_serial (item_code, serial_number, warehouse_code)
+    WHERE serial_number IS NOT NULL;
+CREATE INDEX IF NOT EXISTS ix_serial_numero
+    ON sap_item_serial ((upper(serial_number) COLLATE "C"))
+    WHERE serial_number IS NOT NULL;
@@ -0,0 +1,10 @@
+-- CardCode SAP como columna propia (antes sólo vivía en notas como
+-- "SAP CardCode: C00123") y búsqueda de socios por nombre con índice.
+ALTER TABLE clientes ADD COLUMN IF NOT EXISTS sap_card_code TEXT DEFAULT '';
+
+UPDATE clientes SET sap_card_code=substring(notas from 'SAP CardCode:\s*(\S+)')
+WHERE COALESCE(sap_card_code,'')='' AND notas ~ 'SAP CardCode:\s*\S';
+
+CREATE INDEX IF NOT EXISTS ix_clientes_sap_card_code ON clientes (sap_card_code) WHERE sap_card_code <> '';
+CREATE INDEX IF NOT EXISTS ix_clientes_nombre_lower ON clientes (lower(nombre));
+CREATE INDEX IF NOT EXISTS ix_bp_card_name_lower ON sap_business_partners (lower(card_name));
@@ -0,0 +1,20 @@
+-- Sugerencias de clientes duplicados (las genera `flask dedup-clientes`) e
+-- índices para reasignar documentos al fusionar.
+CREATE TABLE IF NOT EXISTS clientes_duplicados (
+    cliente_a INTEGER NOT NULL REFERENCES clientes(id) ON DELETE CASCADE,
+    cliente_b INTEGER NOT NULL REFERENCES clientes(id) ON DELETE CASCADE,
+    puntaje NUMERIC(4,3) NOT NULL, motivo TEXT DEFAULT '',
+    estatus TEXT DEFAULT 'pendiente',          -- pendiente | descartado | fusionado
+    fecha TEXT DEFAULT '',
+    PRIMARY KEY (cliente_a, cliente_b),
+    CHECK (cliente_a < cliente_b)
+);
+CREATE INDEX IF NOT EXISTS ix_duplicados_pendientes ON clientes_duplicados (puntaje DESC) WHERE estatus='pendiente';
+CREATE INDEX IF NOT EXISTS ix_duplicados_b ON clientes_duplicados (cliente_b);
+
+CREATE INDEX IF NOT EXISTS ix_cotizaciones_cliente ON cotizaciones (cliente_id);
+CREATE INDEX IF NOT EXISTS ix_llamadas_cliente ON llamadas_servicio (cliente_id);
+CREATE INDEX IF NOT EXISTS ix_ordenes_venta_cliente ON ordenes_venta (cliente_id);
+CREATE INDEX IF NOT EXISTS ix_remisiones_cliente ON remisiones (cliente_id);
+CREATE INDEX IF NOT EXISTS ix_ordenes_compra_proveedor ON ordenes_compra (proveedor_id);
+CREATE INDEX IF NOT EXISTS ix_actividades_cliente ON actividades (lower(cliente));
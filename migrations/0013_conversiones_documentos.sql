@@ -0,0 +1,19 @@
+-- Conversiones cotización → OV → remisión del lado del servidor: cada renglón
+-- de remisión apunta al renglón de OV que surte (entregas parciales) e índices
+-- para las copias INSERT ... SELECT y el anti-join de cotizaciones pendientes.
+ALTER TABLE remisiones_items ADD COLUMN IF NOT EXISTS orden_item_id INTEGER REFERENCES ordenes_venta_items(id);
+
+-- Remisiones anteriores: al primer renglón de su OV con el mismo código
+UPDATE remisiones_items ri SET orden_item_id=(
+    SELECT oi.id FROM remisiones r
+    JOIN ordenes_venta_items oi ON oi.orden_id=r.orden_venta_id AND oi.item_code=ri.item_code
+    WHERE r.id=ri.remision_id ORDER BY oi.id LIMIT 1)
+WHERE ri.orden_item_id IS NULL;
+
+CREATE INDEX IF NOT EXISTS ix_remisiones_items_orden_item ON remisiones_items (orden_item_id);
+CREATE INDEX IF NOT EXISTS ix_remisiones_items_remision   ON remisiones_items (remision_id);
+CREATE INDEX IF NOT EXISTS ix_remisiones_ov               ON remisiones (orden_venta_id);
+CREATE INDEX IF NOT EXISTS ix_cotizaciones_items_cot      ON cotizaciones_items (cotizacion_id);
+CREATE INDEX IF NOT EXISTS ix_ordenes_venta_items_orden   ON ordenes_venta_items (orden_id);
+CREATE INDEX IF NOT EXISTS ix_ordenes_venta_cotizacion    ON ordenes_venta (cotizacion_id) WHERE cotizacion_id IS NOT NULL;
+CREATE INDEX IF NOT EXISTS ix_cotizaciones_aceptadas      ON cotizaciones (fecha_creacion DESC) WHERE estatus='aceptada';
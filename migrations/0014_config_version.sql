@@ -0,0 +1,3 @@
+-- Versión de la configuración visual: forma parte de la clave de caché de los
+-- PDF de cotizaciones y remisiones (cambiar la marca los regenera).
+ALTER TABLE config ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1;
@@ -0,0 +1,48 @@
+-- Reportes: agregados diarios de cotizaciones y ventas por vendedor. Los
+-- documentos que se crean o cambian marcan su día en rep_dias_pendientes y
+-- `flask refresh-reportes` (o el refresco programado) recalcula sólo esos días.
+CREATE TABLE IF NOT EXISTS rep_cotizaciones_dia (
+    dia DATE NOT NULL,
+    vendedor_id INTEGER NOT NULL DEFAULT 0,      -- 0: sin creador
+    estatus TEXT NOT NULL DEFAULT '',
+    cotizaciones INTEGER NOT NULL DEFAULT 0,
+    total NUMERIC(18,2) NOT NULL DEFAULT 0,
+    convertidas INTEGER NOT NULL DEFAULT 0,      -- con OV no cancelada
+    total_convertido NUMERIC(18,2) NOT NULL DEFAULT 0,
+    PRIMARY KEY (dia, vendedor_id, estatus)
+);
+
+CREATE TABLE IF NOT EXISTS rep_ventas_cliente_dia (
+    dia DATE NOT NULL,
+    vendedor_id INTEGER NOT NULL DEFAULT 0,
+    cliente_id INTEGER NOT NULL DEFAULT 0,       -- 0: cliente capturado sólo por nombre
+    cliente_nombre TEXT NOT NULL DEFAULT '',
+    ordenes INTEGER NOT NULL DEFAULT 0,
+    subtotal NUMERIC(18,2) NOT NULL DEFAULT 0,
+    total NUMERIC(18,2) NOT NULL DEFAULT 0,
+    PRIMARY KEY (dia, vendedor_id, cliente_id, cliente_nombre)
+);
+
+CREATE TABLE IF NOT EXISTS rep_ventas_articulo_dia (
+    dia DATE NOT NULL,
+    vendedor_id INTEGER NOT NULL DEFAULT 0,
+    item_code TEXT NOT NULL DEFAULT '',
+    item_nombre TEXT DEFAULT '',
+    cantidad NUMERIC(18,3) NOT NULL DEFAULT 0,
+    importe NUMERIC(18,2) NOT NULL DEFAULT 0,
+    PRIMARY KEY (dia, vendedor_id, item_code)
+);
+
+CREATE TABLE IF NOT EXISTS rep_dias_pendientes (dia DATE PRIMARY KEY);
+
+-- Para recalcular un día sin recorrer toda la tabla
+CREATE INDEX IF NOT EXISTS ix_cotizaciones_dia  ON cotizaciones (left(fecha_creacion,10));
+CREATE INDEX IF NOT EXISTS ix_ordenes_venta_dia ON ordenes_venta (left(fecha_creacion,10));
+
+-- Historia existente: queda pendiente para el primer refresco
+INSERT INTO rep_dias_pendientes (dia)
+SELECT DISTINCT left(fecha_creacion,10)::date FROM (
+    SELECT fecha_creacion FROM cotizaciones
+    UNION ALL SELECT fecha_creacion FROM ordenes_venta) f
+WHERE fecha_creacion ~ '^\d{4}-\d{2}-\d{2}'
+ON CONFLICT DO NOTHING;
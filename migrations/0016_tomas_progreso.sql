@@ -0,0 +1,21 @@
+-- Avance de tomas sin contar líneas: contadores en el encabezado que mantienen
+-- crear_toma, la API de conteo y el guardado del formulario.
+ALTER TABLE tomas_inventario ADD COLUMN IF NOT EXISTS lineas INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE tomas_inventario ADD COLUMN IF NOT EXISTS contadas INTEGER NOT NULL DEFAULT 0;
+
+UPDATE tomas_inventario t SET lineas=s.lineas, contadas=s.contadas
+FROM (SELECT toma_id, COUNT(*) AS lineas, COUNT(*) FILTER (WHERE contada) AS contadas
+      FROM tomas_inventario_lineas GROUP BY toma_id) s
+WHERE s.toma_id=t.id;
+
+-- Conteos capturados antes por el formulario (sin subtotal por contador): se
+-- asignan al creador de la toma para que la suma de conteos los conserve.
+INSERT INTO tomas_inventario_conteos AS c (linea_id,usuario_id,toma_id,cantidad,escaneos,fecha)
+SELECT l.id, t.creado_por, l.toma_id, l.stock_contado-COALESCE(s.total,0), 0, ''
+FROM tomas_inventario_lineas l
+JOIN tomas_inventario t ON t.id=l.toma_id
+LEFT JOIN (SELECT linea_id, SUM(cantidad) AS total FROM tomas_inventario_conteos GROUP BY linea_id) s
+       ON s.linea_id=l.id
+WHERE t.estatus<>'cerrada' AND t.creado_por IS NOT NULL AND l.contada
+  AND l.stock_contado <> COALESCE(s.total,0)
+ON CONFLICT (linea_id,usuario_id) DO UPDATE SET cantidad=c.cantidad+EXCLUDED.cantidad;
@@ -0,0 +1,4 @@
+-- Medidas reales de la foto normalizada (<nombre>_max): el srcset anuncia su
+-- ancho verdadero y el de cada miniatura en vez de suponer IMG_MAX_LADO.
+ALTER TABLE fotos ADD COLUMN IF NOT EXISTS ancho INTEGER;
+ALTER TABLE fotos ADD COLUMN IF NOT EXISTS alto INTEGER;